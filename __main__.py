@@ -1,14 +1,20 @@
+import metrics
 import opentherm
-import code
+import opentherm_commands
+import opentherm_recorder
+import pipeline
+import profiler
+import tracing
 import datetime
 import logging
 import signal
 import json
+import os
+import sys
 import paho.mqtt.client as mqtt
 
-# Values used to parse boolean values of incoming messages
-true_values=('True', 'true', '1', 'y', 'yes')
-false_values=('False', 'false', '0', 'n', 'no')
+# Run the OTGW and MQTT clients on an asyncio event loop instead of in threads
+use_asyncio = '--async' in sys.argv[1:]
 
 # Default settings
 settings = {
@@ -28,7 +34,18 @@ settings = {
         "qos": 0,
         "pub_topic_namespace": "value/otgw",
         "sub_topic_namespace": "set/otgw",
-        "retain": False
+        "retain": False,
+        "publish_on_change": False,
+        "deadband": 0,
+        "max_silence": 300,
+        "batch_window": 0,
+        "batch_size": 100,
+        "queue_size": 0,
+        "queue_policy": "drop-oldest"
+    },
+    "commands" : {
+        "queue": True,
+        "timeout": 2
     }
 }
 
@@ -37,7 +54,37 @@ with open('config.json') as f:
     settings.update(json.load(f))
 
 # Set the namespace of the mqtt messages from the settings
-opentherm.topic_namespace=settings['mqtt']['pub_topic_namespace']
+opentherm.set_topic_namespace(settings['mqtt']['pub_topic_namespace'])
+
+# Bridge all gateways in the gateways list, or the single otgw gateway. Each
+# gateway publishes and subscribes in its own namespace, which is the
+# namespace from the mqtt settings followed by the gateway's name (or index)
+# when there are multiple gateways
+gateways = settings.get('gateways') or [settings['otgw']]
+for index, gateway in enumerate(gateways):
+    suffix = '/{}'.format(gateway.get('name', index)) \
+        if settings.get('gateways') else ''
+    gateway.setdefault('pub_topic_namespace', '{}{}'.format(
+        settings['mqtt']['pub_topic_namespace'], suffix))
+    gateway.setdefault('sub_topic_namespace', '{}{}'.format(
+        settings['mqtt']['sub_topic_namespace'], suffix))
+
+def gateway_args(gateway):
+    # Get the arguments for a gateway client from its settings
+    args = dict(gateway)
+    args['namespace'] = args.pop('pub_topic_namespace')
+    del args['sub_topic_namespace']
+    return args
+
+# Only publish changed values, if enabled
+publish_filter = None
+if settings['mqtt'].get('publish_on_change'):
+    publish_filter = pipeline.ChangeFilter(
+        deadband=settings['mqtt'].get('deadband', 0),
+        max_silence=settings['mqtt'].get('max_silence'),
+        float_topics=frozenset().union(*(
+            opentherm.PublishTable(gateway['pub_topic_namespace']).float_topics
+            for gateway in gateways)))
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -47,8 +94,15 @@ def on_mqtt_connect(client, userdata, flags, rc):
     # Subscribe to all topics in our namespace when we're connected. Send out
     # a message telling we're online
     log.info("Connected with result code "+str(rc))
-    mqtt_client.subscribe('{}/#'.format(settings['mqtt']['sub_topic_namespace']))
-    mqtt_client.subscribe('{}'.format(settings['mqtt']['sub_topic_namespace']))
+    if publish_filter:
+        # Publish all values again after (re)connecting
+        publish_filter.reset()
+    for gateway in gateways:
+        mqtt_client.subscribe('{}/#'.format(gateway['sub_topic_namespace']))
+        mqtt_client.subscribe('{}'.format(gateway['sub_topic_namespace']))
+    if not any(profile_topic.startswith(gateway['sub_topic_namespace'] + '/')
+               for gateway in gateways):
+        mqtt_client.subscribe(profile_topic)
     mqtt_client.publish(
         topic=opentherm.topic_namespace,
         payload="online",
@@ -56,42 +110,56 @@ def on_mqtt_connect(client, userdata, flags, rc):
         retain=True)
 
 def on_mqtt_message(client, userdata, msg):
-    # Handle incoming messages
-    log.info("Received message on topic {} with payload {}".format(
+    # Handle incoming messages that are not a command for a gateway
+    log.info("Ignoring message on topic {} with payload {}".format(
                 msg.topic, str(msg.payload.decode('ascii', 'ignore'))))
-    namespace = settings['mqtt']['sub_topic_namespace']
-    command_generators={
-        "{}/room_setpoint/temporary".format(namespace): \
-            lambda _ :"TT={:.2f}".format(float(_) if is_float(_) else 0),
-        "{}/room_setpoint/constant".format(namespace):  \
-            lambda _ :"TC={:.2f}".format(float(_) if is_float(_) else 0),
-        "{}/outside_temperature".format(namespace):     \
-            lambda _ :"OT={:.2f}".format(float(_) if is_float(_) else 99),
-        "{}/hot_water/enable".format(namespace):        \
-            lambda _ :"HW={}".format('1' if _ in true_values else '0' if _ in false_values else 'T'),
-        "{}/hot_water/temperature".format(namespace):   \
-            lambda _ :"SW={:.2f}".format(float(_) if is_float(_) else 60),
-        "{}/central_heating/enable".format(namespace):  \
-            lambda _ :"CH={}".format('0' if _ in false_values else '1'),
-        # TODO: "set/otgw/raw/+": lambda _ :publish_to_otgw("PS", _)
-    }
-    # Find the correct command generator from the dict above
-    command_generator = command_generators.get(msg.topic)
-    if command_generator:
-        # Get the command and send it to the OTGW
-        command = command_generator(msg.payload.decode('ascii', 'ignore'))
-        log.info("Sending command: '{}'".format(command))
-        otgw_client.write("{}\r".format(command))
+
+def on_profile_message(client, userdata, msg):
+    # Profile for the number of seconds in the payload
+    payload = msg.payload.decode('ascii', 'ignore')
+    log.info("Received message on topic {} with payload {}".format(
+                msg.topic, payload))
+    start_profile(float(payload) if is_float(payload)
+                  else profile_settings['duration'])
 
 
 def on_otgw_message(message):
     # Send out messages to the MQTT broker
     log.debug("[{}] {}".format(str(datetime.datetime.now()), message))
-    mqtt_client.publish(
-        topic=message[0],
-        payload=message[1],
-        qos=settings['mqtt']['qos'],
-        retain=settings['mqtt']['retain'])
+    if publish_queue:
+        publish_queue.put(message[0], message[1])
+    else:
+        forward_messages((message, ))
+
+def forward_messages(messages):
+    # Pass the changed messages on to the batcher or the MQTT broker
+    if publish_filter:
+        messages = [message for message in messages
+                    if publish_filter.accept(message[0], message[1])]
+    if tracer:
+        for topic, payload in messages:
+            tracer.mark(topic, 'queue')
+    if publish_batcher:
+        for topic, payload in messages:
+            publish_batcher.add(topic, payload)
+    elif messages:
+        publish_messages(messages)
+
+def publish_messages(messages):
+    # Send out a batch of messages to the MQTT broker at once
+    qos = settings['mqtt']['qos']
+    retain = settings['mqtt']['retain']
+    if tracer:
+        for topic, payload in messages:
+            tracer.mark(topic, 'batch')
+    start = pipeline.time_func()
+    infos = mqtt_client.publish_many(
+        (topic, payload, qos, retain, ) for topic, payload in messages)
+    publish_seconds.observe(pipeline.time_func() - start)
+    if tracer:
+        for (topic, payload), info in zip(messages, infos):
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                tracer.published(topic, info.mid)
 
 def is_float(value):
     try:
@@ -100,6 +168,80 @@ def is_float(value):
     except ValueError:
         return False
 
+def start_profile(duration):
+    # Take a profile of all threads, unless one is being taken already
+    if not sampling_profiler.start(duration):
+        log.warning("Already profiling")
+
+def publish_command_result(namespace, command, status, response, latency):
+    # Send out the result of a command sent to the OTGW
+    mqtt_client.publish(
+        topic='{}/command/{}'.format(namespace, command[:2]),
+        payload=json.dumps({
+            'command': command,
+            'status': status,
+            'response': response,
+            'latency': round(latency, 3),
+        }),
+        qos=settings['mqtt']['qos'])
+
+def create_command_queue(gateway, otgw_client, call):
+    # Queue the commands for a gateway, writing them to the client and
+    # publishing their results with call
+    namespace = gateway['pub_topic_namespace']
+    return opentherm_commands.CommandQueue(
+        lambda data: call(otgw_client.write, data),
+        on_result=lambda *result: call(publish_command_result, namespace,
+                                       *result),
+        timeout=settings['commands'].get('timeout', 2))
+
+def route_commands(otgw_clients, call=lambda func, *args: func(*args)):
+    # Send the commands in the subscription namespace of every gateway to
+    # its client, through a command queue if enabled. The clients are
+    # written to and the results are published with call, so that can be
+    # done on an event loop.
+    for gateway, otgw_client in zip(gateways, otgw_clients):
+        target = otgw_client
+        if settings['commands'].get('queue', True):
+            target = create_command_queue(gateway, otgw_client, call)
+            otgw_client.command_queue = target
+            target.start()
+        command_router.add(gateway['sub_topic_namespace'], target)
+
+def start_recorders(otgw_clients):
+    # Record the raw frames of every gateway, if enabled. With multiple
+    # gateways, every gateway gets its own directory.
+    if not settings.get('recorder'):
+        return
+    for index, (gateway, otgw_client) in enumerate(zip(gateways,
+                                                       otgw_clients)):
+        args = dict(settings['recorder'])
+        directory = args.pop('directory', 'recordings')
+        if settings.get('gateways'):
+            directory = os.path.join(directory,
+                                     str(gateway.get('name', index)))
+        otgw_client.recorder = opentherm_recorder.FrameRecorder(directory,
+                                                                **args)
+        otgw_client.recorder.start()
+
+def start_tracing(otgw_clients):
+    # Trace the messages of every gateway, if enabled
+    if not tracer:
+        return
+    for otgw_client in otgw_clients:
+        otgw_client.tracer = tracer
+    mqtt_client.on_publish = \
+        lambda client, userdata, mid: tracer.written(mid)
+    if hasattr(signal, 'SIGUSR1'):
+        # Log the latencies on SIGUSR1
+        signal.signal(signal.SIGUSR1, lambda signum, frame: log.info(
+            "Stage latencies in ms:\n{}".format(tracer.report())))
+
+# The time it takes to hand a batch of messages to the MQTT client
+publish_seconds = metrics.registry.histogram(
+    'otgw_publish_seconds', "Time taken to publish a batch of messages",
+    metrics.exponential_buckets(0.00001, 2, 16))
+
 log.info("Initializing MQTT")
 
 # Set up paho-mqtt
@@ -108,6 +250,10 @@ mqtt_client = mqtt.Client(
 mqtt_client.on_connect = on_mqtt_connect
 mqtt_client.on_message = on_mqtt_message
 
+# The commands for the gateways are routed by the MQTT client, the callbacks
+# are added when the gateway clients are created
+command_router = opentherm_commands.CommandRouter(mqtt_client)
+
 if settings['mqtt']['username']:
     mqtt_client.username_pw_set(
         settings['mqtt']['username'],
@@ -128,31 +274,143 @@ mqtt_client.connect_async(
     port=settings['mqtt']['port'],
     keepalive=settings['mqtt']['keepalive'],
     bind_address=settings['mqtt']['bind_address'])
+
+# Take profiles on request, on the profile topic or SIGUSR2
+profile_settings = {
+    'directory': 'profiles',
+    'interval': 0.01,
+    'duration': 30,
+}
+profile_settings.update(settings.get('profiler', {}))
+profile_topic = '{}/_debug/profile'.format(
+    settings['mqtt']['sub_topic_namespace'])
+mqtt_client.message_callback_add(profile_topic, on_profile_message)
+sampling_profiler = profiler.SamplingProfiler(
+    directory=profile_settings['directory'],
+    interval=profile_settings['interval'])
+if hasattr(signal, 'SIGUSR2'):
+    signal.signal(signal.SIGUSR2, lambda signum, frame: start_profile(
+        profile_settings['duration']))
+
+# Trace the latency of the messages through the bridge, if enabled
+tracer = None
+if settings.get('tracing'):
+    tracer = tracing.Tracer(registry=metrics.registry)
+
+# The state of the MQTT client's outgoing messages
+metrics.registry.gauge(
+    'otgw_mqtt_out_messages', "Messages waiting to be sent or acknowledged",
+    lambda: mqtt_client._out_messages_len())
+metrics.registry.gauge(
+    'otgw_mqtt_inflight_messages', "QoS > 0 messages in flight",
+    lambda: mqtt_client._inflight_messages)
+
+# Serve the metrics over HTTP, if enabled
+if settings.get('metrics'):
+    metrics_server = metrics.MetricsServer(
+        port=settings['metrics'].get('port', 9100),
+        bind_address=settings['metrics'].get('bind_address', '127.0.0.1'))
+    metrics_server.start()
+    log.info("Serving metrics on port {}".format(metrics_server.port))
+
+if use_asyncio:
+    # Messages are published straight from the event loop
+    publish_batcher = None
+    publish_queue = None
+
+    log.info("Initializing OTGW")
+
+    import asyncio
+    import opentherm_async
+
+    async_types = {
+        "serial" : opentherm_async.AsyncOTGWSerialClient,
+        "tcp" :    opentherm_async.AsyncOTGWTcpClient,
+    }
+    for gateway in gateways:
+        if gateway['type'] not in async_types:
+            log.error("Gateway type '{}' is not supported in asyncio mode"
+                      .format(gateway['type']))
+            sys.exit(1)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # Drive the MQTT client from the event loop
+    mqtt_adapter = opentherm_async.AsyncioMQTTAdapter(mqtt_client, loop)
+    mqtt_adapter.start()
+
+    otgw_clients = [async_types[gateway['type']](on_otgw_message,
+                                                 **gateway_args(gateway))
+                    for gateway in gateways]
+    route_commands(otgw_clients, loop.call_soon_threadsafe)
+    start_recorders(otgw_clients)
+    start_tracing(otgw_clients)
+
+    log.info("Running")
+
+    # Run until the gateway clients are stopped
+    loop.run_until_complete(asyncio.gather(
+        *[otgw_client.start() for otgw_client in otgw_clients]))
+
+    log.info("Done")
+    sys.exit()
+
 mqtt_client.loop_start()
 
+# Collect the messages from the OTGW in batches, if enabled
+publish_batcher = None
+if settings['mqtt'].get('batch_window'):
+    publish_batcher = pipeline.PublishBatcher(
+        publish_messages,
+        window=settings['mqtt']['batch_window'],
+        max_messages=settings['mqtt'].get('batch_size', 100))
+    publish_batcher.start()
+
+# Decouple reading from the OTGW from publishing, if enabled
+publish_queue = None
+if settings['mqtt'].get('queue_size'):
+    publish_queue = pipeline.PublishQueue(
+        forward_messages,
+        maxsize=settings['mqtt']['queue_size'],
+        policy=settings['mqtt'].get('queue_policy', 'drop-oldest'))
+    publish_queue.start()
+
 log.info("Initializing OTGW")
 
 # Import the module for the correct gateway type and return a reference to
 # the type itself, so we can instantiate it easily
-otgw_type = {
+otgw_types = {
     "serial" : lambda: __import__('opentherm_serial',
                               globals(), locals(), ['OTGWSerialClient'], 0) \
                               .OTGWSerialClient,
     "tcp" :    lambda: __import__('opentherm_tcp',
                               globals(), locals(), ['OTGWTcpClient'], 0) \
                               .OTGWTcpClient,
-                                  # This is actually not implemented yet
-}[settings['otgw']['type']]()
+    "replay" : lambda: __import__('opentherm_replay',
+                              globals(), locals(), ['OTGWReplayClient'], 0) \
+                              .OTGWReplayClient,
+}
 
-# Create the actual instance of the client
-otgw_client = otgw_type(on_otgw_message, **settings['otgw'])
+# Create the actual instances of the clients
+otgw_clients = [otgw_types[gateway['type']]()(on_otgw_message,
+                                              **gateway_args(gateway))
+                for gateway in gateways]
+route_commands(otgw_clients)
+start_recorders(otgw_clients)
+start_tracing(otgw_clients)
 
-# Start the gateway client's worker thread
-otgw_client.start()
+# A single gateway client runs its own worker thread, multiple clients are
+# read from a single thread by the supervisor
+if len(otgw_clients) == 1:
+    otgw_worker = otgw_clients[0]
+else:
+    otgw_worker = opentherm.OTGWSupervisor(otgw_clients)
+otgw_worker.start()
 
 log.info("Running")
 
-# Block until the gateway client is stopped
-otgw_client.join()
+# Block until the gateway clients are stopped
+otgw_worker.join()
 
 log.info("Done")
@@ -0,0 +1,65 @@
+r"""
+Benchmark bulk decoding of recorded OTGW logs
+
+Writes a log with timestamps from a recorded OTGW trace, repeated until it
+has the requested number of lines, decodes it with `decode_log` (NumPy) and
+with `decode_log_scalar`, checks the results are the same and prints the
+number of lines per second of each.
+
+Requires NumPy.
+
+Usage: python benchmarks/bench_bulk_decoder.py [lines] [trace-file]
+"""
+import math
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import opentherm_bulk
+from bench_decoder import default_trace, load_trace
+
+def write_log(f, lines, count):
+    timestamp = 1514764800.0
+    for i in range(count):
+        f.write('{:.6f} {}\r\n'.format(timestamp, lines[i % len(lines)])
+                .encode('ascii'))
+        timestamp += 0.1
+
+def same_columns(a, b):
+    for x, y in zip(a, b):
+        if len(x) != len(y):
+            return False
+        for p, q in zip(x, y):
+            if p != q and not (isinstance(p, float) and math.isnan(p)
+                               and math.isnan(q)):
+                return False
+    return True
+
+def bench(name, decode, path, count):
+    start = time.time()
+    columns = decode(path)
+    elapsed = time.time() - start
+    print("{:<8} {:>12.0f} lines/s {:>10} frames".format(
+        name, count / elapsed, len(columns.source)))
+    return columns
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 1000000
+    lines = load_trace(argv[2] if len(argv) > 2 else default_trace)
+    fd, path = tempfile.mkstemp(suffix='.log')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_log(f, lines, count)
+        print("{} lines, {} bytes".format(count, os.path.getsize(path)))
+        scalar = bench("scalar", opentherm_bulk.decode_log_scalar, path,
+                       count)
+        bulk = bench("numpy", opentherm_bulk.decode_log, path, count)
+        assert same_columns([column.tolist() for column in bulk], scalar)
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,66 @@
+r"""
+Benchmark the OpenTherm data id catalogue
+
+Creates frames with random values for every id in `opentherm_catalogue` and
+prints the number of frames per second the compiled `PublishTable` encodes,
+for all ids and for the ids of each value format. The dense encoder list is
+compared with looking the encoders up in a dict.
+
+Usage: python benchmarks/bench_catalogue.py [frames-per-id]
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import opentherm
+
+def dict_messages(table):
+    # Look up the encoders in a dict, like the table did before
+    encoders = dict((data_id, encoder)
+                    for data_id, encoder in enumerate(table._encoders)
+                    if encoder is not None)
+    def get_messages(data_id, value):
+        encoder = encoders.get(data_id)
+        if encoder is None:
+            return ()
+        return encoder(value)
+    return get_messages
+
+def bench(name, get_messages, frames, repeat=5, number=20):
+    def run():
+        for data_id, value in frames:
+            get_messages(data_id, value)
+    best = min(timeit.repeat(run, repeat=repeat, number=number))
+    messages = sum(len(get_messages(data_id, value))
+                   for data_id, value in frames)
+    print("{:<16} {:>12.0f} frames/s {:>12.0f} msgs/s".format(
+        name, len(frames) * number / best, messages * number / best))
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 50
+    random.seed(0)
+    table = opentherm.PublishTable(opentherm.topic_namespace)
+    frames = [(data_id, random.randrange(0x10000))
+              for data_id in sorted(opentherm.opentherm_catalogue)
+              for _ in range(count)]
+    # Unknown ids are looked up too, but yield no messages
+    frames += [(data_id, 0) for data_id in range(256)
+               if data_id not in opentherm.opentherm_catalogue]
+    random.shuffle(frames)
+    print("{} ids, {} frames".format(len(opentherm.opentherm_catalogue),
+                                     len(frames)))
+    bench("list", table.get_messages, frames)
+    bench("dict", dict_messages(table), frames)
+    formats = sorted(set(entry[1]
+                         for entry in opentherm.opentherm_catalogue.values()))
+    for value_format in formats:
+        bench(value_format, table.get_messages,
+              [(data_id, value) for data_id, value in frames
+               if data_id in opentherm.opentherm_catalogue
+               and opentherm.opentherm_catalogue[data_id][1] == value_format])
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,121 @@
+r"""
+Benchmark the OTGW line decoder
+
+Decodes every line of a recorded OTGW trace into its source, message type,
+data id and value, with the legacy regex-based parser, which converts every
+field with a separate `int` call, and with `opentherm.decode_frame`. Prints
+the number of lines per second each of them handles.
+
+Usage: python benchmarks/bench_decoder.py [trace-file]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import opentherm
+
+default_trace = os.path.join(os.path.dirname(__file__), 'data',
+                             'otgw_trace.txt')
+
+# The message generators the legacy parser used, before the messages were
+# created by `opentherm.PublishTable`
+
+def flags_msg_generator(ot_id, val):
+    yield (opentherm.encode_topic(ot_id), val, )
+    if(ot_id == "flame_status"):
+        yield (opentherm.encode_topic("flame_status_ch"),
+               val & ( 1 << 1 ) > 0, )
+        yield (opentherm.encode_topic("flame_status_dhw"),
+               val & ( 1 << 2 ) > 0, )
+        yield (opentherm.encode_topic("flame_status_bit"),
+               val & ( 1 << 3 ) > 0, )
+
+def float_msg_generator(ot_id, val):
+    yield (opentherm.encode_topic(ot_id), round(val/float(256), 2), )
+
+def int_msg_generator(ot_id, val):
+    yield (opentherm.encode_topic(ot_id), val, )
+
+# The ids the bridge originally published, mapped to their names and the
+# generators that created their messages. `opentherm.opentherm_catalogue` has
+# all ids.
+opentherm_ids = {
+	0:   ("flame_status",flags_msg_generator,),
+	1:   ("control_setpoint",float_msg_generator,),
+	9:   ("remote_override_setpoint",float_msg_generator,),
+	14:  ("max_relative_modulation_level",float_msg_generator,),
+	16:  ("room_setpoint",float_msg_generator,),
+	17:  ("relative_modulation_level",float_msg_generator,),
+	18:  ("ch_water_pressure",float_msg_generator,),
+	24:  ("room_temperature",float_msg_generator,),
+	25:  ("boiler_water_temperature",float_msg_generator,),
+	26:  ("dhw_temperature",float_msg_generator,),
+	27:  ("outside_temperature",float_msg_generator,),
+	28:  ("return_water_temperature",float_msg_generator,),
+	56:  ("dhw_setpoint",float_msg_generator,),
+	57:  ("max_ch_water_setpoint",float_msg_generator,),
+	116: ("burner_starts",int_msg_generator,),
+	117: ("ch_pump_starts",int_msg_generator,),
+	118: ("dhw_pump_starts",int_msg_generator,),
+	119: ("dhw_burner_starts",int_msg_generator,),
+	120: ("burner_operation_hours",int_msg_generator,),
+	121: ("ch_pump_operation_hours",int_msg_generator,),
+	122: ("dhw_pump_valve_operation_hours",int_msg_generator,),
+	123: ("dhw_burner_operation_hours",int_msg_generator,)
+}
+
+def legacy_decode(line):
+    # The regex-based parsing get_messages used before decode_frame
+    info = opentherm.line_parser.match(line)
+    if info is None:
+        return None
+    (source, ttype, res, did, data) = \
+        map(lambda f, d: f(d),
+            (str, lambda _: opentherm.hex_int(_) & 7, opentherm.hex_int,
+             opentherm.hex_int, opentherm.hex_int),
+            info.groups())
+    return (source, ttype, did, data, )
+
+def as_published(messages):
+    # Encode the messages the way paho encodes topics and payloads
+    return [(topic if isinstance(topic, bytes) else topic.encode('utf-8'),
+             payload if isinstance(payload, bytes)
+             else str(payload).encode('ascii'))
+            for topic, payload in messages]
+
+def legacy_misreads(data_id, value):
+    # The legacy generators decode negative f8.8 values as positive ones
+    entry = opentherm_ids.get(data_id)
+    return entry is not None and entry[1] is float_msg_generator \
+        and value & 0x8000 != 0
+
+def load_trace(path):
+    with open(path) as f:
+        return [line.rstrip('\r\n') for line in f]
+
+def run(parse, lines):
+    for line in lines:
+        parse(line)
+
+def bench(name, parse, lines, repeat=5, number=20):
+    best = min(timeit.repeat(lambda: run(parse, lines),
+                             repeat=repeat, number=number))
+    rate = len(lines) * number / best
+    print("{:<12} {:>12.0f} lines/s".format(name, rate))
+    return rate
+
+def main(argv):
+    lines = load_trace(argv[1] if len(argv) > 1 else default_trace)
+    # Both decoders must agree before timing them
+    for line in lines:
+        frame = opentherm.decode_frame(line)
+        assert (frame and tuple(frame)) == legacy_decode(line), line
+    print("{} lines in trace".format(len(lines)))
+    before = bench("before", legacy_decode, lines)
+    after = bench("after", opentherm.decode_frame, lines)
+    print("speed-up     {:>12.2f}x".format(after / before))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,101 @@
+r"""
+Stress benchmark for QoS 1 acknowledgement handling in the paho client
+
+Publishes a large number of QoS 1 messages to a client with a fake socket,
+then acknowledges every message the client has sent, in random order, until
+all messages are published. Prints the time spent publishing and handling
+the acknowledgements.
+
+Usage: python benchmarks/bench_paho_inflight.py [messages] [max-inflight]
+"""
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import paho.mqtt.client as mqtt
+
+class FakeSocket(object):
+    r"""
+    Accepts everything the client sends and collects the mids of the QoS 1
+    PUBLISH packets in it
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self.mids = []
+
+    def send(self, data):
+        self._buffer += data
+        buf = self._buffer
+        pos = 0
+        while len(buf) - pos >= 2:
+            # Decode the remaining length
+            length = 0
+            mult = 1
+            i = pos + 1
+            while i < len(buf):
+                length += (buf[i] & 127) * mult
+                mult *= 128
+                i += 1
+                if not buf[i - 1] & 128:
+                    break
+            else:
+                break
+            if len(buf) - i < length:
+                break
+            if buf[pos] & 0xF6 == mqtt.PUBLISH | 2:
+                topic_length, = struct.unpack_from('!H', buf, i)
+                mid, = struct.unpack_from('!H', buf, i + 2 + topic_length)
+                self.mids.append(mid)
+            pos = i + length
+        del buf[:pos]
+        return len(data)
+
+    def close(self):
+        pass
+
+def ack(client, mid):
+    client._in_packet['command'] = mqtt.PUBACK
+    client._in_packet['remaining_length'] = 2
+    client._in_packet['packet'] = struct.pack('!H', mid)
+    client._packet_handle()
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    max_inflight = int(argv[2]) if len(argv) > 2 else 1000
+    random.seed(0)
+
+    client = mqtt.Client('bench')
+    client.max_inflight_messages_set(max_inflight)
+    sock = client._sock = FakeSocket()
+    client._state = mqtt.mqtt_cs_connected
+    published = []
+    client.on_publish = lambda client, userdata, mid: published.append(mid)
+
+    start = time.time()
+    for i in range(count):
+        client.publish('bench/{}'.format(i % 100), b'20.5', qos=1)
+    publish_time = time.time() - start
+
+    start = time.time()
+    while len(published) < count:
+        mids = sock.mids
+        sock.mids = []
+        if not mids:
+            raise RuntimeError("No messages in flight")
+        random.shuffle(mids)
+        for mid in mids:
+            ack(client, mid)
+    ack_time = time.time() - start
+
+    print("{} messages, max inflight {}".format(count, max_inflight))
+    print("publish      {:>8.3f} s {:>10.0f} msgs/s".format(
+        publish_time, count / publish_time))
+    print("acks         {:>8.3f} s {:>10.0f} acks/s".format(
+        ack_time, count / ack_time))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,72 @@
+r"""
+Benchmark creating the pub-messages for decoded frames
+
+Compares the legacy message generators in `bench_decoder`, followed by the
+payload encoding paho does for int, float and bool payloads, with the compiled
+`PublishTable`. Prints the frames per second and the number of memory blocks
+allocated for the messages of each frame.
+
+Usage: python benchmarks/bench_publish_table.py [trace-file]
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import opentherm
+from bench_decoder import as_published, default_trace, legacy_misreads, \
+    load_trace, opentherm_ids
+
+def generator_messages(data_id, value):
+    ot_id, generator = opentherm_ids[data_id]
+    return as_published(generator(ot_id, value))
+
+def load_frames(path):
+    frames = []
+    for line in load_trace(path):
+        frame = opentherm.decode_frame(line)
+        if frame is not None and frame.source in ('B', 'T', 'A') \
+            and frame.msg_type in (1,4) \
+            and frame.data_id in opentherm_ids:
+            frames.append((frame.data_id, frame.data_value))
+    return frames
+
+def blocks_per_frame(get_messages, frames):
+    # Keep the messages alive, so every block allocated for them is counted
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [get_messages(data_id, value) for data_id, value in frames]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff
+                 for stat in after.compare_to(before, 'filename'))
+    # Don't count the list holding the messages
+    return (blocks - 1) / float(len(kept))
+
+def bench(name, get_messages, frames, repeat=5, number=20):
+    def run():
+        for data_id, value in frames:
+            get_messages(data_id, value)
+    best = min(timeit.repeat(run, repeat=repeat, number=number))
+    print("{:<12} {:>12.0f} frames/s {:>8.2f} blocks/frame".format(
+        name, len(frames) * number / best,
+        blocks_per_frame(get_messages, frames)))
+
+def main(argv):
+    frames = load_frames(argv[1] if len(argv) > 1 else default_trace)
+    table = opentherm.PublishTable(opentherm.topic_namespace)
+    # The catalogue publishes more flags than the generators, so only the
+    # messages of the generators are compared
+    for data_id, value in frames:
+        if legacy_misreads(data_id, value):
+            continue
+        assert set(table.get_messages(data_id, value)).issuperset(
+            generator_messages(data_id, value))
+    print("{} frames in trace".format(len(frames)))
+    bench("generators", generator_messages, frames)
+    bench("table", table.get_messages, frames)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,91 @@
+r"""
+Benchmark the latency of serial reads
+
+Writes OTGW lines to a pseudo terminal at random intervals, reads them back
+through `OTGWSerialClient`, and prints a histogram of the time between
+writing a line and the client passing its message on to the listener. The
+select-based reads are compared with the timeout-based reads that are used
+when the serial device has no file descriptor.
+
+Requires pyserial and a POSIX system.
+
+Usage: python benchmarks/bench_serial_latency.py [lines]
+"""
+import os
+import random
+import sys
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from opentherm_serial import OTGWSerialClient
+
+# Upper bounds of the histogram buckets, in milliseconds
+buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+class PollingSerialClient(OTGWSerialClient):
+    r"""
+    Reads with the serial timeout, like on systems without file descriptors
+    """
+    def fileno(self):
+        return None
+
+def measure(client_type, count):
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    latencies = []
+    sent = []
+    done = threading.Event()
+
+    def listener(message):
+        latencies.append(time.time() - sent[len(latencies)])
+        if len(latencies) == count:
+            done.set()
+
+    client = client_type(listener, device=os.ttyname(slave))
+    client.start()
+    time.sleep(0.5)
+    random.seed(0)
+    try:
+        for i in range(count):
+            time.sleep(random.uniform(0.01, 0.2))
+            sent.append(time.time())
+            # Every line yields a single message
+            os.write(master, 'T1018{:04X}\r\n'.format(i % 0x1000).encode())
+        done.wait(5)
+    finally:
+        client.stop()
+        os.close(master)
+        os.close(slave)
+    return latencies
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+def report(name, latencies):
+    print("{}: {} lines, p50 {:.1f} ms, p99 {:.1f} ms".format(
+        name, len(latencies), percentile(latencies, 50) * 1000,
+        percentile(latencies, 99) * 1000))
+    counts = [0] * (len(buckets) + 1)
+    for latency in latencies:
+        ms = latency * 1000
+        index = 0
+        while index < len(buckets) and ms > buckets[index]:
+            index += 1
+        counts[index] += 1
+    for index, n in enumerate(counts):
+        label = "<= {} ms".format(buckets[index]) \
+            if index < len(buckets) else "> {} ms".format(buckets[-1])
+        print("  {:>12} {:>6} {}".format(
+            label, n, '#' * int(round(50. * n / len(latencies)))))
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100
+    report("select", measure(OTGWSerialClient, count))
+    report("timeout", measure(PollingSerialClient, count))
+
+if __name__ == '__main__':
+    main(sys.argv)
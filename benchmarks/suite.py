@@ -0,0 +1,310 @@
+r"""
+Benchmark suite for the bridge hot path
+
+Runs micro-benchmarks of the OTGW line parser and decoder, the framing loop
+of the OTGW worker, publishing, serialising and writing packets in the paho
+client and topic matching, and a macro-benchmark that streams synthetic
+frames from a fake OTGW transport through a paho client into a fake broker
+on a local socket, publishing directly and through the publish queue.
+
+For every benchmark, prints the operations (or messages) per second, the
+p50 and p99 latency in microseconds and the peak memory allocated while
+running it, as measured by tracemalloc, as JSON.
+
+Usage: python benchmarks/suite.py [--quick] [output-file]
+"""
+import json
+import os
+import platform
+import socket
+import struct
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import opentherm
+import pipeline
+import paho.mqtt.client as mqtt
+from paho.mqtt.matcher import MQTTMatcher
+from bench_decoder import default_trace, load_trace
+from bench_paho_inflight import FakeSocket
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+def latency_stats(latencies):
+    # Latencies in seconds to a dict of p50 and p99 in microseconds
+    return {
+        'p50_us': round(percentile(latencies, 50) * 1e6, 3),
+        'p99_us': round(percentile(latencies, 99) * 1e6, 3),
+    }
+
+def micro(func, items, number):
+    r"""
+    Benchmark calling func for every item
+
+    Returns a dict with the results
+    """
+    def run():
+        for item in items:
+            func(item)
+    best = min(timeit.repeat(run, repeat=3, number=number))
+    # Time each call separately for the latency
+    timer = timeit.default_timer
+    latencies = []
+    for item in items:
+        start = timer()
+        func(item)
+        latencies.append(timer() - start)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = {'ops_per_s': round(len(items) * number / best)}
+    result.update(latency_stats(latencies))
+    result['alloc_peak_bytes'] = peak
+    return result
+
+class NullTransport(opentherm.OTGWClient):
+    r"""
+    An OTGW client that is only used to pass data to `handle_data`
+    """
+    binary = True
+
+def connected_client():
+    # A paho client writing to a socket that discards all data
+    client = mqtt.Client('bench')
+    client._sock = FakeSocket()
+    client._state = mqtt.mqtt_cs_connected
+    return client
+
+def micro_benchmarks(quick):
+    number = 2 if quick else 10
+    lines = load_trace(default_trace)
+    byte_lines = [line.encode('ascii') for line in lines]
+    data = b''.join(line + b'\r\n' for line in byte_lines)
+    chunks = [data[i:i + 128] for i in range(0, len(data), 128)]
+    messages = [msg for line in byte_lines
+                for msg in opentherm.get_messages(line)]
+    results = {}
+
+    results['line_parser'] = micro(opentherm.line_parser.match, lines, number)
+    results['get_messages'] = micro(
+        lambda line: tuple(opentherm.get_messages(line)), byte_lines, number)
+
+    def frame(chunk, framer=opentherm.LineFramer(binary=True)):
+        framer.feed(chunk)
+    results['framing'] = micro(frame, chunks, number)
+
+    transport = NullTransport(lambda msg: None)
+    results['worker'] = micro(transport.handle_data, chunks, number)
+
+    client = connected_client()
+    results['publish'] = micro(
+        lambda msg: client.publish(msg[0], msg[1]), messages, number)
+    # _send_publish serialises the packet and queues it, which is measured
+    # in two parts
+    results['publish_packet'] = micro(
+        lambda msg: client._publish_packet(0, msg[0], msg[1], 0, False,
+                                           False),
+        messages, number)
+    # Keep _packet_queue from writing, to write the packets separately
+    packets = [(client._publish_packet(0, topic, payload, 0, False, False),
+                mqtt.MQTTMessageInfo(0))
+               for topic, payload in messages]
+    client._thread = threading.current_thread()
+    def queue_write(item):
+        client._packet_queue(mqtt.PUBLISH, item[0], 0, 0, item[1])
+        client._packet_write()
+    results['packet_write'] = micro(queue_write, packets, number)
+    client._thread = None
+
+    matcher = MQTTMatcher()
+    namespace = 'set/otgw'
+    for sub in ('#', 'room_setpoint/temporary', 'room_setpoint/constant',
+                'outside_temperature', 'hot_water/enable',
+                'hot_water/temperature', 'central_heating/enable'):
+        matcher['{}/{}'.format(namespace, sub)] = sub
+    matcher['$SYS/#'] = 'sys'
+    topics = ['{}/{}'.format(namespace, sub)
+              for sub in ('room_setpoint/temporary', 'outside_temperature',
+                          'hot_water/enable', 'unknown/topic')] + \
+        ['value/otgw/room_temperature', '$SYS/broker/uptime']
+    results['iter_match'] = micro(lambda topic: list(matcher.iter_match(topic)),
+                                  topics * 100, number)
+    return results
+
+class FakeBroker(object):
+    r"""
+    A broker on a local socket that accepts a single client and records the
+    time every PUBLISH packet arrives
+    """
+    def __init__(self):
+        self._server = socket.socket()
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(1)
+        self.port = self._server.getsockname()[1]
+        self.arrivals = []
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        conn, _ = self._server.accept()
+        buf = bytearray()
+        timer = timeit.default_timer
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                return
+            now = timer()
+            buf += data
+            pos = 0
+            while len(buf) - pos >= 2:
+                length = 0
+                mult = 1
+                i = pos + 1
+                while i < len(buf):
+                    length += (buf[i] & 127) * mult
+                    mult *= 128
+                    i += 1
+                    if not buf[i - 1] & 128:
+                        break
+                else:
+                    break
+                if len(buf) - i < length:
+                    break
+                command = buf[pos] & 0xF0
+                if command == mqtt.CONNECT:
+                    conn.sendall(b'\x20\x02\x00\x00')
+                elif command == mqtt.PUBLISH:
+                    topic_length, = struct.unpack_from('!H', buf, i)
+                    self.arrivals.append(
+                        (bytes(buf[i + 2:i + 2 + topic_length]),
+                         bytes(buf[i + 2 + topic_length:i + length]), now))
+                elif command == mqtt.PINGREQ:
+                    conn.sendall(b'\xd0\x00')
+                pos = i + length
+            del buf[:pos]
+
+class SyntheticTransport(opentherm.OTGWClient):
+    r"""
+    An OTGW transport that returns a stream of synthetic frames, with the
+    counters in ids 116 to 123, so every frame yields a unique message
+    """
+    binary = True
+
+    def __init__(self, listener, count, lines_per_read=20):
+        super(SyntheticTransport, self).__init__(listener)
+        self._lines = [('B40{:02X}{:04X}\r\n'.format(116 + seq % 8,
+                                                    seq // 8 % 0x10000)
+                        .encode('ascii')) for seq in range(count)]
+        self._lines_per_read = lines_per_read
+        self._pos = 0
+        self.sent = [None] * count
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, data):
+        pass
+
+    def read(self, timeout):
+        pos = self._pos
+        if pos >= len(self._lines):
+            time.sleep(timeout)
+            return b''
+        end = min(pos + self._lines_per_read, len(self._lines))
+        now = timeit.default_timer()
+        for seq in range(pos, end):
+            self.sent[seq] = now
+        self._pos = end
+        return b''.join(self._lines[pos:end])
+
+def macro(count, use_queue):
+    r"""
+    Stream count frames from a synthetic transport to a fake broker
+
+    Returns a dict with the results
+    """
+    broker = FakeBroker()
+    client = mqtt.Client('bench')
+    client.connect('127.0.0.1', broker.port)
+    client.loop_start()
+    queue = None
+    if use_queue:
+        queue = pipeline.PublishQueue(
+            lambda batch: client.publish_many(batch), maxsize=count,
+            policy='block')
+        queue.start()
+        listener = lambda msg: queue.put(msg[0], msg[1])
+    else:
+        listener = lambda msg: client.publish(msg[0], msg[1])
+    transport = SyntheticTransport(listener, count)
+    transport.start()
+    deadline = time.time() + 60
+    while len(broker.arrivals) < count and time.time() < deadline:
+        time.sleep(0.01)
+    transport.stop()
+    if queue:
+        queue.stop()
+    client.loop_stop()
+    client.disconnect()
+
+    # Match the messages to the frames they came from
+    seqs = {}
+    table = opentherm.publish_table
+    for seq in range(count):
+        topic, payload = table.get_messages(116 + seq % 8,
+                                            seq // 8 % 0x10000)[0]
+        seqs[(topic, payload)] = seq
+    latencies = [arrived - transport.sent[seqs[(topic, payload)]]
+                 for topic, payload, arrived in broker.arrivals]
+    elapsed = broker.arrivals[-1][2] - transport.sent[0]
+    result = {'msgs': len(broker.arrivals),
+              'msgs_per_s': round(len(broker.arrivals) / elapsed)}
+    result.update(latency_stats(latencies))
+    return result
+
+def macro_benchmarks(quick):
+    count = 5000 if quick else 50000
+    results = {}
+    for name, use_queue in (('macro_direct', False), ('macro_queue', True)):
+        results[name] = macro(count, use_queue)
+        # Run again with tracemalloc for the allocations, which slows
+        # everything down
+        tracemalloc.start()
+        macro(count // 5, use_queue)
+        results[name]['alloc_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return results
+
+def main(argv):
+    args = [arg for arg in argv[1:] if arg != '--quick']
+    quick = '--quick' in argv[1:]
+    results = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'benchmarks': {},
+    }
+    results['benchmarks'].update(micro_benchmarks(quick))
+    results['benchmarks'].update(macro_benchmarks(quick))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args:
+        with open(args[0], 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,254 @@
+r"""
+Lightweight metrics for the bridge, exposed in the Prometheus text format.
+
+Counters and histograms keep their values in lists that are allocated when
+the metric is created, so recording a value is a list update and never
+allocates or takes a lock. Each metric is meant to be updated from a single
+thread, like the OTGW reader thread. Concurrent updates from several threads
+may now and then lose an update, which is fine for monitoring. Gauges can
+also take a function, which is only called when the metrics are collected.
+
+`registry` holds the metrics of the bridge, `MetricsServer` serves them on
+`/metrics` over HTTP.
+"""
+from bisect import bisect_left
+import logging
+from threading import Thread
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+log = logging.getLogger(__name__)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class Counter(object):
+    r"""
+    A counter, or `size` counters for the values 0 to `size` - 1 of `label`
+
+    Only the counters with a value other than 0 are exposed when there is a
+    label.
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, label=None, size=1):
+        self.name = name
+        self.help = help
+        self._label = label
+        self._values = [0] * size
+
+    def inc(self, amount=1, index=0):
+        r"""
+        Add amount to the counter for index
+        """
+        self._values[index] += amount
+
+    def value(self, index=0):
+        r"""
+        Get the value of the counter for index
+        """
+        return self._values[index]
+
+    def collect(self):
+        r"""
+        Get the samples as (name, labels, value) tuples
+        """
+        if self._label is None:
+            return [(self.name, '', self._values[0], )]
+        return [(self.name, '{{{}="{}"}}'.format(self._label, index), value, )
+                for index, value in enumerate(self._values) if value]
+
+class Gauge(object):
+    r"""
+    A gauge, which is either set, or read from `func` when it is collected
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, func=None):
+        self.name = name
+        self.help = help
+        self._func = func
+        self._value = 0
+
+    def set(self, value):
+        r"""
+        Set the value of the gauge
+        """
+        self._value = value
+
+    def value(self):
+        r"""
+        Get the value of the gauge
+        """
+        if self._func is not None:
+            return self._func()
+        return self._value
+
+    def collect(self):
+        r"""
+        Get the samples as (name, labels, value) tuples
+        """
+        return [(self.name, '', self.value(), )]
+
+class Histogram(object):
+    r"""
+    A histogram of the observed values, with the upper bounds of the buckets
+    in `buckets`
+
+    Values that are larger than the last bound only count in the `+Inf`
+    bucket.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self._bounds = sorted(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0
+
+    def observe(self, value):
+        r"""
+        Count a value in its bucket
+        """
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self._sum += value
+
+    def collect(self):
+        r"""
+        Get the samples as (name, labels, value) tuples, with cumulative
+        bucket counts like Prometheus expects
+        """
+        samples = []
+        total = 0
+        for bound, count in zip(self._bounds + [float('inf')], self._counts):
+            total += count
+            samples.append(('{}_bucket'.format(self.name),
+                            '{{le="{}"}}'.format(_format_value(bound)),
+                            total, ))
+        samples.append(('{}_sum'.format(self.name), '', self._sum, ))
+        samples.append(('{}_count'.format(self.name), '', total, ))
+        return samples
+
+def exponential_buckets(start, factor, count):
+    r"""
+    Get count bucket bounds, starting at start and growing by factor
+    """
+    return [start * factor ** i for i in range(count)]
+
+class Registry(object):
+    r"""
+    A collection of metrics with unique names
+    """
+    def __init__(self):
+        self._metrics = []
+        self._names = set()
+
+    def register(self, metric):
+        r"""
+        Add a metric to the registry
+
+        Returns the metric
+        """
+        if metric.name in self._names:
+            raise ValueError("Duplicate metric: {}".format(metric.name))
+        self._names.add(metric.name)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label=None, size=1):
+        r"""
+        Create and register a `Counter`
+        """
+        return self.register(Counter(name, help, label, size))
+
+    def gauge(self, name, help, func=None):
+        r"""
+        Create and register a `Gauge`
+        """
+        return self.register(Gauge(name, help, func))
+
+    def histogram(self, name, help, buckets):
+        r"""
+        Create and register a `Histogram`
+        """
+        return self.register(Histogram(name, help, buckets))
+
+    def expose(self):
+        r"""
+        Get all metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            try:
+                samples = metric.collect()
+            except Exception as e:
+                log.warning("Collecting {} failed: {}".format(metric.name, e))
+                continue
+            for name, labels, value in samples:
+                lines.append('{}{} {}'.format(name, labels,
+                                              _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+# The metrics of the bridge
+registry = Registry()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+class MetricsServer(object):
+    r"""
+    Serve the metrics in a registry on `/metrics` over HTTP
+
+    Requests are handled one at a time on a background thread. The server
+    binds to localhost by default.
+    """
+    def __init__(self, registry=registry, port=9100,
+                 bind_address='127.0.0.1'):
+        self._server = HTTPServer((bind_address, port), _MetricsHandler)
+        self._server.registry = registry
+        self._thread = None
+        self.port = self._server.server_address[1]
+
+    def start(self):
+        r"""
+        Start serving the metrics
+        """
+        if self._thread:
+            raise RuntimeError("Already running")
+        self._thread = Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        r"""
+        Stop serving the metrics
+        """
+        if not self._thread:
+            raise RuntimeError("Not running")
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._thread = None
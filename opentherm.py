@@ -1,9 +1,25 @@
 import re
+from collections import namedtuple
 from threading import Lock, Thread
 import logging
+import select
+import time
+
+import metrics
 
 log = logging.getLogger(__name__)
 
+# Metrics of the frames read from all gateways
+frames_read = metrics.registry.counter(
+    'otgw_frames_read_total', "Lines read from the OTGW")
+frames_rejected = metrics.registry.counter(
+    'otgw_frames_rejected_total', "Lines that are not a valid frame")
+messages_by_id = metrics.registry.counter(
+    'otgw_messages_total', "Messages created, per OpenTherm data id",
+    label='data_id', size=256)
+listener_errors = metrics.registry.counter(
+    'otgw_listener_errors_total', "Exceptions raised by the listener")
+
 # Default namespace for the topics. Will be overwritten with the value in
 # config
 topic_namespace="value/otgw"
@@ -12,98 +28,497 @@ topic_namespace="value/otgw"
 def hex_int(hex):
     return int(hex, 16)
 
-# Pre-compile a regex to parse valid OTGW-messages
+# Pre-compile a regex to parse valid OTGW-messages. No longer used by
+# get_messages (see decode_frame), but kept for external users
 line_parser = re.compile(
     r'^(?P<source>[BART])(?P<type>[0-9A-F])(?P<res>[0-9A-F])'
     r'(?P<id>[0-9A-F]{2})(?P<data>[0-9A-F]{4})$'
 )
 
-
-def flags_msg_generator(ot_id, val):
+# A decoded OpenTherm frame
+Frame = namedtuple('Frame', ('source', 'msg_type', 'data_id', 'data_value'))
+
+# Lookup table for decode_frame. Maps the source character of a line, both as
+# a string and as bytes, to the source name and the valid hex digits of the
+# same type
+_frame_hex_digits = '0123456789ABCDEF'
+_frame_sources = {}
+for _source in 'BART':
+    _frame_sources[_source] = (_source, _frame_hex_digits)
+    _frame_sources[_source.encode('ascii')] = \
+        (_source, _frame_hex_digits.encode('ascii'))
+del _source
+
+def decode_frame(line):
     r"""
-    Generate the pub-messages from a boolean value.
+    Decode a single line read from the OTGW into a `Frame`
 
-    Currently, only flame status is supported. Any other items will be returned
-    as-is.
+    A valid line consists of a source character (B, A, R or T) followed by
+    the 32-bit OpenTherm frame as eight upper case hex digits. The frame is
+    parsed with a single `int` call and split into its fields with shifts and
+    masks. The line may be a string or bytes.
 
-    Returns a generator for the messages
+    Returns None if the line is not a valid OpenTherm frame
     """
-    yield ("{}/{}".format(topic_namespace, ot_id), val, )
-    if(ot_id == "flame_status"):
-        yield ("{}/flame_status_ch".format(topic_namespace),
-               val & ( 1 << 1 ) > 0, )
-        yield ("{}/flame_status_dhw".format(topic_namespace),
-               val & ( 1 << 2 ) > 0, )
-        yield ("{}/flame_status_bit".format(topic_namespace),
-               val & ( 1 << 3 ) > 0, )
-
-def float_msg_generator(ot_id, val):
+    if len(line) != 9:
+        return None
+    try:
+        source, hex_digits = _frame_sources[line[:1]]
+    except KeyError:
+        return None
+    digits = line[1:]
+    # strip() removes all characters in the set from both ends, so anything
+    # left over means there is a non-hex digit in the frame
+    if digits.strip(hex_digits):
+        return None
+    frame = int(digits, 16)
+    return Frame(source, (frame >> 28) & 7, (frame >> 16) & 0xFF,
+                 frame & 0xFFFF)
+
+def decode_raw_frame(line):
     r"""
-    Generate the pub-messages from a float-based value
+    Decode a single line read from the OTGW into its source and the 32-bit
+    frame, including the parity and spare bits that `decode_frame` drops
 
-    Returns a generator for the messages
+    Returns a tuple of the source and the frame, or None if the line is not a
+    valid OpenTherm frame
     """
-    yield ("{}/{}".format(topic_namespace, ot_id), round(val/float(256), 2), )
-
-def int_msg_generator(ot_id, val):
+    if len(line) != 9:
+        return None
+    try:
+        source, hex_digits = _frame_sources[line[:1]]
+    except KeyError:
+        return None
+    digits = line[1:]
+    if digits.strip(hex_digits):
+        return None
+    return (source, int(digits, 16), )
+
+# The responses of the OTGW to a command it did not execute
+command_errors = frozenset(('NG', 'SE', 'BV', 'OR', 'NS', 'NF', 'OE'))
+
+def is_response(line):
     r"""
-    Generate the pub-messages from an integer-based value
+    Check if a line read from the OTGW is the response to a command, either
+    the command code followed by a colon and the value, like `TT: 19.50`, or
+    a two letter error like those in `command_errors`
 
-    Returns a generator for the messages
+    The line may be a string or bytes.
     """
-    yield ("{}/{}".format(topic_namespace, ot_id), val, )
+    return len(line) == 2 or line[2:4] in (b': ', ': ')
+
+# Cache of encoded topics, keyed by namespace and name
+_topics = {}
 
-def get_messages(message):
+def encode_topic(name, namespace=None):
+    r"""
+    Get the encoded topic for `name` in `namespace`, which defaults to the
+    current topic namespace
+
+    The topic is encoded once and cached, so the messages can be passed on to
+    the MQTT client as bytes.
+    """
+    if namespace is None:
+        namespace = topic_namespace
+    key = (namespace, name)
+    topic = _topics.get(key)
+    if topic is None:
+        topic = _topics[key] = \
+            "{}/{}".format(namespace, name).encode('utf-8')
+    return topic
+
+def get_messages(message, table=None):
     r"""
     Generate the pub-messages from the supplied OT-message
 
-    Returns a generator for the messages
+    The message may be a string or bytes. The topics and payloads of the
+    generated messages are encoded as bytes, using the supplied publish table,
+    or the publish table for the current topic namespace if it is None.
+
+    Returns an iterable of the messages
     """
-    info = line_parser.match(message)
-    if info is None:
+    frame = decode_frame(message)
+    if frame is None:
         if message:
+            frames_rejected.inc()
             log.debug("Did not understand message: '{}'".format(message))
         return iter([])
-    (source, ttype, res, did, data) = \
-        map(lambda f, d: f(d),
-            (str, lambda _: hex_int(_) & 7, hex_int, hex_int, hex_int),
-            info.groups())
-    if source not in ('B', 'T', 'A') \
-        or ttype not in (1,4) \
-        or did not in opentherm_ids:
+    if frame.source not in ('B', 'T', 'A') \
+        or frame.msg_type not in (1,4):
         return iter([])
-    id_name, parser = opentherm_ids[did]
-    return parser(id_name, data)
-
-
-# Map the opentherm ids (named group 'id' in the line parser regex) to
-# discriptive names and message creators. I put this here because the
-# referenced generators have to be assigned first
-opentherm_ids = {
-	0:   ("flame_status",flags_msg_generator,),
-	1:   ("control_setpoint",float_msg_generator,),
-	9:   ("remote_override_setpoint",float_msg_generator,),
-	14:  ("max_relative_modulation_level",float_msg_generator,),
-	16:  ("room_setpoint",float_msg_generator,),
-	17:  ("relative_modulation_level",float_msg_generator,),
-	18:  ("ch_water_pressure",float_msg_generator,),
-	24:  ("room_temperature",float_msg_generator,),
-	25:  ("boiler_water_temperature",float_msg_generator,),
-	26:  ("dhw_temperature",float_msg_generator,),
-	27:  ("outside_temperature",float_msg_generator,),
-	28:  ("return_water_temperature",float_msg_generator,),
-	56:  ("dhw_setpoint",float_msg_generator,),
-	57:  ("max_ch_water_setpoint",float_msg_generator,),
-	116: ("burner_starts",int_msg_generator,),
-	117: ("ch_pump_starts",int_msg_generator,),
-	118: ("dhw_pump_starts",int_msg_generator,),
-	119: ("dhw_burner_starts",int_msg_generator,),
-	120: ("burner_operation_hours",int_msg_generator,),
-	121: ("ch_pump_operation_hours",int_msg_generator,),
-	122: ("dhw_pump_valve_operation_hours",int_msg_generator,),
-	123: ("dhw_burner_operation_hours",int_msg_generator,)
+    if table is None:
+        table = publish_table
+        if table.namespace != topic_namespace:
+            table = set_topic_namespace(topic_namespace)
+    messages = table.get_messages(frame.data_id, frame.data_value)
+    messages_by_id.inc(len(messages), frame.data_id)
+    return messages
+
+
+# The OpenTherm 2.2 data ids. Maps each id to its name, the format of its
+# value and, for values that consist of two bytes, the names of the high and
+# low byte. For flag8 bytes, the name is a tuple with the names of bits 0 to
+# 7, or None for unused bits.
+#
+# Formats:
+#   f8.8         signed fixed point number with 8 fractional bits
+#   u16, s16     unsigned and signed 16-bit integer
+#   u8/u8, s8/s8 two unsigned or signed 8-bit integers
+#   flag8/flag8  two bytes of flags, published as the whole value and per bit
+#   flag8/u8     a byte of flags, published per bit, and an 8-bit integer
+#   day_time     day of the week, hours and minutes
+opentherm_catalogue = {
+    0:   ("flame_status", "flag8/flag8",
+          (("ch_enable", "dhw_enable", "cooling_enable", "otc_active",
+            "ch2_enable", None, None, None),
+           ("fault_indication", "flame_status_ch", "flame_status_dhw",
+            "flame_status_bit", "cooling_status", "ch2_mode",
+            "diagnostic_indication", None))),
+    1:   ("control_setpoint", "f8.8"),
+    2:   ("master_configuration", "flag8/u8",
+          (("smart_power", None, None, None, None, None, None, None),
+           "master_memberid")),
+    3:   ("slave_configuration", "flag8/u8",
+          (("dhw_present", "control_type", "cooling_config", "dhw_config",
+            "master_low_off_pump_control", "ch2_present", None, None),
+           "slave_memberid")),
+    4:   ("command", "u8/u8", ("command_code", "command_response")),
+    5:   ("fault_flags", "flag8/u8",
+          (("service_request", "lockout_reset", "low_water_pressure",
+            "gas_flame_fault", "air_pressure_fault", "water_over_temperature",
+            None, None),
+           "oem_fault_code")),
+    6:   ("remote_parameter_flags", "flag8/flag8",
+          (("dhw_setpoint_transfer_enabled",
+            "max_ch_setpoint_transfer_enabled",
+            None, None, None, None, None, None),
+           ("dhw_setpoint_read_write", "max_ch_setpoint_read_write",
+            None, None, None, None, None, None))),
+    7:   ("cooling_control", "f8.8"),
+    8:   ("control_setpoint_ch2", "f8.8"),
+    9:   ("remote_override_setpoint", "f8.8"),
+    10:  ("tsp_count", "u8/u8", ("tsp_count", None)),
+    11:  ("tsp_entry", "u8/u8", ("tsp_index", "tsp_value")),
+    12:  ("fault_buffer_size", "u8/u8", ("fault_buffer_size", None)),
+    13:  ("fault_buffer_entry", "u8/u8",
+          ("fault_buffer_index", "fault_buffer_value")),
+    14:  ("max_relative_modulation_level", "f8.8"),
+    15:  ("boiler_capacity", "u8/u8",
+          ("max_boiler_capacity", "min_modulation_level")),
+    16:  ("room_setpoint", "f8.8"),
+    17:  ("relative_modulation_level", "f8.8"),
+    18:  ("ch_water_pressure", "f8.8"),
+    19:  ("dhw_flow_rate", "f8.8"),
+    20:  ("day_time", "day_time", ("day_of_week", "hours", "minutes")),
+    21:  ("date", "u8/u8", ("month", "day_of_month")),
+    22:  ("year", "u16"),
+    23:  ("room_setpoint_ch2", "f8.8"),
+    24:  ("room_temperature", "f8.8"),
+    25:  ("boiler_water_temperature", "f8.8"),
+    26:  ("dhw_temperature", "f8.8"),
+    27:  ("outside_temperature", "f8.8"),
+    28:  ("return_water_temperature", "f8.8"),
+    29:  ("solar_storage_temperature", "f8.8"),
+    30:  ("solar_collector_temperature", "f8.8"),
+    31:  ("flow_temperature_ch2", "f8.8"),
+    32:  ("dhw2_temperature", "f8.8"),
+    33:  ("exhaust_temperature", "s16"),
+    48:  ("dhw_setpoint_bounds", "s8/s8",
+          ("dhw_setpoint_upper_bound", "dhw_setpoint_lower_bound")),
+    49:  ("max_ch_setpoint_bounds", "s8/s8",
+          ("max_ch_setpoint_upper_bound", "max_ch_setpoint_lower_bound")),
+    50:  ("otc_ratio_bounds", "s8/s8",
+          ("otc_ratio_upper_bound", "otc_ratio_lower_bound")),
+    56:  ("dhw_setpoint", "f8.8"),
+    57:  ("max_ch_water_setpoint", "f8.8"),
+    58:  ("otc_heat_curve_ratio", "f8.8"),
+    100: ("remote_override_function", "flag8/flag8",
+          ((None, None, None, None, None, None, None, None),
+           ("manual_change_priority", "program_change_priority",
+            None, None, None, None, None, None))),
+    115: ("oem_diagnostic_code", "u16"),
+    116: ("burner_starts", "u16"),
+    117: ("ch_pump_starts", "u16"),
+    118: ("dhw_pump_starts", "u16"),
+    119: ("dhw_burner_starts", "u16"),
+    120: ("burner_operation_hours", "u16"),
+    121: ("ch_pump_operation_hours", "u16"),
+    122: ("dhw_pump_valve_operation_hours", "u16"),
+    123: ("dhw_burner_operation_hours", "u16"),
+    124: ("master_opentherm_version", "f8.8"),
+    125: ("slave_opentherm_version", "f8.8"),
+    126: ("master_product_version", "u8/u8",
+          ("master_product_type", "master_product_version")),
+    127: ("slave_product_version", "u8/u8",
+          ("slave_product_type", "slave_product_version")),
+}
+
+# Payloads for boolean values
+_bool_payloads = (b'False', b'True')
+
+# Payloads for 8-bit values, indexed by the unsigned and signed value
+_u8_payloads = tuple(b'%d' % val for val in range(256))
+_s8_payloads = tuple(b'%d' % (val - 256 if val & 0x80 else val)
+                     for val in range(256))
+
+def f88_payload(val):
+    r"""
+    Encode an f8.8 value as text with two decimals, the same way
+    `round(val / 256., 2)` rounds it, but using integer math only. Values with
+    the sign bit set are negative.
+    """
+    sign = b''
+    if val & 0x8000:
+        val = 0x10000 - val
+        sign = b'-'
+    # Round to hundredths, with ties to even like round() does
+    hundredths, rest = divmod(val * 100, 256)
+    if rest > 128 or (rest == 128 and hundredths & 1):
+        hundredths += 1
+    if not hundredths:
+        sign = b''
+    whole, frac = divmod(hundredths, 100)
+    if frac % 10:
+        return b'%s%d.%02d' % (sign, whole, frac)
+    return b'%s%d.%d' % (sign, whole, frac // 10)
+
+def _compile_f88(topic):
+    return lambda val: ((topic, f88_payload(val), ), )
+
+def _compile_u16(topic):
+    return lambda val: ((topic, b'%d' % val, ), )
+
+def _compile_s16(topic):
+    return lambda val: ((topic, b'%d' % (val - 0x10000 if val & 0x8000
+                                         else val), ), )
+
+def _bits_encoder(topics, shift):
+    # Get an encoder for the flags in the byte at shift. Unused bits are
+    # skipped, and None is returned if all bits are unused.
+    bits = tuple((1 << (bit + shift), topic)
+                 for bit, topic in enumerate(topics) if topic is not None)
+    if not bits:
+        return None
+    return lambda val: tuple((topic, _bool_payloads[val & mask != 0], )
+                             for mask, topic in bits)
+
+def _byte_encoder(topic, shift, payloads):
+    # Get an encoder for the 8-bit value in the byte at shift, or None if
+    # the byte is unused
+    if topic is None:
+        return None
+    return lambda val: ((topic, payloads[(val >> shift) & 0xFF], ), )
+
+def _join_encoders(hi, lo):
+    # Get an encoder for the messages of both bytes
+    if hi is None or lo is None:
+        return hi or lo
+    return lambda val: hi(val) + lo(val)
+
+def _compile_flag8_flag8(topic, hi_topics, lo_topics):
+    # The whole value is published first, for compatibility with the
+    # flame_status topic
+    bits = _join_encoders(_bits_encoder(hi_topics, 8),
+                          _bits_encoder(lo_topics, 0))
+    return lambda val: ((topic, b'%d' % val, ), ) + bits(val)
+
+def _compile_flag8_u8(topic, hi_topics, lo_topic):
+    return _join_encoders(_bits_encoder(hi_topics, 8),
+                          _byte_encoder(lo_topic, 0, _u8_payloads))
+
+def _compile_u8_u8(topic, hi_topic, lo_topic):
+    return _join_encoders(_byte_encoder(hi_topic, 8, _u8_payloads),
+                          _byte_encoder(lo_topic, 0, _u8_payloads))
+
+def _compile_s8_s8(topic, hi_topic, lo_topic):
+    return _join_encoders(_byte_encoder(hi_topic, 8, _s8_payloads),
+                          _byte_encoder(lo_topic, 0, _s8_payloads))
+
+def _compile_day_time(topic, day_topic, hours_topic, minutes_topic):
+    # The day of the week is in the top three bits of the high byte, the
+    # hours in the other five
+    return lambda val: ((day_topic, _u8_payloads[val >> 13], ),
+                        (hours_topic, _u8_payloads[(val >> 8) & 0x1F], ),
+                        (minutes_topic, _u8_payloads[val & 0xFF], ), )
+
+# Map the formats in the catalogue to functions that compile an encoder for
+# a single id. The functions are called with the encoded topic of the id,
+# followed by the encoded topics of its parts, if any.
+_format_compilers = {
+    "f8.8": _compile_f88,
+    "u16": _compile_u16,
+    "s16": _compile_s16,
+    "flag8/flag8": _compile_flag8_flag8,
+    "flag8/u8": _compile_flag8_u8,
+    "u8/u8": _compile_u8_u8,
+    "s8/s8": _compile_s8_s8,
+    "day_time": _compile_day_time,
 }
 
+def _encode_topics(names, namespace):
+    # Encode a name, or a nested tuple of names, to topics
+    if names is None:
+        return None
+    if isinstance(names, tuple):
+        return tuple(_encode_topics(name, namespace) for name in names)
+    return encode_topic(names, namespace)
+
+class PublishTable(object):
+    r"""
+    The pub-messages for all OpenTherm ids, compiled for a topic namespace.
+
+    For every id in `catalogue`, which defaults to `opentherm_catalogue`, the
+    topics are encoded once and a specialised payload encoder is compiled
+    for its format, so creating the messages for a frame only has to encode
+    the payload. The encoders are stored in a list of 256 entries, indexed
+    by data id.
+
+    `float_topics` holds the topics that have float payloads.
+    """
+    def __init__(self, namespace, catalogue=None):
+        self.namespace = namespace
+        self._encoders = [None] * 256
+        float_topics = set()
+        if catalogue is None:
+            catalogue = opentherm_catalogue
+        for data_id, entry in catalogue.items():
+            name, value_format = entry[:2]
+            topic = encode_topic(name, namespace)
+            parts = _encode_topics(entry[2], namespace) \
+                if len(entry) > 2 else ()
+            if value_format == "f8.8":
+                float_topics.add(topic)
+            self._encoders[data_id] = \
+                _format_compilers[value_format](topic, *parts)
+        self.float_topics = frozenset(float_topics)
+
+    def get_messages(self, data_id, value):
+        r"""
+        Get the pub-messages for a data id and value
+
+        Returns a tuple of (topic, payload) tuples
+        """
+        encoder = self._encoders[data_id]
+        if encoder is None:
+            return ()
+        return encoder(value)
+
+def set_topic_namespace(namespace):
+    r"""
+    Set the namespace of the topics and compile the publish table for it
+
+    Returns the new publish table
+    """
+    global topic_namespace, publish_table
+    topic_namespace = namespace
+    publish_table = PublishTable(namespace)
+    return publish_table
+
+# The publish table used by get_messages
+publish_table = PublishTable(topic_namespace)
+
+class LineFramer(object):
+    r"""
+    Split a stream of data read from the OTGW into lines.
+
+    Data is appended to a single reusable buffer. Line boundaries (any run of
+    carriage returns and/or line feeds) are located with `find`, and the
+    consumed part of the buffer is dropped once per `feed` call instead of
+    once per line. Empty lines are discarded. If `binary` is True, lines are
+    returned as bytes, otherwise they are decoded to strings.
+
+    If no line boundary is found within `max_line_length` bytes, the pending
+    data is thrown away, so garbage input cannot grow the buffer without limit.
+    """
+    def __init__(self, max_line_length=256, binary=False):
+        self._buffer = bytearray()
+        self._max_line_length = max_line_length
+        self._binary = binary
+
+    def feed(self, data):
+        r"""
+        Add a block of read data to the buffer
+
+        Returns a list with the complete lines that are available, without the
+        line terminators.
+        """
+        if not data:
+            return []
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.encode('ascii', 'ignore')
+        buf = self._buffer
+        buf += data
+        size = len(buf)
+        lines = []
+        start = 0
+        # Cache the positions of the next CR and LF, so each byte is
+        # searched at most once per terminator
+        cr = buf.find(b'\r')
+        lf = buf.find(b'\n')
+        while True:
+            if cr < 0 and lf < 0:
+                break
+            end = lf if cr < 0 or (0 <= lf < cr) else cr
+            if end > start:
+                if end - start > self._max_line_length:
+                    log.debug("Discarding line of {} bytes".format(
+                        end - start))
+                elif self._binary:
+                    lines.append(bytes(buf[start:end]))
+                else:
+                    lines.append(buf[start:end].decode('ascii', 'ignore'))
+            # Skip the terminator and any terminators that follow it
+            start = end + 1
+            while start < size and buf[start] in (0x0D, 0x0A):
+                start += 1
+            if 0 <= cr < start:
+                cr = buf.find(b'\r', start)
+            if 0 <= lf < start:
+                lf = buf.find(b'\n', start)
+        if start:
+            del buf[:start]
+        if len(buf) > self._max_line_length:
+            log.debug("Discarding {} bytes without line break".format(
+                len(buf)))
+            del buf[:]
+        return lines
+
+def dispatch_data(data, framer, listener, publish_table=None,
+                  recorder=None, tracer=None, command_queue=None):
+    r"""
+    Pass the messages in a block of data read from the OTGW on to listener
+
+    The data is split into lines by framer. Every line is passed to the
+    `record` method of recorder if it is given, and responses to commands
+    are passed to the `handle_response` method of command_queue instead of
+    being decoded. If tracer is given, every message is traced from the time
+    the data was read. Exceptions raised by the listener are logged.
+    """
+    if tracer is not None:
+        read_time = tracer.clock()
+    lines = framer.feed(data)
+    if lines:
+        frames_read.inc(len(lines))
+    for line in lines:
+        if recorder is not None:
+            recorder.record(line)
+        if command_queue is not None and is_response(line):
+            command_queue.handle_response(line)
+            continue
+        # Get all the messages for the line that has been read, most lines
+        # will yield no messages or just one, but flags-based lines may
+        # return more than one.
+        for msg in get_messages(line, publish_table):
+            try:
+                if tracer is not None:
+                    tracer.start(msg[0], read_time)
+                # Pass each message on to the listener
+                listener(msg)
+            except Exception as e:
+                # Log a warning when an exception occurs in the listener
+                listener_errors.inc()
+                log.warning(str(e))
+
 class OTGWClient(object):
     r"""
     An abstract OTGW client.
@@ -111,11 +526,32 @@ class OTGWClient(object):
     This class can be used to create implementations of OTGW clients for
     different types of communication protocols and technologies. To create a
     full implementation, only four methods need to be implemented.
+
+    Implementations that return bytes from `read` should set `binary` to True,
+    so the read data is passed on as bytes until it is published. To be
+    driven by an `OTGWSupervisor` without polling, implementations can
+    override `fileno`.
+
+    If `namespace` is given, the messages are published in that topic
+    namespace instead of the global one. If `recorder` is set, every line
+    read is passed to its `record` method. If `tracer` is set, every message
+    is traced from the time its data was read, see `tracing.Tracer`. If
+    `command_queue` is set, the responses to commands are passed to its
+    `handle_response` method.
     """
-    def __init__(self, listener, **kwargs):
+    binary = False
+
+    def __init__(self, listener, namespace=None, **kwargs):
         self._worker_running = False
         self._listener = listener
         self._worker_thread = None
+        self._framer = None
+        self.publish_table = None
+        self.recorder = None
+        self.tracer = None
+        self.command_queue = None
+        if namespace is not None:
+            self.publish_table = PublishTable(namespace)
 
     def open(self):
         r"""
@@ -153,13 +589,33 @@ class OTGWClient(object):
         Must be overridden in implementing classes. Called in a loop while the
         client is running. May return any block of data read from the
         connection, be it line by line or any other block size. Must return a
-        string. Line feeds and carriage returns should be passed on unchanged.
-        Should adhere to the timeout passed. If only part of a data block is
-        read before the timeout passes, return only the part that was read
-        successfully, even if it is an empty string.
+        string, or bytes if `binary` is True. Line feeds and carriage returns
+        should be passed on unchanged. Should adhere to the timeout passed. If
+        only part of a data block is read before the timeout passes, return
+        only the part that was read successfully, even if it is an empty
+        string.
         """
         raise NotImplementedError("Abstract method")
 
+    def fileno(self):
+        r"""
+        Get the file descriptor to wait on for data from the OTGW
+
+        May be overridden in implementing classes. Should return None while
+        there is no file descriptor, for example while connecting, in which
+        case `read` is polled instead.
+        """
+        return None
+
+    def handle_data(self, data):
+        r"""
+        Pass the messages in a block of read data on to the listener
+        """
+        if self._framer is None:
+            self._framer = LineFramer(binary=self.binary)
+        dispatch_data(data, self._framer, self._listener, self.publish_table,
+                      self.recorder, self.tracer, self.command_queue)
+
     def join(self):
         r"""
         Block until the worker thread finishes
@@ -191,41 +647,137 @@ class OTGWClient(object):
         # Open the connection to the OTGW
         self.open()
 
-        # Compile a regex that will only match the first part of a string, up
-        # to and including the first time a line break and/or carriage return
-        # occurs. Match any number of line breaks and/or carriage returns that
-        # immediately follow as well (effectively discarding empty lines)
-        line_splitter = re.compile(r'^.*[\r\n]+')
-
-        # Create a buffer for read data
-        data = ""
-
         while self._worker_running:
-            # Call the read method of the implementation
-            data += self.read(timeout=0.5)
-
-            # Find all the lines in the read data
-            while True:
-                m = line_splitter.match(data)
-                if not m:
-                    # There are no full lines yet, so we have to read some more
-                    break
-
-                # Get all the messages for the line that has been read,
-                # most lines will yield no messages or just one, but
-                # flags-based lines may return more than one.
-                for msg in get_messages(m.group().rstrip('\r\n')):
-                    try:
-                        # Pass each message on to the listener
-                        self._listener(msg)
-                    except Exception as e:
-                        # Log a warning when an exception occurs in the
-                        # listener
-                        log.warn(str(e))
-
-                # Strip the consumed line from the buffer
-                data = data[m.end():]
+            # Call the read method of the implementation and handle all the
+            # complete lines in the read data
+            self.handle_data(self.read(timeout=0.5))
 
         # After the read loop, close the connection and clean up
         self.close()
         self._worker_thread = None
+
+class OTGWSupervisor(object):
+    r"""
+    Read data from many OTGW clients in a single thread.
+
+    Instead of running a worker thread for each client, the supervisor waits
+    for data from all clients at once with `select`, using their `fileno`.
+    Clients without a file descriptor are polled with a zero timeout.
+    Clients that fail to open, or fail while reading, are closed and
+    reopened every `reopen_delay` seconds, so one broken gateway does not
+    stop the others.
+    """
+    def __init__(self, clients, reopen_delay=10):
+        self._clients = list(clients)
+        self._reopen_delay = reopen_delay
+        self._worker_running = False
+        self._worker_thread = None
+
+    def join(self):
+        r"""
+        Block until the worker thread finishes
+        """
+        self._worker_thread.join()
+
+    def start(self):
+        r"""
+        Connect to the OTGWs and start reading data
+        """
+        if self._worker_thread:
+            raise RuntimeError("Already running")
+        self._worker_thread = Thread(target=self._worker)
+        self._worker_thread.start()
+
+    def stop(self):
+        r"""
+        Stop reading data and disconnect from the OTGWs
+        """
+        if not self._worker_thread:
+            raise RuntimeError("Not running")
+        self._worker_running = False
+        self.join()
+
+    def _open(self, client):
+        # Open a client, returning False if that failed
+        try:
+            client.open()
+            return True
+        except Exception as e:
+            log.warning("Opening OTGW failed: {}".format(e))
+            return False
+
+    def _close(self, client):
+        # Close a client, logging any error
+        try:
+            client.close()
+        except Exception as e:
+            log.warning("Closing OTGW failed: {}".format(e))
+
+    def _read(self, client, timeout):
+        # Read from a client and handle the data, returning False if that
+        # failed
+        try:
+            client.handle_data(client.read(timeout=timeout))
+            return True
+        except Exception as e:
+            log.warning("Reading from OTGW failed: {}".format(e))
+            return False
+
+    def _worker(self):
+        self._worker_running = True
+
+        # Maps the clients that failed to the time to reopen them
+        closed = {}
+        opened = []
+        for client in self._clients:
+            if self._open(client):
+                opened.append(client)
+            else:
+                closed[client] = time.time() + self._reopen_delay
+
+        while self._worker_running:
+            now = time.time()
+            for client, retry in list(closed.items()):
+                if retry <= now:
+                    del closed[client]
+                    if self._open(client):
+                        opened.append(client)
+                    else:
+                        closed[client] = now + self._reopen_delay
+
+            # Wait for data from all clients that have a file descriptor
+            readers = {}
+            polled = []
+            for client in opened:
+                fd = client.fileno()
+                if fd is None:
+                    polled.append(client)
+                else:
+                    readers[fd] = client
+            timeout = 0.1 if polled else 0.5
+            if readers:
+                try:
+                    readable = select.select(list(readers), [], [],
+                                             timeout)[0]
+                except (select.error, ValueError, OSError) as e:
+                    # A descriptor was closed, try again on the next loop
+                    log.debug("Waiting for OTGW data failed: {}".format(e))
+                    readable = []
+            else:
+                time.sleep(timeout)
+                readable = []
+
+            failed = [client for client in
+                      [readers[fd] for fd in readable] + polled
+                      if not self._read(client, 0)]
+            # Reopen the clients that failed later, like the ones that
+            # failed to open, instead of reading from them again right away
+            for client in failed:
+                self._close(client)
+                opened.remove(client)
+                closed[client] = time.time() + self._reopen_delay
+
+        # After the read loop, close the connections and clean up
+        for client in opened:
+            self._close(client)
+        self._worker_thread = None
@@ -0,0 +1,267 @@
+r"""
+asyncio support for the OTGW MQTT bridge.
+
+`AsyncOTGWClient` reads from the OTGW with asyncio streams instead of a
+worker thread that polls `read`, and `AsyncioMQTTAdapter` drives a paho
+`Client` from the same event loop instead of from `loop_start`'s thread.
+"""
+import asyncio
+import logging
+
+from opentherm import LineFramer, PublishTable, dispatch_data
+
+log = logging.getLogger(__name__)
+
+class AsyncOTGWClient(object):
+    r"""
+    An abstract asyncio OTGW client.
+
+    To create a full implementation, only `open_connection` needs to be
+    implemented. `run` opens the connection and passes every message read
+    from the OTGW on to the listener, reconnecting with an exponential
+    backoff between `reconnect_min_delay` and `reconnect_max_delay` seconds
+    when the connection fails or is lost.
+
+    If `namespace` is given, the messages are published in that topic
+    namespace instead of the global one. If `recorder` is set, every line
+    read is passed to its `record` method. If `tracer` is set, every message
+    is traced from the time its data was read, see `tracing.Tracer`. If
+    `command_queue` is set, the responses to commands are passed to its
+    `handle_response` method.
+    """
+    def __init__(self, listener, namespace=None, **kwargs):
+        self._listener = listener
+        self._args = kwargs
+        self.publish_table = None
+        self.recorder = None
+        self.tracer = None
+        self.command_queue = None
+        if namespace is not None:
+            self.publish_table = PublishTable(namespace)
+        self._writer = None
+        self._task = None
+
+    async def open_connection(self):
+        r"""
+        Open the connection to the OTGW
+
+        Must be overridden in implementing classes. Returns a tuple of an
+        asyncio StreamReader and StreamWriter.
+        """
+        raise NotImplementedError("Abstract method")
+
+    def write(self, data):
+        r"""
+        Write data to the OTGW
+
+        The data is buffered by the stream and sent by the event loop, so this
+        never blocks. Line feeds and carriage returns are added as needed.
+        """
+        if self._writer is None:
+            log.warning("Not connected, dropping command: {}".format(
+                data.rstrip('\r\n')))
+            return
+        self._writer.write("{}\r\n".format(data.rstrip('\r\n'))
+                           .encode('ascii', 'ignore'))
+
+    def start(self):
+        r"""
+        Start reading data in a task on the running event loop
+        """
+        if self._task:
+            raise RuntimeError("Already running")
+        self._task = asyncio.ensure_future(self.run())
+        return self._task
+
+    def stop(self):
+        r"""
+        Stop reading data and disconnect from the OTGW
+        """
+        if not self._task:
+            raise RuntimeError("Not running")
+        self._task.cancel()
+        self._task = None
+
+    async def run(self):
+        r"""
+        Read data from the OTGW until cancelled
+        """
+        delay = None
+        while True:
+            try:
+                reader, self._writer = await self.open_connection()
+            except (OSError, asyncio.TimeoutError) as e:
+                if delay is None:
+                    delay = self._args.get('reconnect_min_delay', 1)
+                else:
+                    delay = min(delay * 2,
+                                self._args.get('reconnect_max_delay', 60))
+                log.warning("Connecting to OTGW failed ({}), retrying in "
+                            "{}s".format(e, delay))
+                await asyncio.sleep(delay)
+                continue
+            delay = None
+            log.info("Connected to OTGW")
+            try:
+                await self._read_messages(reader)
+            except OSError as e:
+                log.warning("Connection to the OTGW failed: {}".format(e))
+            finally:
+                self._writer.close()
+                self._writer = None
+            await asyncio.sleep(self._args.get('reconnect_min_delay', 1))
+
+    async def _read_messages(self, reader):
+        framer = LineFramer(binary=True)
+        while True:
+            data = await reader.read(self._args.get('read_size', 4096))
+            if not data:
+                log.warning("Connection closed by the OTGW")
+                return
+            dispatch_data(data, framer, self._listener, self.publish_table,
+                          self.recorder, self.tracer, self.command_queue)
+
+class AsyncOTGWTcpClient(AsyncOTGWClient):
+    r"""
+    A TCP-based AsyncOTGWClient implementation
+    """
+    async def open_connection(self):
+        return await asyncio.wait_for(
+            asyncio.open_connection(self._args.get('host', 'localhost'),
+                                    self._args.get('port', 25238)),
+            self._args.get('connect_timeout', 10))
+
+class AsyncOTGWSerialClient(AsyncOTGWClient):
+    r"""
+    A serial-based AsyncOTGWClient implementation
+
+    Requires the pyserial-asyncio package.
+    """
+    async def open_connection(self):
+        import serial_asyncio
+        return await serial_asyncio.open_serial_connection(
+            url=self._args['device'],
+            baudrate=self._args.get('baudrate', 9600))
+
+class AsyncioMQTTAdapter(object):
+    r"""
+    Drive a paho MQTT client from an asyncio event loop.
+
+    Instead of running a network thread with `loop_start`, the client's
+    socket is registered with the event loop, which calls `loop_read` when
+    the socket is readable, `loop_write` when the client wants to write, and
+    `loop_misc` once a second. Lost connections are reopened with the
+    client's reconnect delay settings. The client must be set up with
+    `connect_async` before calling `start`.
+    """
+    def __init__(self, client, loop=None):
+        self._client = client
+        self._loop = loop or asyncio.get_event_loop()
+        self._sock = None
+        self._fd = None
+        self._writing = False
+        self._task = None
+
+    def start(self):
+        r"""
+        Connect and start processing network events
+        """
+        if self._task:
+            raise RuntimeError("Already running")
+        self._task = asyncio.ensure_future(self._run())
+        # publish() calls from callbacks and other threads write a byte to
+        # this socket when they queue a packet
+        self._loop.add_reader(self._client._sockpairR, self._on_wakeup)
+        return self._task
+
+    def stop(self):
+        r"""
+        Stop processing network events and disconnect
+        """
+        if not self._task:
+            raise RuntimeError("Not running")
+        self._task.cancel()
+        self._task = None
+        self._loop.remove_reader(self._client._sockpairR)
+        self._client.disconnect()
+        self._update_writer()
+        self._unregister()
+
+    async def _run(self):
+        client = self._client
+        delay = None
+        while True:
+            if self._sock is None:
+                try:
+                    # Connecting blocks, so do it outside the event loop
+                    await self._loop.run_in_executor(None, client.reconnect)
+                except OSError as e:
+                    if delay is None:
+                        delay = client._reconnect_min_delay
+                    else:
+                        delay = min(delay * 2, client._reconnect_max_delay)
+                    log.warning("Connecting to MQTT broker failed ({}), "
+                                "retrying in {}s".format(e, delay))
+                    await asyncio.sleep(delay)
+                    continue
+                delay = None
+                self._register()
+            await asyncio.sleep(1)
+            if self._sock is not None:
+                client.loop_misc()
+                self._check_socket()
+
+    def _register(self):
+        # Register the file descriptor rather than the socket, so it can
+        # still be unregistered after the client closed the socket
+        self._sock = self._client.socket()
+        self._fd = self._sock.fileno()
+        self._loop.add_reader(self._fd, self._on_readable)
+        self._update_writer()
+
+    def _unregister(self):
+        if self._sock is not None:
+            self._loop.remove_reader(self._fd)
+            if self._writing:
+                self._loop.remove_writer(self._fd)
+                self._writing = False
+            self._sock = None
+            self._fd = None
+
+    def _check_socket(self):
+        # Stop watching the socket when the client closed it
+        if self._client.socket() is not self._sock:
+            self._unregister()
+        else:
+            self._update_writer()
+
+    def _update_writer(self):
+        # Only wait for the socket to become writable when there is data to
+        # write
+        if self._sock is None:
+            return
+        want_write = self._client.want_write()
+        if want_write and not self._writing:
+            self._loop.add_writer(self._fd, self._on_writable)
+        elif not want_write and self._writing:
+            self._loop.remove_writer(self._fd)
+        self._writing = want_write
+
+    def _on_readable(self):
+        self._client.loop_read()
+        # SSL sockets may have data buffered that select() does not see
+        sock = self._client.socket()
+        if sock is not None and hasattr(sock, 'pending') and sock.pending():
+            self._loop.call_soon(self._on_readable)
+        self._check_socket()
+
+    def _on_writable(self):
+        self._client.loop_write()
+        self._check_socket()
+
+    def _on_wakeup(self):
+        try:
+            self._client._sockpairR.recv(4096)
+        except OSError:
+            pass
+        self._check_socket()
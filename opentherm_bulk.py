@@ -0,0 +1,250 @@
+r"""
+Bulk decoding of recorded OTGW logs.
+
+`decode_log` memory-maps a log file and decodes all frames in it at once
+with NumPy, returning the fields of the frames as columns. NumPy is an
+optional dependency, `decode_log_scalar` gives the same results with plain
+Python, one line at a time.
+
+A log line is a frame as sent by the OTGW, for example `B401801E6`,
+optionally preceded by a timestamp and whitespace. Timestamps are either
+seconds (`1514764800.25`) or a time of day (`12:30:01.250000`), which is
+converted to seconds since midnight. Lines are separated by any run of
+carriage returns and/or line feeds, like `LineFramer` does. Lines that do
+not end in a valid frame are skipped.
+"""
+from collections import namedtuple
+import mmap
+import re
+
+import opentherm
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The columns of decoded frames. `timestamp` is NaN for lines without a
+# (valid) timestamp, `source` holds the source characters as bytes.
+FrameColumns = namedtuple('FrameColumns', ('timestamp', 'source', 'msg_type',
+                                           'data_id', 'data_value'))
+
+# Timestamps longer than this, including blanks, are not parsed
+max_timestamp_length = 32
+
+_timestamp_parser = re.compile(
+    r'^(?:(?P<seconds>[0-9][0-9.]*)'
+    r'|(?P<h>[0-9]{2}):(?P<m>[0-9]{2}):(?P<s>[0-9]{2}(?:\.[0-9]*)?))$')
+
+def parse_timestamp(text):
+    r"""
+    Parse the timestamp in front of a frame
+
+    Returns the timestamp in seconds, or NaN if it is not valid
+    """
+    if len(text) > max_timestamp_length:
+        return float('nan')
+    text = text.strip(' \t')
+    info = _timestamp_parser.match(text)
+    if info is None or (info.group('seconds') or '').count('.') > 1:
+        return float('nan')
+    if info.group('seconds'):
+        return float(info.group('seconds'))
+    return int(info.group('h')) * 3600 + int(info.group('m')) * 60 + \
+        float(info.group('s'))
+
+def decode_log_scalar(path):
+    r"""
+    Decode all frames in a log file, one line at a time
+
+    Returns a `FrameColumns` of lists
+    """
+    columns = FrameColumns([], [], [], [], [])
+    with open(path, 'rb') as f:
+        data = f.read()
+    for line in re.split(b'[\r\n]+', data):
+        frame = opentherm.decode_frame(line[-9:])
+        if frame is None:
+            continue
+        if len(line) > 9:
+            if line[-10:-9] not in (b' ', b'\t'):
+                continue
+            timestamp = parse_timestamp(line[:-10].decode('latin-1'))
+        else:
+            timestamp = float('nan')
+        columns.timestamp.append(timestamp)
+        columns.source.append(frame.source.encode('ascii'))
+        columns.msg_type.append(frame.msg_type)
+        columns.data_id.append(frame.data_id)
+        columns.data_value.append(frame.data_value)
+    return columns
+
+def decode_log(path, chunk_size=1 << 26):
+    r"""
+    Decode all frames in a log file with NumPy
+
+    The file is memory-mapped and decoded in chunks of about `chunk_size`
+    bytes, split at line boundaries, so memory use does not grow with the
+    size of the log.
+
+    Returns a `FrameColumns` of NumPy arrays
+    """
+    if np is None:
+        raise ImportError("decode_log requires NumPy, use decode_log_scalar "
+                          "instead")
+    with open(path, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return _decode_chunk(np.zeros(0, np.uint8))
+    try:
+        buf = np.frombuffer(mapped, np.uint8)
+        chunks = []
+        pos = 0
+        while pos < len(buf):
+            end = min(pos + chunk_size, len(buf))
+            if end < len(buf):
+                # Cut the chunk after its last line terminator
+                terms = np.flatnonzero(_is_terminator(buf[pos:end]))
+                if len(terms):
+                    end = pos + terms[-1] + 1
+                else:
+                    end = _next_terminator(buf, end)
+            chunks.append(_decode_chunk(buf[pos:end]))
+            pos = end
+        del buf
+        if not chunks:
+            return _decode_chunk(np.zeros(0, np.uint8))
+        return FrameColumns(*(np.concatenate(column)
+                              for column in zip(*chunks)))
+    finally:
+        mapped.close()
+
+def _is_terminator(buf):
+    return (buf == 0x0D) | (buf == 0x0A)
+
+def _next_terminator(buf, pos):
+    # Find the first line terminator at or after pos, for lines that are
+    # longer than a chunk
+    while pos < len(buf):
+        terms = np.flatnonzero(_is_terminator(buf[pos:pos + (1 << 20)]))
+        if len(terms):
+            return pos + terms[0] + 1
+        pos += 1 << 20
+    return len(buf)
+
+# Lookup tables for the characters of a frame, indexed by byte value
+if np is not None:
+    _hex_values = np.full(256, -1, np.int16)
+    for _digit in '0123456789ABCDEF':
+        _hex_values[ord(_digit)] = int(_digit, 16)
+    _is_source = np.zeros(256, bool)
+    for _source in 'BART':
+        _is_source[ord(_source)] = True
+    _is_digit = np.zeros(256, bool)
+    _is_digit[ord('0'):ord('9') + 1] = True
+    _is_blank = np.zeros(256, bool)
+    _is_blank[[ord(' '), ord('\t')]] = True
+    del _digit, _source
+
+def _windows(buf, width):
+    # Get a read-only view of all runs of width bytes in buf
+    return np.lib.stride_tricks.as_strided(
+        buf, (max(0, len(buf) - width + 1), width),
+        (buf.strides[0], buf.strides[0]), writeable=False)
+
+def _decode_chunk(buf):
+    # Find the lines in the chunk
+    terms = np.flatnonzero(_is_terminator(buf))
+    starts = np.concatenate(([0], terms + 1))
+    ends = np.concatenate((terms, [len(buf)]))
+
+    # Every line that is long enough should end in a frame
+    lengths = ends - starts
+    long_enough = lengths >= 9
+    starts = starts[long_enough]
+    ends = ends[long_enough]
+    lengths = lengths[long_enough]
+    # Taking rows from a sliding window view copies each frame at once
+    chars = _windows(buf, 9)[ends - 9]
+    digits = _hex_values[chars[:, 1:]]
+    valid = _is_source[chars[:, 0]] & (digits >= 0).all(axis=1)
+    # Anything in front of the frame has to be separated by a blank
+    has_prefix = lengths > 9
+    valid[has_prefix] &= _is_blank[buf[ends[has_prefix] - 10]]
+
+    chars = chars[valid]
+    digits = digits[valid].astype(np.uint32)
+    starts = starts[valid]
+    ends = ends[valid]
+    frames = np.zeros(len(digits), np.uint32)
+    for digit in range(8):
+        frames = (frames << 4) | digits[:, digit]
+
+    return FrameColumns(
+        _decode_timestamps(buf, starts, ends - 10),
+        chars[:, 0].copy().view('S1'),
+        ((frames >> 28) & 7).astype(np.uint8),
+        ((frames >> 16) & 0xFF).astype(np.uint8),
+        (frames & 0xFFFF).astype(np.uint16))
+
+def _decode_timestamps(buf, starts, ends):
+    # Parse the text from starts to ends (exclusive) of every line into a
+    # timestamp, the same way parse_timestamp does
+    timestamps = np.full(len(starts), np.nan)
+    lengths = ends - starts
+    candidates = np.flatnonzero((lengths > 0)
+                                & (lengths <= max_timestamp_length))
+    if not len(candidates):
+        return timestamps
+    starts = starts[candidates]
+    lengths = lengths[candidates][:, None]
+    # Only work on as many columns as the longest text needs, but at least
+    # enough to check for a time of day
+    width = max(9, int(lengths.max()))
+    # Gather the text into a fixed-width array padded with blanks. The
+    # buffer is padded, so every row can be taken from the window view.
+    padded = np.concatenate((buf[starts[0]:starts[-1] + width],
+                             np.full(width, ord(' '), np.uint8)))
+    text = _windows(padded, width)[starts - starts[0]]
+    columns = np.arange(width)
+    text[columns >= lengths] = ord(' ')
+    # Strip the blanks, moving the text to the left and padding it with
+    # NULs. Leading blanks are rare, so the rows are moved per offset.
+    blank = _is_blank[text]
+    nonblank = ~blank.all(axis=1)
+    first = np.argmax(~blank, axis=1)
+    length = width - np.argmax(~blank[:, ::-1], axis=1) - first
+    for offset in np.unique(first[nonblank & (first > 0)]):
+        rows = np.flatnonzero(first == offset)
+        text[rows, :width - offset] = text[rows, offset:]
+    inside = columns < length[:, None]
+    text[~inside] = 0
+
+    digit = _is_digit[text]
+    dot = text == ord('.')
+    # Seconds: a digit followed by digits and at most one dot
+    seconds = nonblank & digit[:, 0] & ((digit | dot) == inside).all(axis=1) \
+        & (np.count_nonzero(dot, axis=1) <= 1)
+    # Time of day: two digits, a colon, two digits, a colon, two digits and
+    # optionally a dot followed by digits
+    clock = nonblank & (length >= 8) & (text[:, 2] == ord(':')) \
+        & (text[:, 5] == ord(':')) \
+        & digit[:, [0, 1, 3, 4, 6, 7]].all(axis=1) \
+        & ((length == 8) | dot[:, 8]) \
+        & (digit[:, 9:] == inside[:, 9:]).all(axis=1)
+
+    # The NUL padding is dropped when the rows are viewed as strings
+    if seconds.any():
+        strings = text[seconds].view('S{}'.format(width)).ravel()
+        timestamps[candidates[seconds]] = strings.astype(np.float64)
+    if clock.any():
+        fields = text[clock].astype(np.float64) - ord('0')
+        strings = text[clock][:, 6:].copy().view(
+            'S{}'.format(width - 6)).ravel()
+        timestamps[candidates[clock]] = \
+            (fields[:, 0] * 10 + fields[:, 1]) * 3600 + \
+            (fields[:, 3] * 10 + fields[:, 4]) * 60 + \
+            strings.astype(np.float64)
+    return timestamps
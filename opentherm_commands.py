@@ -0,0 +1,419 @@
+r"""
+The commands the OTGW accepts, and routing of MQTT messages to them.
+
+`commands` maps topics, relative to a gateway's subscription namespace, to
+the two letter OTGW command and a parser that validates the payload and
+converts it to the value the OTGW expects. A parser raises ValueError for
+a payload that is not valid, in which case nothing is sent to the OTGW.
+
+`CommandRouter` registers a callback for every command topic of a gateway
+with the MQTT client's `message_callback_add`, so the commands are looked up
+by paho's topic matcher instead of for every message.
+
+`CommandQueue` sends the commands to a gateway one at a time from its own
+thread, and matches them with the responses of the gateway.
+"""
+from collections import OrderedDict
+import logging
+import re
+from threading import Condition, Thread
+import time
+
+import metrics
+from opentherm import command_errors
+
+log = logging.getLogger(__name__)
+
+try:
+    # Use monotonic clock if available
+    time_func = time.monotonic
+except AttributeError:
+    time_func = time.time
+
+# Metrics of the commands sent to all gateways
+command_seconds = metrics.registry.histogram(
+    'otgw_command_seconds',
+    "Time from queueing a command to the response of the OTGW",
+    metrics.exponential_buckets(0.01, 2, 10))
+commands_coalesced = metrics.registry.counter(
+    'otgw_commands_coalesced_total',
+    "Commands replaced by a newer command before they were sent")
+
+# Values used to parse boolean values of incoming messages
+true_values = ('True', 'true', '1', 'y', 'yes')
+false_values = ('False', 'false', '0', 'n', 'no')
+
+def temperature(low, high, default=None):
+    r"""
+    Parse a temperature in degrees Celsius between low and high
+
+    If default is given, it is used for payloads that are not a number, like
+    an empty payload.
+    """
+    def parse(payload):
+        try:
+            value = float(payload)
+        except ValueError:
+            if default is None:
+                raise
+            value = default
+        if not low <= value <= high:
+            raise ValueError("{} is not between {} and {}".format(
+                value, low, high))
+        return "{:.2f}".format(value)
+    return parse
+
+def integer(low, high):
+    r"""
+    Parse a whole number between low and high
+    """
+    def parse(payload):
+        value = int(payload)
+        if not low <= value <= high:
+            raise ValueError("{} is not between {} and {}".format(
+                value, low, high))
+        return str(value)
+    return parse
+
+def choice(*values, **aliases):
+    r"""
+    Parse one of values, or one of the keywords of aliases, which are
+    replaced by their value
+
+    Boolean payloads are accepted as the aliases `true` and `false`. If the
+    alias `default` is given, any other payload is replaced by its value.
+    """
+    default = aliases.pop('default', None)
+    def parse(payload):
+        if payload in values:
+            return payload
+        if payload in true_values and 'true' in aliases:
+            return aliases['true']
+        if payload in false_values and 'false' in aliases:
+            return aliases['false']
+        if payload in aliases:
+            return aliases[payload]
+        if default is not None:
+            return default
+        raise ValueError("{} is not one of {}".format(
+            payload, ', '.join(values + tuple(aliases))))
+    return parse
+
+def pattern(regex, description):
+    r"""
+    Parse a value that matches regex
+    """
+    compiled = re.compile(r'(?:{})\Z'.format(regex))
+    def parse(payload):
+        if not compiled.match(payload):
+            raise ValueError("{} is not {}".format(payload, description))
+        return payload
+    return parse
+
+# Parse an on/off value
+boolean = choice('0', '1', true='1', false='0')
+
+# Parse an OpenTherm data id
+data_id = integer(0, 255)
+
+# The functions that can be assigned to the LEDs and GPIO pins
+led_function = choice(*'RXTBOFHWCEMP')
+gpio_function = choice(*'01234567')
+
+# The commands for the topics in a gateway's subscription namespace, as
+# topic: (command, parser). The defaults of the topics the bridge has always
+# had keep their old meaning: an empty or other non-numeric payload cancels
+# the setpoint override (TT, TC), clears the outside temperature (OT) or
+# sets the hot water setpoint to 60 (SW), an unknown hot water payload
+# selects thermostat control (HW) and central heating is enabled for
+# anything but a false value (CH).
+commands = {
+    # Thermostat
+    "room_setpoint/temporary":   ("TT", temperature(0, 30, default=0)),
+    "room_setpoint/constant":    ("TC", temperature(0, 30, default=0)),
+    "room_setpoint/setback":     ("SB", temperature(0, 30)),
+    "outside_temperature":       ("OT", temperature(-40, 99, default=99)),
+    "clock":                     ("SC", pattern(
+        r'([01][0-9]|2[0-3]):[0-5][0-9]/[1-7]', "a time like HH:MM/D")),
+    # Boiler
+    "hot_water/enable":          ("HW", choice('0', '1', 'P', 'T',
+                                               true='1', false='0',
+                                               default='T')),
+    "hot_water/temperature":     ("SW", temperature(0, 100, default=60)),
+    "central_heating/enable":    ("CH", choice('0', '1', true='1',
+                                               false='0', default='1')),
+    "central_heating/max_setpoint": ("SH", temperature(0, 100)),
+    "central_heating/control_setpoint": ("CS", temperature(0, 100)),
+    "central_heating_2/enable":  ("H2", boolean),
+    "central_heating_2/control_setpoint": ("C2", temperature(0, 100)),
+    "max_modulation":            ("MM", integer(0, 100)),
+    "ventilation_setpoint":      ("VS", integer(0, 100)),
+    "reset_counter":             ("RS", choice(
+        'HBS', 'HBH', 'HPS', 'HPH', 'WBS', 'WBH', 'WPS', 'WPH')),
+    # Gateway
+    "gateway/mode":              ("GW", choice('0', '1', 'R',
+                                               true='1', false='0')),
+    "gateway/print_summary":     ("PS", boolean),
+    "gateway/report":            ("PR", choice(*'ABCGILMOPQRSTVW')),
+    "gateway/thermostat_model":  ("FT", choice('D', 'I')),
+    "gateway/reference_voltage": ("VR", integer(0, 9)),
+    "gateway/ignore_transitions": ("IT", boolean),
+    "gateway/override_high_byte": ("OH", boolean),
+    "gateway/led/a":             ("LA", led_function),
+    "gateway/led/b":             ("LB", led_function),
+    "gateway/led/c":             ("LC", led_function),
+    "gateway/led/d":             ("LD", led_function),
+    "gateway/led/e":             ("LE", led_function),
+    "gateway/led/f":             ("LF", led_function),
+    "gateway/gpio/a":            ("GA", gpio_function),
+    "gateway/gpio/b":            ("GB", gpio_function),
+    # Message handling
+    "gateway/alternative/add":   ("AA", integer(1, 255)),
+    "gateway/alternative/delete": ("DA", integer(1, 255)),
+    "gateway/unknown_id":        ("UI", integer(1, 255)),
+    "gateway/known_id":          ("KI", integer(1, 255)),
+    "gateway/priority_message":  ("PM", data_id),
+    "gateway/response/set":      ("SR", pattern(
+        r'[0-9]{1,3}:[0-9]{1,3}(,[0-9]{1,3})?', "like ID:HB or ID:HB,LB")),
+    "gateway/response/clear":    ("CR", integer(1, 255)),
+}
+
+# Commands with any other code can be sent on raw/<code>. The value is
+# passed on as is, but may not contain line breaks.
+raw_command = pattern(r'[\x20-\x7e]*', "printable text")
+raw_code = re.compile(r'[A-Z][A-Z0-9]\Z')
+
+def encode_command(code, parser, payload):
+    r"""
+    Get the command to send to the OTGW for a payload
+
+    Raises ValueError if the payload is not valid for the command
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode('ascii', 'ignore')
+    return "{}={}".format(code, parser(payload.strip()))
+
+class CommandRouter(object):
+    r"""
+    Route the messages on the command topics of gateways to the gateways
+
+    `add` registers a callback for every topic in `commands`, and for
+    `raw/+`, below the subscription namespace of a gateway, which validates
+    the payload and writes the command to the gateway.
+    """
+    def __init__(self, mqtt_client):
+        self._mqtt_client = mqtt_client
+        self.topics = []
+
+    def add(self, namespace, otgw_client):
+        r"""
+        Send the commands below namespace to otgw_client
+        """
+        for topic, (code, parser) in commands.items():
+            self._register('{}/{}'.format(namespace, topic),
+                           self._callback(otgw_client, code, parser))
+        self._register('{}/raw/+'.format(namespace),
+                       self._raw_callback(otgw_client))
+
+    def remove(self):
+        r"""
+        Remove the callbacks of all gateways
+        """
+        for topic in self.topics:
+            self._mqtt_client.message_callback_remove(topic)
+        self.topics = []
+
+    def _register(self, topic, callback):
+        self._mqtt_client.message_callback_add(topic, callback)
+        self.topics.append(topic)
+
+    def _callback(self, otgw_client, code, parser):
+        def on_message(client, userdata, msg):
+            self._send(otgw_client, msg, code, parser)
+        return on_message
+
+    def _raw_callback(self, otgw_client):
+        def on_message(client, userdata, msg):
+            code = msg.topic.rsplit('/', 1)[-1]
+            if not raw_code.match(code):
+                log.warning("Ignoring raw command with invalid code {}"
+                            .format(code))
+                return
+            self._send(otgw_client, msg, code, raw_command)
+        return on_message
+
+    def _send(self, otgw_client, msg, code, parser):
+        log.info("Received message on topic {} with payload {}".format(
+            msg.topic, msg.payload.decode('ascii', 'ignore')))
+        try:
+            command = encode_command(code, parser, msg.payload)
+        except ValueError as e:
+            log.warning("Ignoring invalid {} command: {}".format(code, e))
+            return
+        log.info("Sending command: '{}'".format(command))
+        otgw_client.write("{}\r".format(command))
+
+# Commands of which the value selects what the command applies to, so only
+# commands with the same value replace each other in a `CommandQueue`
+_per_value_codes = frozenset(('PR', 'RS', 'AA', 'DA', 'UI', 'KI', 'PM', 'CR'))
+
+def coalesce_key(command):
+    r"""
+    Get the key of a command in a `CommandQueue`, a newer command with the
+    same key replaces it while it is waiting to be sent
+    """
+    code = command[:2]
+    if code in _per_value_codes:
+        return command
+    if code == 'SR':
+        # Set response, per data id
+        return command.split(':', 1)[0]
+    return code
+
+class CommandQueue(object):
+    r"""
+    Send commands to a gateway one at a time, and wait for their responses.
+
+    `write` queues a command, and can be called from any thread without
+    blocking. Commands are sent in order from a worker thread with
+    `send`, which is usually the `write` method of an OTGW client. A
+    queued command is replaced by a newer command of the same kind (see
+    `coalesce_key`), so a burst of setpoints only sends the latest one.
+
+    After sending a command, the worker waits up to `timeout` seconds for
+    the gateway's response, which the OTGW client passes to
+    `handle_response`. The OTGW answers a command with its code and the
+    value, like `TT: 19.50`, or with an error code like `BV`. Then
+    `on_result` is called with the command, the status (`ok`, `error` or
+    `timeout`), the response value or error code and the time from
+    queueing the command to the response in seconds.
+    """
+    def __init__(self, send, on_result=None, timeout=2):
+        self._send = send
+        self._on_result = on_result
+        self._timeout = timeout
+        # Maps coalesce keys to tuples of (command, time queued)
+        self._pending = OrderedDict()
+        self._condition = Condition()
+        # The code of the command that is waiting for a response
+        self._in_flight = None
+        self._response = None
+        self._worker_running = False
+        self._worker_thread = None
+        self.coalesced = 0
+
+    def write(self, data):
+        r"""
+        Queue a command, written like it would be to an OTGW client
+        """
+        command = data.rstrip('\r\n')
+        key = coalesce_key(command)
+        with self._condition:
+            if key in self._pending:
+                # Keep the position in the queue, but send the new command
+                self.coalesced += 1
+                commands_coalesced.inc()
+                log.debug("Replacing command '{}' with '{}'".format(
+                    self._pending[key][0], command))
+            self._pending[key] = (command, time_func(), )
+            self._condition.notify()
+
+    def handle_response(self, line):
+        r"""
+        Match a response read from the gateway with the command that is
+        waiting for it
+
+        Returns True if the response matched
+        """
+        if not isinstance(line, str):
+            line = line.decode('ascii', 'ignore')
+        with self._condition:
+            code = self._in_flight
+            if code is None:
+                return False
+            if line in command_errors:
+                self._response = ('error', line, )
+            elif line.startswith(code + ':'):
+                self._response = ('ok', line[len(code) + 1:].strip(), )
+            else:
+                return False
+            self._condition.notify()
+            return True
+
+    def start(self):
+        r"""
+        Start sending the queued commands
+        """
+        if self._worker_thread:
+            raise RuntimeError("Already running")
+        self._worker_running = True
+        self._worker_thread = Thread(target=self._worker)
+        self._worker_thread.daemon = True
+        self._worker_thread.start()
+
+    def stop(self):
+        r"""
+        Stop sending commands, dropping the queued commands
+        """
+        if not self._worker_thread:
+            raise RuntimeError("Not running")
+        with self._condition:
+            self._worker_running = False
+            self._condition.notify()
+        self._worker_thread.join()
+        self._worker_thread = None
+
+    def _next(self):
+        # Wait for the next command, and mark it as in flight
+        with self._condition:
+            while self._worker_running and not self._pending:
+                self._condition.wait()
+            if not self._worker_running:
+                return None
+            command, queued = self._pending.popitem(last=False)[1]
+            self._in_flight = command[:2]
+            self._response = None
+            return command, queued
+
+    def _wait_response(self):
+        # Wait for the response to the command in flight
+        deadline = time_func() + self._timeout
+        with self._condition:
+            while self._worker_running and self._response is None:
+                remaining = deadline - time_func()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            response = self._response
+            self._in_flight = None
+            self._response = None
+        return response or ('timeout', None, )
+
+    def _worker(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            command, queued = item
+            log.debug("Writing command: '{}'".format(command))
+            try:
+                self._send("{}\r".format(command))
+            except Exception as e:
+                with self._condition:
+                    self._in_flight = None
+                status, response = ('error', str(e), )
+            else:
+                status, response = self._wait_response()
+            latency = time_func() - queued
+            command_seconds.observe(latency)
+            if status == 'error':
+                log.warning("Command '{}' failed: {}".format(command,
+                                                             response))
+            elif status == 'timeout':
+                log.warning("No response to command '{}'".format(command))
+            if self._on_result:
+                try:
+                    self._on_result(command, status, response, latency)
+                except Exception as e:
+                    log.warning("Handling the result of '{}' failed: {}"
+                                .format(command, e))
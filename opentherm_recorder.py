@@ -0,0 +1,264 @@
+r"""
+Recording of the raw frames read from the OTGW.
+
+`FrameRecorder` appends every valid frame to segment files in a compact
+binary format, and `FrameReader` reads them back through a memory map.
+
+A segment file starts with a 16-byte header: the magic bytes `OTGWRAW1`
+followed by the time the segment was started, as an unsigned 64-bit
+little-endian number of milliseconds since the epoch. The header is
+followed by 8-byte records of two unsigned 32-bit little-endian numbers:
+
+- the time of the frame in milliseconds since the start of the segment in
+  the low 30 bits, and the source (0 to 3 for B, A, R and T) in the high 2
+- the 32-bit OpenTherm frame
+
+A new segment is started when the current one reaches `segment_size`
+bytes, or when the time of a frame no longer fits in 30 bits (after about
+12 days).
+"""
+from collections import deque
+import glob
+import logging
+import mmap
+import os
+import struct
+from threading import Event, Thread
+import time
+
+from opentherm import Frame, decode_raw_frame
+
+log = logging.getLogger(__name__)
+
+magic = b'OTGWRAW1'
+_header = struct.Struct('<8sQ')
+_record = struct.Struct('<II')
+
+# The sources in the order of their number in a record
+sources = 'BART'
+_source_numbers = dict((source, number)
+                       for number, source in enumerate(sources))
+
+# The largest time offset that fits in a record
+_max_offset = (1 << 30) - 1
+
+# The number of bytes FrameReader unpacks at a time
+_chunk_size = _record.size * 8192
+
+class FrameRecorder(object):
+    r"""
+    Record the frames read from the OTGW to rotating segment files.
+
+    Segments are written to `directory` as `<prefix>-<start time>.otgw`.
+    Only the newest `max_segments` segments are kept, set it to None to keep
+    all of them.
+
+    `record` only decodes the line and queues the frame, the records are
+    written by a worker thread every `flush_interval` seconds, which also
+    syncs the segment to disk every `fsync_interval` seconds, so recording
+    adds little latency to reading from the OTGW.
+    """
+    def __init__(self, directory, prefix='frames', segment_size=1 << 22,
+                 max_segments=30, flush_interval=1, fsync_interval=5):
+        self._directory = directory
+        self._prefix = prefix
+        self._segment_size = segment_size
+        self._max_segments = max_segments
+        self._flush_interval = flush_interval
+        self._fsync_interval = fsync_interval
+        self._queue = deque()
+        self._file = None
+        self._start = 0
+        self._size = 0
+        self._last_fsync = 0
+        self._stopped = Event()
+        self._worker_thread = None
+        self.recorded = 0
+
+    def record(self, line, timestamp=None):
+        r"""
+        Record a line read from the OTGW, if it is a valid frame
+
+        The timestamp defaults to the current time.
+        """
+        raw = decode_raw_frame(line)
+        if raw is None:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        # Appending to a deque is thread-safe, so no lock is needed
+        self._queue.append((int(timestamp * 1000), raw[0], raw[1], ))
+
+    def start(self):
+        r"""
+        Start writing the recorded frames
+        """
+        if self._worker_thread:
+            raise RuntimeError("Already running")
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        self._stopped.clear()
+        self._worker_thread = Thread(target=self._worker)
+        self._worker_thread.daemon = True
+        self._worker_thread.start()
+
+    def stop(self):
+        r"""
+        Write the recorded frames and close the segment
+        """
+        if not self._worker_thread:
+            raise RuntimeError("Not running")
+        self._stopped.set()
+        self._worker_thread.join()
+        self._worker_thread = None
+
+    def _worker(self):
+        while not self._stopped.wait(self._flush_interval):
+            self._flush()
+        self._flush()
+        self._close()
+
+    def _flush(self):
+        # Write the queued frames, rotating segments as needed
+        queue = self._queue
+        data = bytearray()
+        try:
+            while queue:
+                timestamp, source, frame = queue.popleft()
+                offset = timestamp - self._start
+                if self._file is None or offset > _max_offset or offset < 0 \
+                        or self._size + len(data) >= self._segment_size:
+                    self._write(data)
+                    data = bytearray()
+                    self._rotate(timestamp)
+                    offset = 0
+                data += _record.pack(
+                    offset | _source_numbers[source] << 30, frame)
+                self.recorded += 1
+            self._write(data)
+            if self._file is not None:
+                # Hand the data to the OS, so it survives the process being
+                # killed, and sync it to disk now and then
+                self._file.flush()
+                if time.time() - self._last_fsync >= self._fsync_interval:
+                    self._fsync()
+        except (IOError, OSError) as e:
+            log.warning("Recording frames failed: {}".format(e))
+            self._close()
+
+    def _write(self, data):
+        if data:
+            self._file.write(data)
+            self._size += len(data)
+
+    def _fsync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.time()
+
+    def _rotate(self, timestamp):
+        # Close the current segment and start a new one at timestamp
+        self._close()
+        path = os.path.join(self._directory, '{}-{:013d}.otgw'.format(
+            self._prefix, timestamp))
+        self._file = open(path, 'ab')
+        if not self._file.tell():
+            self._file.write(_header.pack(magic, timestamp))
+        self._start = timestamp
+        self._size = self._file.tell()
+        log.info("Recording frames to {}".format(path))
+        if self._max_segments:
+            for old in segments(self._directory, self._prefix)[
+                    :-self._max_segments]:
+                os.remove(old)
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                self._fsync()
+                self._file.close()
+            finally:
+                self._file = None
+
+def segments(directory, prefix='frames'):
+    r"""
+    Get the paths of the segments in a directory, oldest first
+    """
+    return sorted(glob.glob(os.path.join(directory,
+                                         '{}-*.otgw'.format(prefix))))
+
+class FrameReader(object):
+    r"""
+    Read the frames in a segment file through a memory map.
+
+    Iterating over the reader yields (timestamp, frame) tuples, with the
+    timestamp in seconds since the epoch and the frame as a `Frame`. An
+    incomplete record at the end, from a segment that is still being
+    written, is ignored.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header, self.start = _header.unpack_from(self._map)
+        except struct.error:
+            header = None
+        if header != magic:
+            self._map.close()
+            raise ValueError("Not a frame recording: {}".format(path))
+        self._count = (len(self._map) - _header.size) // _record.size
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for timestamp, source, frame in self.raw():
+            yield (timestamp, Frame(source, (frame >> 28) & 7,
+                                    (frame >> 16) & 0xFF, frame & 0xFFFF))
+
+    def raw(self):
+        r"""
+        Get the frames as (timestamp, source, frame) tuples, with the frame
+        as a 32-bit number
+        """
+        start = self.start
+        end = _header.size + self._count * _record.size
+        # Unpack slices of the map rather than a view of it, so the map can
+        # be closed while a generator is still suspended
+        for pos in range(_header.size, end, _chunk_size):
+            chunk = self._map[pos:min(pos + _chunk_size, end)]
+            for offset, frame in _record.iter_unpack(chunk):
+                yield ((start + (offset & _max_offset)) / 1000.,
+                       sources[offset >> 30], frame)
+
+    def lines(self):
+        r"""
+        Get the frames as (timestamp, line) tuples, with the lines as the
+        OTGW sends them
+        """
+        for timestamp, source, frame in self.raw():
+            yield (timestamp, '{}{:08X}'.format(source, frame))
+
+    def close(self):
+        r"""
+        Close the memory map
+        """
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_recording(directory, prefix='frames', raw=False):
+    r"""
+    Read the frames in all segments in a directory, oldest first
+
+    Returns a generator of (timestamp, frame) tuples, or of (timestamp,
+    source, frame) tuples like `FrameReader.raw` if `raw` is set
+    """
+    for path in segments(directory, prefix):
+        with FrameReader(path) as reader:
+            for item in (reader.raw() if raw else reader):
+                yield item
@@ -0,0 +1,161 @@
+from opentherm import OTGWClient, decode_raw_frame
+from opentherm_bulk import parse_timestamp
+import opentherm_recorder
+import logging
+import math
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+try:
+    # Use monotonic clock if available
+    time_func = time.monotonic
+except AttributeError:
+    time_func = time.time
+
+class OTGWReplayClient(OTGWClient):
+    r"""
+    An OTGWClient implementation that replays a recording
+
+    Replays a text log of OTGW lines, optionally preceded by timestamps like
+    `opentherm_bulk` reads them, or a binary recording made by
+    `opentherm_recorder`, either a single segment or a directory of them.
+    Lines without a timestamp follow the previous line after `interval`
+    seconds. When the timestamps go back, for example at midnight in a log
+    with times of day, the replay continues from the previous line.
+
+    The lines are returned by `read` at the time they were recorded, sped up
+    `speed` times, or as fast as possible if `speed` is 0. When the end of
+    the recording is reached, it starts over if `loop` is set, otherwise
+    `finished` is set and nothing more is read. Commands written to the
+    client are logged and counted in `commands`, but otherwise ignored.
+    """
+    binary = True
+
+    def __init__(self, listener, namespace=None, **kwargs):
+        super(OTGWReplayClient, self).__init__(listener, namespace)
+        self._args = kwargs
+        self._lines = None
+        self._pending = None
+        self.finished = False
+        self.commands = 0
+
+    def open(self):
+        r"""
+        Start replaying the recording
+        """
+        self._lines = self._read_lines()
+        self._pending = None
+        self.finished = False
+
+    def close(self):
+        r"""
+        Stop replaying the recording
+        """
+        if self._lines is not None:
+            self._lines.close()
+            self._lines = None
+
+    def write(self, data):
+        r"""
+        Log the commands written to the OTGW
+        """
+        self.commands += 1
+        log.info("Replaying, ignoring command: {}".format(data.rstrip()))
+
+    def read(self, timeout):
+        r"""
+        Read the lines that are due, waiting at most timeout seconds for the
+        first one
+        """
+        speed = self._args.get('speed', 1)
+        read_size = self._args.get('read_size', 4096)
+        deadline = time_func() + timeout
+        data = bytearray()
+        while len(data) < read_size:
+            if self._pending is None:
+                try:
+                    self._pending = next(self._lines)
+                except StopIteration:
+                    if not self._args.get('loop'):
+                        if not self.finished:
+                            log.info("Replay finished")
+                            self.finished = True
+                        break
+                    self._lines.close()
+                    self._lines = self._read_lines()
+                    continue
+            timestamp, line = self._pending
+            if speed:
+                delay = self._start + (timestamp - self._first) / speed \
+                    - time_func()
+                if delay > 0:
+                    # Return what is due, or wait for the next line
+                    if data or time_func() + delay > deadline:
+                        break
+                    time.sleep(delay)
+            data += line
+            data += b'\r\n'
+            self._pending = None
+        if not data:
+            remaining = deadline - time_func()
+            if remaining > 0:
+                time.sleep(remaining)
+        return bytes(data)
+
+    def _read_lines(self):
+        # Generate the lines of the recording as (timestamp, line) tuples,
+        # and set the times to replay them relative to
+        path = self._args['path']
+        self._start = time_func()
+        self._first = None
+        last = None
+        shift = 0
+        if os.path.isdir(path):
+            recording = opentherm_recorder.read_recording(
+                path, self._args.get('prefix', 'frames'), raw=True)
+            lines = ((timestamp, '{}{:08X}'.format(source, frame)
+                      .encode('ascii'))
+                     for timestamp, source, frame in recording)
+        else:
+            with open(path, 'rb') as f:
+                binary = f.read(len(opentherm_recorder.magic)) == \
+                    opentherm_recorder.magic
+            lines = self._read_binary(path) if binary \
+                else self._read_text(path)
+        for timestamp, line in lines:
+            timestamp += shift
+            if last is not None and timestamp < last:
+                shift += last - timestamp
+                timestamp = last
+            if self._first is None:
+                self._first = timestamp
+            last = timestamp
+            yield (timestamp, line, )
+
+    def _read_binary(self, path):
+        with opentherm_recorder.FrameReader(path) as reader:
+            for timestamp, source, frame in reader.raw():
+                yield (timestamp, '{}{:08X}'.format(source, frame)
+                       .encode('ascii'), )
+
+    def _read_text(self, path):
+        interval = self._args.get('interval', 0.1)
+        timestamp = 0.
+        with open(path, 'rb') as f:
+            for line in f:
+                line = line.rstrip(b'\r\n')
+                if not line:
+                    continue
+                # Split off the timestamp in front of a frame, if any
+                if len(line) > 9 and line[-10:-9] in (b' ', b'\t') \
+                        and decode_raw_frame(line[-9:]) is not None:
+                    parsed = parse_timestamp(line[:-10].decode('latin-1'))
+                    line = line[-9:]
+                    if not math.isnan(parsed):
+                        timestamp = parsed
+                        yield (timestamp, line, )
+                        continue
+                timestamp += interval
+                yield (timestamp, line, )
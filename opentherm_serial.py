@@ -2,18 +2,32 @@ from opentherm import OTGWClient
 import re
 from threading import Lock, Thread
 import logging
+import metrics
+import select
 import serial
 
 log = logging.getLogger(__name__)
 
+# The number of bytes returned by each read that returned data
+read_sizes = metrics.registry.histogram(
+    'otgw_serial_read_bytes', "Bytes returned by serial reads",
+    metrics.exponential_buckets(1, 2, 13))
+
 class OTGWSerialClient(OTGWClient):
     r"""
     A serial-based OTGWClient implementation
+
+    Where the serial device has a file descriptor, `read` waits for data in
+    `select` and then reads all the data that is waiting at once, so lines
+    are passed on as soon as they arrive. Otherwise, it falls back to reading
+    blocks of up to 128 bytes with the serial timeout.
     """
+    binary = True
 
-    def __init__(self, listener, **kwargs):
-        super(OTGWSerialClient, self).__init__(listener)
+    def __init__(self, listener, namespace=None, **kwargs):
+        super(OTGWSerialClient, self).__init__(listener, namespace)
         self._args=kwargs
+        self._serial = None
 
     def open(self):
         r"""
@@ -38,10 +52,42 @@ class OTGWSerialClient(OTGWClient):
         self._serial.write("{}\r\n".format(data.rstrip('\r\n')).encode('ascii', 'ignore'))
         self._serial.flush()
 
+    def fileno(self):
+        r"""
+        Get the file descriptor of the serial device
+        """
+        if self._serial is None or not hasattr(self._serial, 'fileno'):
+            return None
+        return self._serial.fileno()
+
     def read(self, timeout):
         r"""
         Read a block of data from the serial device
         """
+        fd = self.fileno()
+        if fd is None:
+            return self._poll(timeout)
+        if not self._serial.in_waiting:
+            try:
+                readable, _, _ = select.select([fd], [], [], timeout)
+            except (select.error, OSError) as e:
+                log.warning("Waiting for serial data failed: {}".format(e))
+                return b''
+            if not readable:
+                return b''
+        # Read everything that is waiting, without blocking for more
+        if self._serial.timeout != 0:
+            self._serial.timeout = 0
+        data = self._serial.read(max(1, self._serial.in_waiting))
+        if data:
+            read_sizes.observe(len(data))
+        return data
+
+    def _poll(self, timeout):
+        # Wait for up to 128 bytes or the timeout
         if(self._serial.timeout != timeout):
             self._serial.timeout = timeout
-        return self._serial.read(128).decode('ascii', 'ignore')
+        data = self._serial.read(128)
+        if data:
+            read_sizes.observe(len(data))
+        return data
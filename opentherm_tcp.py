@@ -1,56 +1,211 @@
 from opentherm import OTGWClient
+import errno
 import logging
+import select
+import socket
+from threading import Lock
+import time
 
 log = logging.getLogger(__name__)
 
+try:
+    # Use monotonic clock if available
+    time_func = time.monotonic
+except AttributeError:
+    time_func = time.time
+
+# Errors that mean a non-blocking operation has to be retried later
+_retry_errors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS,
+                 errno.EALREADY, errno.EINTR)
+
 class OTGWTcpClient(OTGWClient):
     r"""
-    A skeleton for a TCP-client based
+    A TCP-based OTGWClient implementation
+
+    Connects to an OTGW that is reachable over the network, for example
+    through ser2net or the OTGW NodeMCU firmware, which listens on port 25238
+    by default. The socket is non-blocking and all waiting is done in
+    `select`, so `read` never blocks longer than its timeout. When the
+    connection fails or is lost, it is reopened with an exponential backoff
+    between `reconnect_min_delay` and `reconnect_max_delay` seconds.
     """
+    binary = True
+
+    def __init__(self, listener, namespace=None, **kwargs):
+        super(OTGWTcpClient, self).__init__(listener, namespace)
+        self._args = kwargs
+        self._socket = None
+        self._connecting = None
+        self._connect_deadline = 0
+        self._reconnect_delay = None
+        self._next_connect = 0
+        self._write_lock = Lock()
 
     def open(self):
         r"""
         Open the connection to the OTGW
 
-        Must be overridden in implementing classes. Called before reading of
-        the data starts. Should not return until the connection is opened, so
-        an immediately following call to `read` does not fail.
+        Retries until the connection is opened or the client is stopped. When
+        the client is not running its own worker thread, only starts
+        connecting, and `read` finishes connecting.
         """
-        # TODO: Implement
-        raise NotImplementedError("Not implemented yet")
+        if not self._worker_running:
+            self._wait_connected(0)
+        while self._worker_running and self._socket is None:
+            self._wait_connected(0.5)
 
     def close(self):
         r"""
         Close the connection to the OTGW
-
-        Must be overridden in implementing classes. Called after reading of
-        the data is finished. Should not return until the connection is closed.
         """
-        # TODO: Implement
-        raise NotImplementedError("Not implemented yet")
+        self._disconnect()
 
     def write(self, data):
         r"""
         Write data to the OTGW
+        """
+        data = "{}\r\n".format(data.rstrip('\r\n')).encode('ascii', 'ignore')
+        with self._write_lock:
+            sock = self._socket
+            if sock is None:
+                log.warning("Not connected, dropping command: {}".format(
+                    data.rstrip()))
+                return
+            view = memoryview(data)
+            deadline = time_func() + self._args.get('write_timeout', 5)
+            while view:
+                remaining = deadline - time_func()
+                if remaining <= 0:
+                    raise socket.timeout("Timed out writing to the OTGW")
+                select.select([], [sock], [], remaining)
+                try:
+                    view = view[sock.send(view):]
+                except socket.error as e:
+                    if e.errno not in _retry_errors:
+                        raise
 
-        Must be overridden in implementing classes. Called when a command is
-        received that should be sent to the OTGW. Should pass on the data
-        as-is, not appending line feeds, carriage returns or anything.
+    def fileno(self):
+        r"""
+        Get the file descriptor of the socket, while connected
         """
-        # TODO: Implement
-        raise NotImplementedError("Not implemented yet")
+        sock = self._socket
+        return None if sock is None else sock.fileno()
 
     def read(self, timeout):
         r"""
-        Read data from the OTGW
-
-        Must be overridden in implementing classes. Called in a loop while the
-        client is running. May return any block of data read from the
-        connection, be it line by line or any other block size. Must return a
-        string. Line feeds and carriage returns should be passed on unchanged.
-        Should adhere to the timeout passed. If only part of a data block is
-        read before the timeout passes, return only the part that was read
-        successfully, even if it is an empty string.
+        Read a block of data from the OTGW
+
+        Reconnects first if the connection was lost.
         """
-        # TODO: Implement
-        raise NotImplementedError("Not implemented yet")
+        sock = self._socket
+        if sock is None:
+            # Reading starts with the next call after connecting
+            self._wait_connected(timeout)
+            return b''
+        try:
+            readable, _, _ = select.select([sock], [], [], timeout)
+            if not readable:
+                return b''
+            data = sock.recv(self._args.get('read_size', 4096))
+        except (socket.error, select.error, ValueError) as e:
+            if getattr(e, 'errno', None) in _retry_errors:
+                return b''
+            log.warning("Connection to the OTGW failed: {}".format(e))
+            self._disconnect()
+            return b''
+        if not data:
+            log.warning("Connection closed by the OTGW")
+            self._disconnect()
+        return data
+
+    def _wait_connected(self, timeout):
+        # Make progress on connecting for at most timeout seconds. Returns
+        # when connected, or when the timeout passes.
+        deadline = time_func() + timeout
+        while self._socket is None:
+            now = time_func()
+            if self._connecting is None:
+                if now < self._next_connect:
+                    time.sleep(max(0, min(self._next_connect, deadline) - now))
+                    if time_func() < self._next_connect:
+                        return
+                self._start_connect()
+                continue
+            # Also check without waiting when the timeout is zero
+            remaining = max(0, min(deadline, self._connect_deadline) - now)
+            _, writable, _ = select.select(
+                [], [self._connecting], [], remaining)
+            if writable:
+                self._finish_connect()
+                continue
+            if time_func() >= self._connect_deadline:
+                self._connect_failed("timed out")
+            if time_func() >= deadline:
+                return
+
+    def _start_connect(self):
+        # Start a non-blocking connect
+        host = self._args.get('host', 'localhost')
+        port = self._args.get('port', 25238)
+        log.info("Connecting to OTGW at {}:{}".format(host, port))
+        try:
+            info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            sock = socket.socket(info[0], info[1], info[2])
+        except socket.error as e:
+            self._connect_failed(e)
+            return
+        sock.setblocking(False)
+        self._connecting = sock
+        self._connect_deadline = \
+            time_func() + self._args.get('connect_timeout', 10)
+        err = sock.connect_ex(info[4])
+        if err not in (0, ) + _retry_errors:
+            self._connect_failed(socket.error(err, errno.errorcode.get(err)))
+
+    def _finish_connect(self):
+        # Check the result of a non-blocking connect that became writable
+        sock = self._connecting
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._connect_failed(socket.error(err, errno.errorcode.get(err)))
+            return
+        # Send commands right away, and detect dead connections
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 10),
+                              ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP,
+                                getattr(socket, option), value)
+        self._connecting = None
+        self._reconnect_delay = None
+        self._socket = sock
+        log.info("Connected to OTGW")
+
+    def _connect_failed(self, reason):
+        # Close the pending connection and schedule the next attempt
+        if self._connecting is not None:
+            self._connecting.close()
+            self._connecting = None
+        if self._reconnect_delay is None:
+            self._reconnect_delay = self._args.get('reconnect_min_delay', 1)
+        else:
+            self._reconnect_delay = min(
+                self._reconnect_delay * 2,
+                self._args.get('reconnect_max_delay', 60))
+        self._next_connect = time_func() + self._reconnect_delay
+        log.warning("Connecting to OTGW failed ({}), retrying in {}s".format(
+            reason, self._reconnect_delay))
+
+    def _disconnect(self):
+        # Close the connection, if any. The next connect is delayed by the
+        # backoff, so a gateway that accepts and then drops connections is
+        # not hammered.
+        with self._write_lock:
+            for sock in (self._socket, self._connecting):
+                if sock is not None:
+                    sock.close()
+            self._socket = None
+            self._connecting = None
+        self._next_connect = time_func() + \
+            self._args.get('reconnect_min_delay', 1)
@@ -18,6 +18,8 @@ protocol that is easy to implement and suitable for low powered devices.
 """
 import collections
 import errno
+import heapq
+import itertools
 import platform
 import random
 import select
@@ -144,6 +146,9 @@ MQTT_ERR_QUEUE_SIZE = 15
 
 sockpair_data = b"0"
 
+# Number of bytes to read from the socket at once
+IN_BUFFER_SIZE = 65536
+
 
 class WebsocketConnectionError(ValueError):
     pass
@@ -498,7 +503,12 @@ class Client(object):
         self._sockpairR, self._sockpairW = _socketpair_compat()
         self._keepalive = 60
         self._message_retry = 20
-        self._last_retry_check = 0
+        # Retry deadlines of the messages in _out_messages and _in_messages,
+        # as heaps of (deadline, sequence number, message). Entries of
+        # finished messages are dropped when they expire.
+        self._out_retry = []
+        self._in_retry = []
+        self._retry_seq = itertools.count()
         self._clean_session = clean_session
 
         # [MQTT-3.1.3-4] Client Id must be UTF-8 encoded string.
@@ -523,6 +533,9 @@ class Client(object):
             "packet": b"",
             "to_process": 0,
             "pos": 0}
+        # Data received from the socket that does not form a complete packet
+        # yet
+        self._in_buffer = bytearray()
         self._out_packet = collections.deque()
         self._current_out_packet = None
         self._last_msg_in = time_func()
@@ -533,8 +546,12 @@ class Client(object):
         self._ping_t = 0
         self._last_mid = 0
         self._state = mqtt_cs_new
-        self._out_messages = []
-        self._in_messages = []
+        # Outgoing QoS>0 messages that have been sent, or will be sent when
+        # connected, and incoming QoS 2 messages, by mid. Outgoing messages
+        # waiting for room in the inflight window are kept in _out_queue.
+        self._out_messages = collections.OrderedDict()
+        self._out_queue = collections.deque()
+        self._in_messages = collections.OrderedDict()
         self._max_inflight_messages = 20
         self._inflight_messages = 0
         self._max_queued_messages = 0
@@ -866,6 +883,7 @@ class Client(object):
             "packet": b"",
             "to_process": 0,
             "pos": 0}
+        self._in_buffer = bytearray()
 
         with self._out_packet_mutex:
             self._out_packet = collections.deque()
@@ -1028,7 +1046,8 @@ class Client(object):
         This causes a message to be sent to the broker and subsequently from
         the broker to any clients subscribing to matching topics.
 
-        topic: The topic that the message should be published on.
+        topic: The topic that the message should be published on. May be a
+        string or UTF-8 encoded bytes.
         payload: The actual message to send. If not given, or set to None a
         zero length message will be used. Passing an int or float will result
         in the payload being converted to a string representing that number. If
@@ -1056,30 +1075,7 @@ class Client(object):
         A ValueError will be raised if topic is None, has zero length or is
         invalid (contains a wildcard), if qos is not one of 0, 1 or 2, or if
         the length of the payload is greater than 268435455 bytes."""
-        if topic is None or len(topic) == 0:
-            raise ValueError('Invalid topic.')
-
-        topic = topic.encode('utf-8')
-
-        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
-            raise ValueError('Publish topic cannot contain wildcards.')
-
-        if qos < 0 or qos > 2:
-            raise ValueError('Invalid QoS level.')
-
-        if isinstance(payload, unicode):
-            local_payload = payload.encode('utf-8')
-        elif isinstance(payload, (bytes, bytearray)):
-            local_payload = payload
-        elif isinstance(payload, (int, float)):
-            local_payload = str(payload).encode('ascii')
-        elif payload is None:
-            local_payload = b''
-        else:
-            raise TypeError('payload must be a string, bytearray, int, float or None.')
-
-        if len(local_payload) > 268435455:
-            raise ValueError('Payload too large.')
+        topic, local_payload = self._publish_check(topic, payload, qos)
 
         local_mid = self._mid_generate()
 
@@ -1097,12 +1093,13 @@ class Client(object):
             message.dup = False
 
             with self._out_message_mutex:
-                if self._max_queued_messages > 0 and len(self._out_messages) >= self._max_queued_messages:
+                if self._max_queued_messages > 0 and self._out_messages_len() >= self._max_queued_messages:
                     message.info.rc = MQTT_ERR_QUEUE_SIZE
                     return message.info
 
-                self._out_messages.append(message)
-                if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
+                if self._can_send_out_message(message):
+                    self._out_messages[message.mid] = message
+                    self._retry_schedule(self._out_retry, message)
                     self._inflight_messages += 1
                     if qos == 1:
                         message.state = mqtt_ms_wait_for_puback
@@ -1121,9 +1118,102 @@ class Client(object):
                     return message.info
                 else:
                     message.state = mqtt_ms_queued
+                    self._out_queue.append(message)
                     message.info.rc = MQTT_ERR_SUCCESS
                     return message.info
 
+    def publish_many(self, msgs):
+        """Publish many messages at once.
+
+        This works like calling publish() for every message, but all messages
+        that can be sent right away are serialised into a single buffer that
+        is queued, and written to the network, as a whole.
+
+        msgs: an iterable of messages. Each message is either a dict of the
+        form {'topic':"<topic>", 'payload':"<payload>", 'qos':<qos>,
+        'retain':<retain>}, in which only the topic is required, or a tuple of
+        the form ("<topic>", "<payload>", qos, retain).
+
+        Returns a list with a MQTTMessageInfo for each message, in the same
+        order as the messages.
+
+        A ValueError or TypeError will be raised for an invalid message, in
+        the same cases as for publish(). No messages are sent in that case."""
+        prepared = []
+        for msg in msgs:
+            if isinstance(msg, dict):
+                topic = msg.get('topic')
+                payload = msg.get('payload')
+                qos = msg.get('qos', 0)
+                retain = msg.get('retain', False)
+            elif isinstance(msg, tuple):
+                (topic, payload, qos, retain) = \
+                    (msg + (None, 0, False)[len(msg) - 1:])[:4]
+            else:
+                raise ValueError('message must be a dict or a tuple')
+            topic, local_payload = self._publish_check(topic, payload, qos)
+            prepared.append((topic, local_payload, qos, retain))
+
+        infos = []
+        packet = bytearray()
+        published = []
+        connected = self._sock is not None
+        with self._out_message_mutex:
+            for topic, local_payload, qos, retain in prepared:
+                local_mid = self._mid_generate()
+
+                if qos == 0:
+                    info = MQTTMessageInfo(local_mid)
+                    infos.append(info)
+                    if not connected:
+                        info.rc = MQTT_ERR_NO_CONN
+                        continue
+                    info.rc = MQTT_ERR_SUCCESS
+                    packet.extend(self._publish_packet(local_mid, topic, local_payload, qos, retain, False))
+                    published.append((local_mid, info))
+                    continue
+
+                message = MQTTMessage(local_mid, topic)
+                message.timestamp = time_func()
+                message.payload = local_payload
+                message.qos = qos
+                message.retain = retain
+                message.dup = False
+                infos.append(message.info)
+
+                if self._max_queued_messages > 0 and self._out_messages_len() >= self._max_queued_messages:
+                    message.info.rc = MQTT_ERR_QUEUE_SIZE
+                    continue
+
+                message.info.rc = MQTT_ERR_SUCCESS
+                if not self._can_send_out_message(message):
+                    message.state = mqtt_ms_queued
+                    self._out_queue.append(message)
+                elif not connected:
+                    # Will be sent after a connection is made
+                    self._out_messages[message.mid] = message
+                    self._retry_schedule(self._out_retry, message)
+                    message.state = mqtt_ms_publish
+                    message.info.rc = MQTT_ERR_NO_CONN
+                else:
+                    self._out_messages[message.mid] = message
+                    self._retry_schedule(self._out_retry, message)
+                    self._inflight_messages += 1
+                    if qos == 1:
+                        message.state = mqtt_ms_wait_for_puback
+                    elif qos == 2:
+                        message.state = mqtt_ms_wait_for_pubrec
+                    packet.extend(self._publish_packet(local_mid, topic, local_payload, qos, retain, False))
+
+            if len(packet) > 0:
+                rc = self._packet_queue(PUBLISH, packet, 0, 0, batch=published)
+                if rc != MQTT_ERR_SUCCESS:
+                    for info in infos:
+                        if info.rc == MQTT_ERR_SUCCESS:
+                            info.rc = rc
+
+        return infos
+
     def username_pw_set(self, username, password=None):
         """Set a username and optionally a password for broker authentication.
 
@@ -1274,7 +1364,7 @@ class Client(object):
         if self._sock is None:
             return MQTT_ERR_NO_CONN
 
-        max_packets = len(self._out_messages) + len(self._in_messages)
+        max_packets = self._out_messages_len() + len(self._in_messages)
         if max_packets < 1:
             max_packets = 1
 
@@ -1332,10 +1422,7 @@ class Client(object):
 
         now = time_func()
         self._check_keepalive()
-        if self._last_retry_check + 1 < now:
-            # Only check once a second at most
-            self._message_retry_check()
-            self._last_retry_check = now
+        self._message_retry_check()
 
         if self._ping_t > 0 and now - self._ping_t >= self._keepalive:
             # client->ping_t != 0 means we are waiting for a pingresp.
@@ -1383,6 +1470,16 @@ class Client(object):
 
         self._message_retry = retry
 
+        # Reschedule the messages with the new timeout
+        with self._out_message_mutex:
+            self._out_retry = []
+            for m in self._out_messages.values():
+                self._retry_schedule(self._out_retry, m)
+        with self._in_message_mutex:
+            self._in_retry = []
+            for m in self._in_messages.values():
+                self._retry_schedule(self._in_retry, m)
+
     def user_data_set(self, userdata):
         """Set the user data variable passed to callbacks. May be any data type."""
         self._userdata = userdata
@@ -1487,7 +1584,7 @@ class Client(object):
                 if (self._thread_terminate is True
                     and self._current_out_packet is None
                     and len(self._out_packet) == 0
-                    and len(self._out_messages) == 0):
+                    and self._out_messages_len() == 0):
                     rc = 1
                     run = False
 
@@ -1767,100 +1864,105 @@ class Client(object):
 
     def _packet_read(self):
         # This gets called if pselect() indicates that there is network data
-        # available - ie. at least one byte.  What we do depends on what data we
-        # already have.
-        # If we've not got a command, attempt to read one and save it. This should
-        # always work because it's only a single byte.
-        # Then try to read the remaining length. This may fail because it is may
-        # be more than one byte - will need to save data pending next read if it
-        # does fail.
-        # Then try to read the remaining payload, where 'payload' here means the
-        # combined variable header and actual payload. This is the most likely to
-        # fail due to longer length, so save current data and current position.
-        # After all data is read, send to _mqtt_handle_packet() to deal with.
-        # Finally, free the memory and reset everything to starting conditions.
-        if self._in_packet['command'] == 0:
-            try:
-                command = self._sock.recv(1)
-            except socket.error as err:
-                if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
-                    return MQTT_ERR_AGAIN
-                if err.errno == EAGAIN:
-                    return MQTT_ERR_AGAIN
-                print(err)
+        # available - ie. at least one byte.
+        # Read a large block of data in a single call and append it to the
+        # data left over from the previous read. Then handle every complete
+        # packet in the data, passing the variable header and payload on to
+        # _packet_handle() as a memoryview slice, so it is not copied. Data
+        # of an incomplete packet at the end is kept in a bytearray for the
+        # next read, which the following reads are appended to in place, so
+        # a packet that spans many reads is not copied on every read.
+        try:
+            data = self._sock.recv(IN_BUFFER_SIZE)
+        except socket.error as err:
+            if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
+                return MQTT_ERR_AGAIN
+            if err.errno == EAGAIN:
+                return MQTT_ERR_AGAIN
+            print(err)
+            return 1
+        else:
+            if len(data) == 0:
                 return 1
-            else:
-                if len(command) == 0:
-                    return 1
-                command, = struct.unpack("!B", command)
-                self._in_packet['command'] = command
 
-        if self._in_packet['have_remaining'] == 0:
-            # Read remaining
+        buf = self._in_buffer
+        if buf:
+            buf += data
+            data = buf
+        view = memoryview(data)
+        size = len(data)
+        sock = self._sock
+        pos = 0
+        rc = MQTT_ERR_SUCCESS
+
+        while size - pos >= 2:
+            # Read remaining length
             # Algorithm for decoding taken from pseudo code at
             # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
+            remaining_length = 0
+            remaining_mult = 1
+            i = pos + 1
             while True:
-                try:
-                    byte = self._sock.recv(1)
-                except socket.error as err:
-                    if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
-                        return MQTT_ERR_AGAIN
-                    if err.errno == EAGAIN:
-                        return MQTT_ERR_AGAIN
-                    print(err)
-                    return 1
-                else:
-                    if len(byte) == 0:
-                        return 1
-                    byte, = struct.unpack("!B", byte)
-                    self._in_packet['remaining_count'].append(byte)
-                    # Max 4 bytes length for remaining length as defined by protocol.
-                    # Anything more likely means a broken/malicious client.
-                    if len(self._in_packet['remaining_count']) > 4:
-                        return MQTT_ERR_PROTOCOL
-
-                    self._in_packet['remaining_length'] += (byte & 127) * self._in_packet['remaining_mult']
-                    self._in_packet['remaining_mult'] = self._in_packet['remaining_mult'] * 128
-
-                if (byte & 128) == 0:
+                if i >= size:
                     break
+                byte, = struct.unpack_from("!B", data, i)
+                i += 1
+                # Max 4 bytes length for remaining length as defined by protocol.
+                # Anything more likely means a broken/malicious client.
+                if i - pos > 5:
+                    return MQTT_ERR_PROTOCOL
 
-            self._in_packet['have_remaining'] = 1
-            self._in_packet['to_process'] = self._in_packet['remaining_length']
-
-        while self._in_packet['to_process'] > 0:
-            try:
-                data = self._sock.recv(self._in_packet['to_process'])
-            except socket.error as err:
-                if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
-                    return MQTT_ERR_AGAIN
-                if err.errno == EAGAIN:
-                    return MQTT_ERR_AGAIN
-                print(err)
-                return 1
-            else:
-                if len(data) == 0:
-                    return 1
-                self._in_packet['to_process'] -= len(data)
-                self._in_packet['packet'] += data
+                remaining_length += (byte & 127) * remaining_mult
+                remaining_mult = remaining_mult * 128
 
-        # All data for this packet is read.
-        self._in_packet['pos'] = 0
-        rc = self._packet_handle()
+                if (byte & 128) == 0:
+                    break
+            if byte & 128 or size - i < remaining_length:
+                # The packet isn't complete yet
+                break
 
-        # Free data and reset values
-        self._in_packet = {
-            'command': 0,
-            'have_remaining': 0,
-            'remaining_count': [],
-            'remaining_mult': 1,
-            'remaining_length': 0,
-            'packet': b"",
-            'to_process': 0,
-            'pos': 0}
+            # All data for this packet is read.
+            command, = struct.unpack_from("!B", data, pos)
+            pos = i + remaining_length
+            self._in_packet = {
+                'command': command,
+                'have_remaining': 1,
+                'remaining_count': [],
+                'remaining_mult': remaining_mult,
+                'remaining_length': remaining_length,
+                'packet': view[i:pos],
+                'to_process': 0,
+                'pos': 0}
+            rc = self._packet_handle()
+
+            # Free data and reset values
+            self._in_packet = {
+                'command': 0,
+                'have_remaining': 0,
+                'remaining_count': [],
+                'remaining_mult': 1,
+                'remaining_length': 0,
+                'packet': b"",
+                'to_process': 0,
+                'pos': 0}
+
+            with self._msgtime_mutex:
+                self._last_msg_in = time_func()
+
+            if rc or self._sock is not sock:
+                # Don't handle any further data on error, or if the handler
+                # reconnected
+                return rc
 
-        with self._msgtime_mutex:
-            self._last_msg_in = time_func()
+        if pos == 0:
+            # No packet was handed out, so the buffer can still grow
+            view.release()
+            if data is not buf:
+                self._in_buffer = bytearray(data)
+        else:
+            # The handled packets may still refer to the data, so the rest is
+            # copied to a new buffer
+            self._in_buffer = bytearray(view[pos:])
         return rc
 
     def _packet_write(self):
@@ -1888,7 +1990,15 @@ class Client(object):
                 packet['pos'] += write_length
 
                 if packet['to_process'] == 0:
-                    if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
+                    if (packet['command'] & 0xF0) == PUBLISH and packet['batch'] is not None:
+                        for mid, info in packet['batch']:
+                            with self._callback_mutex:
+                                if self.on_publish:
+                                    with self._in_callback:
+                                        self.on_publish(self, self._userdata, mid)
+
+                            info._set_as_published()
+                    elif (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
                         with self._callback_mutex:
                             if self.on_publish:
                                 with self._in_callback:
@@ -2030,6 +2140,36 @@ class Client(object):
         packet.extend(struct.pack("!H", len(data)))
         packet.extend(data)
 
+    def _publish_check(self, topic, payload, qos):
+        # Validate the arguments of a publish and encode the topic and payload
+        if topic is None or len(topic) == 0:
+            raise ValueError('Invalid topic.')
+
+        if isinstance(topic, unicode):
+            topic = topic.encode('utf-8')
+
+        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
+            raise ValueError('Publish topic cannot contain wildcards.')
+
+        if qos < 0 or qos > 2:
+            raise ValueError('Invalid QoS level.')
+
+        if isinstance(payload, unicode):
+            local_payload = payload.encode('utf-8')
+        elif isinstance(payload, (bytes, bytearray)):
+            local_payload = payload
+        elif isinstance(payload, (int, float)):
+            local_payload = str(payload).encode('ascii')
+        elif payload is None:
+            local_payload = b''
+        else:
+            raise TypeError('payload must be a string, bytearray, int, float or None.')
+
+        if len(local_payload) > 268435455:
+            raise ValueError('Payload too large.')
+
+        return topic, local_payload
+
     def _send_publish(self, mid, topic, payload=b'', qos=0, retain=False, dup=False, info=None):
         # we assume that topic and payload are already properly encoded
         assert not isinstance(topic, unicode) and not isinstance(payload, unicode) and payload is not None
@@ -2037,6 +2177,11 @@ class Client(object):
         if self._sock is None:
             return MQTT_ERR_NO_CONN
 
+        packet = self._publish_packet(mid, topic, payload, qos, retain, dup)
+        return self._packet_queue(PUBLISH, packet, mid, qos, info)
+
+    def _publish_packet(self, mid, topic, payload, qos, retain, dup):
+        # Serialise a PUBLISH packet
         command = PUBLISH | ((dup & 0x1) << 3) | (qos << 1) | retain
         packet = bytearray()
         packet.append(command)
@@ -2070,7 +2215,7 @@ class Client(object):
 
         packet.extend(payload)
 
-        return self._packet_queue(PUBLISH, packet, mid, qos, info)
+        return packet
 
     def _send_pubrec(self, mid):
         self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: %d)", mid)
@@ -2191,10 +2336,23 @@ class Client(object):
         self._easy_log(MQTT_LOG_DEBUG, "Sending UNSUBSCRIBE (d%d) %s", dup, topics)
         return (self._packet_queue(command, packet, local_mid, 1), local_mid)
 
-    def _message_retry_check_actual(self, messages, mutex):
+    def _retry_schedule(self, retry, message, now=None):
+        # Schedule a retry check for a message. Must be called with the mutex
+        # for the messages held. If the message has already expired at now,
+        # it is checked again one retry timeout later.
+        deadline = message.timestamp + self._message_retry
+        if now is not None and deadline < now:
+            deadline = now + self._message_retry
+        heapq.heappush(retry, (deadline, next(self._retry_seq), message))
+
+    def _message_retry_check_actual(self, messages, mutex, retry):
         with mutex:
             now = time_func()
-            for m in messages:
+            while retry and retry[0][0] < now:
+                m = heapq.heappop(retry)[2]
+                if messages.get(m.mid) is not m:
+                    # The message is finished
+                    continue
                 if m.timestamp + self._message_retry < now:
                     if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
                         m.timestamp = now
@@ -2215,15 +2373,16 @@ class Client(object):
                         m.timestamp = now
                         m.dup = True
                         self._send_pubrel(m.mid, True)
+                self._retry_schedule(retry, m, now)
 
     def _message_retry_check(self):
-        self._message_retry_check_actual(self._out_messages, self._out_message_mutex)
-        self._message_retry_check_actual(self._in_messages, self._in_message_mutex)
+        self._message_retry_check_actual(self._out_messages, self._out_message_mutex, self._out_retry)
+        self._message_retry_check_actual(self._in_messages, self._in_message_mutex, self._in_retry)
 
     def _messages_reconnect_reset_out(self):
         with self._out_message_mutex:
             self._inflight_messages = 0
-            for m in self._out_messages:
+            for m in self._out_messages.values():
                 m.timestamp = 0
                 if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
                     if m.qos == 0:
@@ -2247,10 +2406,10 @@ class Client(object):
 
     def _messages_reconnect_reset_in(self):
         with self._in_message_mutex:
-            for m in self._in_messages:
+            for m in list(self._in_messages.values()):
                 m.timestamp = 0
                 if m.qos != 2:
-                    self._in_messages.pop(self._in_messages.index(m))
+                    del self._in_messages[m.mid]
                 else:
                     # Preserve current state
                     pass
@@ -2259,7 +2418,9 @@ class Client(object):
         self._messages_reconnect_reset_out()
         self._messages_reconnect_reset_in()
 
-    def _packet_queue(self, command, packet, mid, qos, info=None):
+    def _packet_queue(self, command, packet, mid, qos, info=None, batch=None):
+        # batch is a list of (mid, info) for the QoS 0 messages in a packet
+        # that holds multiple PUBLISH packets, see publish_many()
         mpkt = {
             'command': command,
             'mid': mid,
@@ -2267,7 +2428,8 @@ class Client(object):
             'pos': 0,
             'to_process': len(packet),
             'packet': packet,
-            'info': info}
+            'info': info,
+            'batch': batch}
 
         with self._out_packet_mutex:
             self._out_packet.append(mpkt)
@@ -2374,7 +2536,7 @@ class Client(object):
         if result == 0:
             rc = 0
             with self._out_message_mutex:
-                for m in self._out_messages:
+                for m in self._out_messages.values():
                     m.timestamp = time_func()
                     if m.state == mqtt_ms_queued:
                         self.loop_write()  # Process outgoing messages that have just been queued up
@@ -2431,6 +2593,9 @@ class Client(object):
                                 return rc
                     self.loop_write()  # Process outgoing messages that have just been queued up
 
+                # Fill up the inflight window with queued messages
+                rc = self._update_inflight()
+
             return rc
         elif result > 0 and result < 6:
             return MQTT_ERR_CONN_REFUSED
@@ -2460,10 +2625,13 @@ class Client(object):
         message.qos = (header & 0x06) >> 1
         message.retain = (header & 0x01)
 
-        pack_format = "!H" + str(len(self._in_packet['packet']) - 2) + 's'
-        (slen, packet) = struct.unpack(pack_format, self._in_packet['packet'])
-        pack_format = '!' + str(slen) + 's' + str(len(packet) - slen) + 's'
-        (topic, packet) = struct.unpack(pack_format, packet)
+        # Slice the packet and only copy the topic and payload
+        packet = self._in_packet['packet']
+        slen, = struct.unpack_from("!H", packet)
+        if len(packet) < 2 + slen:
+            return MQTT_ERR_PROTOCOL
+        topic = bytes(packet[2:2 + slen])
+        packet = packet[2 + slen:]
 
         if len(topic) == 0:
             return MQTT_ERR_PROTOCOL
@@ -2483,10 +2651,10 @@ class Client(object):
         message.topic = topic
 
         if message.qos > 0:
-            pack_format = "!H" + str(len(packet) - 2) + 's'
-            (message.mid, packet) = struct.unpack(pack_format, packet)
+            message.mid, = struct.unpack_from("!H", packet)
+            packet = packet[2:]
 
-        message.payload = packet
+        message.payload = bytes(packet)
 
         self._easy_log(
             MQTT_LOG_DEBUG,
@@ -2507,8 +2675,9 @@ class Client(object):
             rc = self._send_pubrec(message.mid)
             message.state = mqtt_ms_wait_for_pubrel
             with self._in_message_mutex:
-                if message not in self._in_messages:
-                    self._in_messages.append(message)
+                if message.mid not in self._in_messages:
+                    self._in_messages[message.mid] = message
+                    self._retry_schedule(self._in_retry, message)
             return rc
         else:
             return MQTT_ERR_PROTOCOL
@@ -2521,46 +2690,70 @@ class Client(object):
         self._easy_log(MQTT_LOG_DEBUG, "Received PUBREL (Mid: %d)", mid)
 
         with self._in_message_mutex:
-            for i in range(len(self._in_messages)):
-                if self._in_messages[i].mid == mid:
-
-                    # Only pass the message on if we have removed it from the queue - this
-                    # prevents multiple callbacks for the same message.
-                    self._handle_on_message(self._in_messages[i])
-                    self._in_messages.pop(i)
-                    self._inflight_messages -= 1
-                    if self._max_inflight_messages > 0:
-                        with self._out_message_mutex:
-                            rc = self._update_inflight()
-                        if rc != MQTT_ERR_SUCCESS:
-                            return rc
+            message = self._in_messages.get(mid)
+            if message is not None:
+                # Only pass the message on if we have removed it from the queue - this
+                # prevents multiple callbacks for the same message.
+                self._handle_on_message(message)
+                del self._in_messages[mid]
+                self._inflight_messages -= 1
+                with self._out_message_mutex:
+                    rc = self._update_inflight()
+                if rc != MQTT_ERR_SUCCESS:
+                    return rc
 
-                    return self._send_pubcomp(mid)
+                return self._send_pubcomp(mid)
 
         return MQTT_ERR_SUCCESS
 
+    def _out_messages_len(self):
+        # Number of outgoing QoS>0 messages, including the queued ones
+        return len(self._out_messages) + len(self._out_queue)
+
+    def _can_send_out_message(self, message):
+        # Check if a new outgoing message can be sent right away. It must be
+        # queued if the inflight window is full, if other messages are
+        # queued before it, or if its mid is still in use by a message that
+        # was published more than 65535 messages before it.
+        return (self._window_open()
+                and len(self._out_queue) == 0
+                and message.mid not in self._out_messages)
+
+    def _window_open(self):
+        # Check if there is room in the inflight window, which is unlimited
+        # if max_inflight_messages is 0
+        return (self._max_inflight_messages == 0
+                or self._inflight_messages < self._max_inflight_messages)
+
     def _update_inflight(self):
+        # Send queued messages while there is room in the inflight window.
+        # With an unlimited window, messages are only queued when their mid
+        # collides with a message in flight, and are sent once it is done.
         # Dont lock message_mutex here
-        for m in self._out_messages:
-            if self._inflight_messages < self._max_inflight_messages:
-                if m.qos > 0 and m.state == mqtt_ms_queued:
-                    self._inflight_messages += 1
-                    if m.qos == 1:
-                        m.state = mqtt_ms_wait_for_puback
-                    elif m.qos == 2:
-                        m.state = mqtt_ms_wait_for_pubrec
-                    rc = self._send_publish(
-                        m.mid,
-                        m.topic.encode('utf-8'),
-                        m.payload,
-                        m.qos,
-                        m.retain,
-                        m.dup,
-                    )
-                    if rc != 0:
-                        return rc
-            else:
+        while self._out_queue and self._window_open():
+            m = self._out_queue[0]
+            if m.mid in self._out_messages:
+                # Wait for the message using the same mid to be finished
                 return MQTT_ERR_SUCCESS
+            self._out_queue.popleft()
+            self._out_messages[m.mid] = m
+            m.timestamp = time_func()
+            self._retry_schedule(self._out_retry, m)
+            self._inflight_messages += 1
+            if m.qos == 1:
+                m.state = mqtt_ms_wait_for_puback
+            elif m.qos == 2:
+                m.state = mqtt_ms_wait_for_pubrec
+            rc = self._send_publish(
+                m.mid,
+                m.topic.encode('utf-8'),
+                m.payload,
+                m.qos,
+                m.retain,
+                m.dup,
+            )
+            if rc != 0:
+                return rc
         return MQTT_ERR_SUCCESS
 
     def _handle_pubrec(self):
@@ -2571,11 +2764,11 @@ class Client(object):
         self._easy_log(MQTT_LOG_DEBUG, "Received PUBREC (Mid: %d)", mid)
 
         with self._out_message_mutex:
-            for m in self._out_messages:
-                if m.mid == mid:
-                    m.state = mqtt_ms_wait_for_pubcomp
-                    m.timestamp = time_func()
-                    return self._send_pubrel(mid, False)
+            m = self._out_messages.get(mid)
+            if m is not None:
+                m.state = mqtt_ms_wait_for_pubcomp
+                m.timestamp = time_func()
+                return self._send_pubrel(mid, False)
 
         return MQTT_ERR_SUCCESS
 
@@ -2591,19 +2784,18 @@ class Client(object):
                     self.on_unsubscribe(self, self._userdata, mid)
         return MQTT_ERR_SUCCESS
 
-    def _do_on_publish(self, idx, mid):
+    def _do_on_publish(self, mid):
         with self._callback_mutex:
             if self.on_publish:
                 with self._in_callback:
                     self.on_publish(self, self._userdata, mid)
 
-        msg = self._out_messages.pop(idx)
+        msg = self._out_messages.pop(mid)
         if msg.qos > 0:
             self._inflight_messages -= 1
-            if self._max_inflight_messages > 0:
-                rc = self._update_inflight()
-                if rc != MQTT_ERR_SUCCESS:
-                    return rc
+            rc = self._update_inflight()
+            if rc != MQTT_ERR_SUCCESS:
+                return rc
         msg.info._set_as_published()
         return MQTT_ERR_SUCCESS
 
@@ -2615,16 +2807,10 @@ class Client(object):
         self._easy_log(MQTT_LOG_DEBUG, "Received %s (Mid: %d)", cmd, mid)
 
         with self._out_message_mutex:
-            for i in range(len(self._out_messages)):
-                try:
-                    if self._out_messages[i].mid == mid:
-                        # Only inform the client the message has been sent once.
-                        rc = self._do_on_publish(i, mid)
-                        return rc
-                except IndexError:
-                    # Have removed item so i>count.
-                    # Not really an error.
-                    pass
+            if mid in self._out_messages:
+                # Only inform the client the message has been sent once.
+                rc = self._do_on_publish(mid)
+                return rc
 
         return MQTT_ERR_SUCCESS
 
@@ -26,14 +26,17 @@ import paho.mqtt as mqtt
 def _do_publish(client):
     """Internal function"""
 
-    message = client._userdata.pop()
-
-    if isinstance(message, dict):
-        client.publish(**message)
-    elif isinstance(message, tuple):
-        client.publish(*message)
-    else:
-        raise ValueError('message must be a dict or a tuple')
+    # Publish all messages at once and keep track of the ones that have not
+    # been published yet. Messages the client did not accept are never
+    # published, so waiting for them would never finish.
+    infos = client.publish_many(client._userdata)
+    client.user_data_set(set(info.mid for info in infos
+                             if info.rc == paho.MQTT_ERR_SUCCESS))
+    failed = [info for info in infos if info.rc != paho.MQTT_ERR_SUCCESS]
+    if failed:
+        raise mqtt.MQTTException(
+            "{} of {} messages could not be published: {}".format(
+                len(failed), len(infos), paho.error_string(failed[0].rc)))
 
 
 def _on_connect(client, userdata, flags, rc):
@@ -41,7 +44,7 @@ def _on_connect(client, userdata, flags, rc):
     #pylint: disable=invalid-name, unused-argument
 
     if rc == 0:
-        if len(userdata) > 0:
+        if isinstance(userdata, list) and len(userdata) > 0:
             _do_publish(client)
     else:
         raise mqtt.MQTTException(paho.connack_string(rc))
@@ -51,10 +54,9 @@ def _on_publish(client, userdata, mid):
     """Internal callback"""
     #pylint: disable=unused-argument
 
+    userdata.discard(mid)
     if len(userdata) == 0:
         client.disconnect()
-    else:
-        _do_publish(client)
 
 
 def multiple(msgs, hostname="localhost", port=1883, client_id="", keepalive=60,
@@ -0,0 +1,293 @@
+from collections import OrderedDict, deque
+from threading import Condition, Event, Lock, Thread
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+try:
+    # Use monotonic clock if available
+    time_func = time.monotonic
+except AttributeError:
+    time_func = time.time
+
+class ChangeFilter(object):
+    r"""
+    Only let messages through when their payload changed.
+
+    Keeps the last published payload for every topic. A message is suppressed
+    when its payload equals the last published payload for the topic, or, for
+    topics in `float_topics`, when its value differs less than `deadband` from
+    the last published value. When nothing was published on a topic for
+    `max_silence` seconds, the next message is let through regardless, so
+    subscribers still get a periodic heartbeat. Set `max_silence` to None to
+    disable the heartbeat.
+    """
+    def __init__(self, deadband=0, max_silence=None, float_topics=(),
+                 clock=time_func):
+        self._deadband = deadband
+        self._max_silence = max_silence
+        self._float_topics = frozenset(float_topics)
+        self._clock = clock
+        # Maps topics to tuples of (payload, float value, time published)
+        self._last = {}
+        self.suppressed = 0
+
+    def accept(self, topic, payload):
+        r"""
+        Check if a message should be published
+
+        Returns True if it should, in which case it is recorded as the last
+        published message for the topic.
+        """
+        now = self._clock()
+        last = self._last.get(topic)
+        if last is not None and (self._max_silence is None
+                                 or now - last[2] < self._max_silence):
+            if payload == last[0]:
+                self.suppressed += 1
+                return False
+            if self._deadband and last[1] is not None:
+                try:
+                    if abs(float(payload) - last[1]) < self._deadband:
+                        self.suppressed += 1
+                        return False
+                except ValueError:
+                    pass
+        value = None
+        if topic in self._float_topics:
+            try:
+                value = float(payload)
+            except ValueError:
+                pass
+        self._last[topic] = (payload, value, now)
+        return True
+
+    def reset(self):
+        r"""
+        Forget all published messages, so the next message for every topic is
+        let through
+        """
+        self._last = {}
+
+class PublishBatcher(object):
+    r"""
+    Collect messages and publish them in batches.
+
+    Messages passed to `add` are collected until `window` seconds have passed
+    since the first message of the batch arrived, or until `max_messages`
+    topics are pending. The batch is then passed to `publish` as a list of
+    (topic, payload) tuples from a worker thread. Within a batch, only the
+    newest payload for each topic is kept.
+    """
+    def __init__(self, publish, window=0.05, max_messages=100):
+        self._publish = publish
+        self._window = window
+        self._max_messages = max_messages
+        self._pending = OrderedDict()
+        self._condition = Condition()
+        self._worker_running = False
+        self._worker_thread = None
+
+    def add(self, topic, payload):
+        r"""
+        Add a message to the current batch
+        """
+        with self._condition:
+            pending = self._pending
+            pending[topic] = payload
+            if len(pending) == 1 or len(pending) >= self._max_messages:
+                self._condition.notify()
+
+    def start(self):
+        r"""
+        Start publishing batches
+        """
+        if self._worker_thread:
+            raise RuntimeError("Already running")
+        self._worker_running = True
+        self._worker_thread = Thread(target=self._worker)
+        self._worker_thread.daemon = True
+        self._worker_thread.start()
+
+    def stop(self):
+        r"""
+        Publish the pending messages and stop the worker thread
+        """
+        if not self._worker_thread:
+            raise RuntimeError("Not running")
+        with self._condition:
+            self._worker_running = False
+            self._condition.notify()
+        self._worker_thread.join()
+        self._worker_thread = None
+
+    def _next_batch(self):
+        # Wait for the first message, then for the window to pass or the
+        # batch to fill up
+        with self._condition:
+            while self._worker_running and not self._pending:
+                self._condition.wait()
+            deadline = time_func() + self._window
+            while self._worker_running \
+                    and len(self._pending) < self._max_messages:
+                remaining = deadline - time_func()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = list(self._pending.items())
+            self._pending.clear()
+            return batch
+
+    def _worker(self):
+        while self._worker_running:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self._publish(batch)
+            except Exception as e:
+                # Log a warning when an exception occurs while publishing
+                log.warning(str(e))
+
+class PublishQueue(object):
+    r"""
+    A bounded queue between the OTGW reader and the MQTT publisher.
+
+    Messages passed to `put` are stored in a ring buffer of `maxsize`
+    messages and passed to `publish` from a worker thread, in lists of up to
+    `batch_size` (topic, payload) tuples, so a slow broker connection does
+    not stall reading from the OTGW. When the queue is full, `policy`
+    decides what happens to a new message:
+
+    - "drop-oldest": the oldest queued message is dropped
+    - "keep-latest": only the newest payload for every topic is queued, a new
+      payload replaces a queued one for the same topic. When the queue is
+      full, the oldest topic is dropped
+    - "block": `put` waits until there is space in the queue
+
+    The "drop-oldest" and "block" policies take no locks in `put`. The
+    `queued` and `dropped` counters count the messages that were queued and
+    dropped because the queue was full, `coalesced` counts the messages
+    that replaced a queued payload with the "keep-latest" policy.
+    """
+    policies = ('drop-oldest', 'keep-latest', 'block')
+
+    def __init__(self, publish, maxsize=1000, policy='drop-oldest',
+                 batch_size=100):
+        if policy not in self.policies:
+            raise ValueError("Unknown overflow policy: {}".format(policy))
+        self._publish = publish
+        self._maxsize = maxsize
+        self._policy = policy
+        self._batch_size = batch_size
+        # With the keep-latest policy, the ring buffer holds the topics and
+        # the payloads are kept in a dict
+        self._messages = deque(
+            maxlen=maxsize if policy == 'drop-oldest' else None)
+        self._latest = {}
+        self._lock = Lock()
+        self._ready = Event()
+        self._space = Event()
+        self._worker_running = False
+        self._worker_thread = None
+        self._reported = 0
+        self.queued = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, topic, payload):
+        r"""
+        Queue a message to be published
+        """
+        messages = self._messages
+        if self._policy == 'drop-oldest':
+            if len(messages) >= self._maxsize:
+                self.dropped += 1
+            # The deque drops the oldest message itself
+            messages.append((topic, payload, ))
+        elif self._policy == 'keep-latest':
+            with self._lock:
+                latest = self._latest
+                if topic in latest:
+                    latest[topic] = payload
+                    self.coalesced += 1
+                else:
+                    if len(messages) >= self._maxsize:
+                        del latest[messages.popleft()]
+                        self.dropped += 1
+                    latest[topic] = payload
+                    messages.append(topic)
+        else:
+            while len(messages) >= self._maxsize and self._worker_running:
+                self._space.clear()
+                if len(messages) >= self._maxsize:
+                    self._space.wait(0.1)
+            messages.append((topic, payload, ))
+        self.queued += 1
+        if not self._ready.is_set():
+            self._ready.set()
+
+    def start(self):
+        r"""
+        Start publishing queued messages
+        """
+        if self._worker_thread:
+            raise RuntimeError("Already running")
+        self._worker_running = True
+        self._worker_thread = Thread(target=self._worker)
+        self._worker_thread.daemon = True
+        self._worker_thread.start()
+
+    def stop(self):
+        r"""
+        Publish the queued messages and stop the worker thread
+        """
+        if not self._worker_thread:
+            raise RuntimeError("Not running")
+        self._worker_running = False
+        self._ready.set()
+        self._worker_thread.join()
+        self._worker_thread = None
+
+    def _take(self):
+        # Take up to batch_size messages from the queue
+        batch = []
+        messages = self._messages
+        count = min(len(messages), self._batch_size)
+        if self._policy == 'keep-latest':
+            with self._lock:
+                latest = self._latest
+                for _ in range(count):
+                    topic = messages.popleft()
+                    batch.append((topic, latest.pop(topic), ))
+        else:
+            # Only this thread takes messages, so the deque holds at least
+            # count messages
+            for _ in range(count):
+                batch.append(messages.popleft())
+        return batch
+
+    def _worker(self):
+        while self._worker_running or self._messages:
+            # Clear the flag before checking the queue, so a message queued
+            # after the check sets it again
+            self._ready.clear()
+            batch = self._take()
+            if not batch:
+                if self._worker_running:
+                    self._ready.wait(1)
+                continue
+            self._space.set()
+            if self.dropped != self._reported:
+                log.warning("Publish queue overflowed, dropped {} messages"
+                         .format(self.dropped - self._reported))
+                self._reported = self.dropped
+            try:
+                self._publish(batch)
+            except Exception as e:
+                # Log a warning when an exception occurs while publishing
+                log.warning(str(e))
@@ -0,0 +1,108 @@
+r"""
+A sampling profiler that can be switched on while the bridge is running.
+
+`SamplingProfiler` samples the stacks of all threads with
+`sys._current_frames` every `interval` seconds for a given duration, and
+then writes them to a file in the collapsed stack format that
+flamegraph.pl, speedscope and similar tools read: one line per distinct
+stack, with the thread name and the frames from the outermost to the
+innermost separated by semicolons, followed by the number of samples.
+"""
+from collections import defaultdict
+import logging
+import os
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class SamplingProfiler(object):
+    r"""
+    Sample the stacks of all threads and write them to `directory`
+
+    Profiles are written as `profile-<start time>.folded`. A profile runs for
+    at most `max_duration` seconds.
+    """
+    def __init__(self, directory='profiles', interval=0.01, max_duration=600):
+        self._directory = directory
+        self._interval = interval
+        self._max_duration = max_duration
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        r"""
+        True while a profile is being taken
+        """
+        return self._thread is not None
+
+    def start(self, duration):
+        r"""
+        Start sampling for duration seconds in the background
+
+        Returns False if a profile is already being taken
+        """
+        with self._lock:
+            if self._thread is not None:
+                return False
+            duration = max(0, min(duration, self._max_duration))
+            self._thread = threading.Thread(target=self._worker,
+                                            args=(duration, ))
+            self._thread.daemon = True
+            self._thread.start()
+            return True
+
+    def _worker(self, duration):
+        try:
+            started = time.time()
+            log.info("Profiling for {} seconds".format(duration))
+            stacks, samples = self._sample(duration)
+            path = self._write(stacks, started)
+            log.info("Wrote {} samples to {}".format(samples, path))
+        except Exception as e:
+            log.warning("Profiling failed: {}".format(e))
+        finally:
+            self._thread = None
+
+    def _sample(self, duration):
+        # Count the distinct stacks of all other threads
+        stacks = defaultdict(int)
+        # Cache the labels of the frames, keyed by code object and line
+        labels = {}
+        own = threading.current_thread().ident
+        samples = 0
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            names = dict((thread.ident, thread.name)
+                         for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    key = (frame.f_code, frame.f_lineno)
+                    label = labels.get(key)
+                    if label is None:
+                        label = labels[key] = '{} ({}:{})'.format(
+                            frame.f_code.co_name,
+                            os.path.basename(frame.f_code.co_filename),
+                            frame.f_lineno)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self._interval)
+        return stacks, samples
+
+    def _write(self, stacks, started):
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        path = os.path.join(self._directory, 'profile-{}.folded'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(started))))
+        with open(path, 'w') as f:
+            for stack, count in sorted(stacks.items()):
+                f.write('{} {}\n'.format(stack, count))
+        return path
@@ -0,0 +1,153 @@
+r"""
+Tests for passing the data read from the OTGW on to the listener
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import opentherm
+import opentherm_async
+
+data = b'T80000200\r\nBV: 19.50\r\nB40190000\r\n'
+
+class Recorder(object):
+    def __init__(self):
+        self.lines = []
+
+    def record(self, line):
+        self.lines.append(line)
+
+class CommandQueue(object):
+    def __init__(self):
+        self.responses = []
+
+    def handle_response(self, line):
+        self.responses.append(line)
+
+class BytesTransport(opentherm.OTGWClient):
+    binary = True
+
+class ReaderTransport(opentherm_async.AsyncOTGWClient):
+    async def open_connection(self):
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return reader, None
+
+class DispatchTest(unittest.TestCase):
+    def check_client(self, client, messages):
+        self.assertEqual(client.recorder.lines,
+                         [b'T80000200', b'BV: 19.50', b'B40190000'])
+        self.assertEqual(client.command_queue.responses, [b'BV: 19.50'])
+        expected = list(opentherm.get_messages(b'T80000200'))
+        expected += list(opentherm.get_messages(b'B40190000'))
+        self.assertTrue(expected)
+        self.assertEqual(messages, expected)
+
+    def setup_client(self, client):
+        client.recorder = Recorder()
+        client.command_queue = CommandQueue()
+
+    def test_threaded_client(self):
+        messages = []
+        client = BytesTransport(messages.append)
+        self.setup_client(client)
+        # Split a line over two reads
+        client.handle_data(data[:15])
+        client.handle_data(data[15:])
+        self.check_client(client, messages)
+
+    def test_asyncio_client(self):
+        messages = []
+        client = ReaderTransport(messages.append)
+        self.setup_client(client)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(client._read_messages(
+                loop.run_until_complete(client.open_connection())[0]))
+        finally:
+            loop.close()
+        self.check_client(client, messages)
+
+    def test_listener_errors_are_counted(self):
+        def listener(msg):
+            raise ValueError("Listener failed")
+        before = opentherm.listener_errors.value()
+        opentherm.dispatch_data(data, opentherm.LineFramer(binary=True),
+                                listener)
+        count = len(list(opentherm.get_messages(b'T80000200')))
+        count += len(list(opentherm.get_messages(b'B40190000')))
+        self.assertEqual(opentherm.listener_errors.value() - before, count)
+
+try:
+    import tty
+    from opentherm_serial import OTGWSerialClient
+except ImportError:
+    OTGWSerialClient = None
+else:
+    class CountingSerialClient(OTGWSerialClient):
+        # Counts the calls to open and the reads that failed
+        def __init__(self, *args, **kwargs):
+            super(CountingSerialClient, self).__init__(*args, **kwargs)
+            self.opens = 0
+            self.failed_reads = 0
+
+        def open(self):
+            self.opens += 1
+            super(CountingSerialClient, self).open()
+
+        def read(self, timeout):
+            try:
+                return super(CountingSerialClient, self).read(timeout)
+            except Exception:
+                self.failed_reads += 1
+                raise
+
+@unittest.skipIf(OTGWSerialClient is None, "Requires pyserial and ptys")
+class SupervisorTest(unittest.TestCase):
+    def open_pty(self):
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        return master, slave
+
+    def test_failed_client_is_reopened(self):
+        broken_master, broken_slave = self.open_pty()
+        master, slave = self.open_pty()
+        messages = []
+        received = threading.Event()
+        def listener(msg):
+            messages.append(msg)
+            received.set()
+        broken = CountingSerialClient(None, device=os.ttyname(broken_slave))
+        working = CountingSerialClient(listener, device=os.ttyname(slave))
+        supervisor = opentherm.OTGWSupervisor([broken, working],
+                                              reopen_delay=0.3)
+        supervisor.start()
+        try:
+            time.sleep(0.2)
+            self.assertEqual((broken.opens, working.opens), (1, 1))
+            # Break one gateway, so reading from it fails
+            os.close(broken_slave)
+            os.close(broken_master)
+            time.sleep(1)
+            # It is not read from in a busy loop, but closed and reopened
+            self.assertGreaterEqual(broken.failed_reads, 1)
+            self.assertLess(broken.failed_reads, 5)
+            self.assertGreaterEqual(broken.opens, 2)
+            # The other gateway is still read from
+            os.write(master, b'B40190000\r\n')
+            self.assertTrue(received.wait(2))
+            self.assertEqual(working.opens, 1)
+            self.assertEqual(working.failed_reads, 0)
+        finally:
+            supervisor.stop()
+            os.close(master)
+            os.close(slave)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+r"""
+Tests for the OTGW commands and routing MQTT messages to them
+"""
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import paho.mqtt.client as mqtt
+import opentherm
+import opentherm_commands
+from opentherm_commands import CommandQueue, CommandRouter, coalesce_key, \
+    commands, encode_command
+
+# Payloads and the commands they are sent as, per topic
+valid_payloads = {
+    "room_setpoint/temporary": [(b'19.5', 'TT=19.50'), (b' 20 ', 'TT=20.00'),
+                                (b'0', 'TT=0.00'), (b'', 'TT=0.00'),
+                                (b'cancel', 'TT=0.00')],
+    "room_setpoint/constant": [(b'30', 'TC=30.00'), (b'', 'TC=0.00')],
+    "room_setpoint/setback": [(b'16', 'SB=16.00')],
+    "outside_temperature": [(b'-12.25', 'OT=-12.25'), (b'', 'OT=99.00')],
+    "clock": [(b'07:30/1', 'SC=07:30/1'), (b'23:59/7', 'SC=23:59/7')],
+    "hot_water/enable": [(b'1', 'HW=1'), (b'true', 'HW=1'),
+                         (b'no', 'HW=0'), (b'P', 'HW=P'),
+                         (b'auto', 'HW=T')],
+    "hot_water/temperature": [(b'55', 'SW=55.00'), (b'', 'SW=60.00')],
+    "central_heating/enable": [(b'0', 'CH=0'), (b'false', 'CH=0'),
+                               (b'on', 'CH=1')],
+    "central_heating_2/enable": [(b'yes', 'H2=1')],
+    "max_modulation": [(b'0', 'MM=0'), (b'100', 'MM=100')],
+    "reset_counter": [(b'HBS', 'RS=HBS')],
+    "gateway/mode": [(b'R', 'GW=R'), (b'True', 'GW=1')],
+    "gateway/report": [(b'A', 'PR=A')],
+    "gateway/led/a": [(b'F', 'LA=F')],
+    "gateway/gpio/b": [(b'7', 'GB=7')],
+    "gateway/priority_message": [(b'0', 'PM=0'), (b'255', 'PM=255')],
+    "gateway/response/set": [(b'70:14', 'SR=70:14'),
+                             (b'70:14,2', 'SR=70:14,2')],
+    "gateway/response/clear": [(b'70', 'CR=70')],
+}
+
+invalid_payloads = {
+    "room_setpoint/temporary": [b'31', b'-1', b'nan'],
+    "room_setpoint/setback": [b'', b'warm'],
+    "outside_temperature": [b'-41', b'100'],
+    "clock": [b'', b'24:00/1', b'07:30', b'07:30/8'],
+    "hot_water/temperature": [b'101'],
+    "central_heating_2/enable": [b'', b'on'],
+    "max_modulation": [b'', b'101', b'1.5', b'-1'],
+    "ventilation_setpoint": [b'fast'],
+    "reset_counter": [b'ABC'],
+    "gateway/mode": [b'X'],
+    "gateway/report": [b'Z', b'AB'],
+    "gateway/thermostat_model": [b'X'],
+    "gateway/reference_voltage": [b'10'],
+    "gateway/led/a": [b'Z'],
+    "gateway/gpio/a": [b'8'],
+    "gateway/alternative/add": [b'0', b'256'],
+    "gateway/priority_message": [b'256'],
+    "gateway/response/set": [b'', b'70', b'70:14,', b'a:b'],
+    "gateway/response/clear": [b'0'],
+}
+
+class Gateway(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+def message(topic, payload):
+    msg = mqtt.MQTTMessage(topic=topic.encode('utf-8'))
+    msg.payload = payload
+    return msg
+
+class CommandTest(unittest.TestCase):
+    def test_valid_payloads(self):
+        for topic, cases in valid_payloads.items():
+            code, parser = commands[topic]
+            for payload, command in cases:
+                self.assertEqual(encode_command(code, parser, payload),
+                                 command, (topic, payload))
+
+    def test_invalid_payloads(self):
+        for topic, payloads in invalid_payloads.items():
+            code, parser = commands[topic]
+            for payload in payloads:
+                self.assertRaises(ValueError, encode_command, code, parser,
+                                  payload)
+
+    def test_raw_command(self):
+        parser = opentherm_commands.raw_command
+        self.assertEqual(encode_command('PS', parser, b'1'), 'PS=1')
+        self.assertEqual(encode_command('XX', parser, b''), 'XX=')
+        self.assertRaises(ValueError, encode_command, 'PS', parser,
+                          b'1\rGW=0')
+        for code in ('PS', 'C2', 'TT'):
+            self.assertTrue(opentherm_commands.raw_code.match(code))
+        for code in ('', 'P', 'ps', '2C', 'PSX', 'P-', '+'):
+            self.assertFalse(opentherm_commands.raw_code.match(code), code)
+
+class CommandRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.client = mqtt.Client('test')
+        self.router = CommandRouter(self.client)
+        self.house = Gateway()
+        self.garage = Gateway()
+        self.router.add('set/otgw/house', self.house)
+        self.router.add('set/otgw/garage', self.garage)
+
+    def deliver(self, topic, payload):
+        self.client._handle_on_message(message(topic, payload))
+
+    def test_routes_to_gateway(self):
+        self.deliver('set/otgw/house/room_setpoint/temporary', b'19.5')
+        self.deliver('set/otgw/garage/hot_water/enable', b'0')
+        self.assertEqual(self.house.written, ['TT=19.50\r'])
+        self.assertEqual(self.garage.written, ['HW=0\r'])
+
+    def test_invalid_payload_is_dropped(self):
+        self.deliver('set/otgw/house/max_modulation', b'fast')
+        self.deliver('set/otgw/house/unknown', b'1')
+        self.assertEqual(self.house.written, [])
+
+    def test_raw(self):
+        self.deliver('set/otgw/house/raw/PS', b'1')
+        self.deliver('set/otgw/house/raw/ps', b'1')
+        self.deliver('set/otgw/house/raw/PSX', b'1')
+        self.deliver('set/otgw/house/raw/GW', b'1\rPS=1')
+        self.assertEqual(self.house.written, ['PS=1\r'])
+
+    def test_remove(self):
+        self.router.remove()
+        self.deliver('set/otgw/house/room_setpoint/temporary', b'19.5')
+        self.assertEqual(self.house.written, [])
+        self.assertEqual(self.router.topics, [])
+
+class RespondingGateway(object):
+    r"""
+    Passes the response to every command written to it through
+    `dispatch_data`, like an OTGW client reading it from the gateway
+    """
+    def __init__(self, responses):
+        self.queue = None
+        self.written = []
+        self.messages = []
+        self._responses = responses
+        self._framer = opentherm.LineFramer(binary=True)
+
+    def write(self, data):
+        self.written.append(data)
+        response = self._responses.get(data.rstrip('\r'))
+        if response is not None:
+            opentherm.dispatch_data(response, self._framer,
+                                    self.messages.append,
+                                    command_queue=self.queue)
+
+class CommandQueueTest(unittest.TestCase):
+    def run_queue(self, gateway, writes, timeout=1):
+        # Queue the commands before starting, and wait for all results
+        results = []
+        done = threading.Event()
+        def on_result(command, status, response, latency):
+            results.append((command, status, response, ))
+            if len(results) == expected:
+                done.set()
+        queue = CommandQueue(gateway.write, on_result, timeout=timeout)
+        gateway.queue = queue
+        for data in writes:
+            queue.write(data)
+        expected = len(queue._pending)
+        queue.start()
+        try:
+            self.assertTrue(done.wait(5))
+        finally:
+            queue.stop()
+        return queue, results
+
+    def test_coalesce_keys(self):
+        self.assertEqual(coalesce_key('TT=19.50'), 'TT')
+        self.assertEqual(coalesce_key('PR=A'), 'PR=A')
+        self.assertEqual(coalesce_key('SR=70:14'), 'SR=70')
+        self.assertEqual(coalesce_key('SR=70:14,2'), 'SR=70')
+        self.assertEqual(coalesce_key('CR=70'), 'CR=70')
+
+    def test_coalescing_keeps_position(self):
+        gateway = RespondingGateway({
+            'TT=21.00': b'TT: 21.00\r\n', 'CH=1': b'CH: 1\r\n'})
+        queue, results = self.run_queue(
+            gateway, ['TT=19.00\r', 'CH=1\r', 'TT=20.00\r', 'TT=21.00\r'])
+        self.assertEqual(gateway.written, ['TT=21.00\r', 'CH=1\r'])
+        self.assertEqual(queue.coalesced, 2)
+        self.assertEqual(results, [('TT=21.00', 'ok', '21.00'),
+                                   ('CH=1', 'ok', '1')])
+
+    def test_per_value_commands_are_not_coalesced(self):
+        gateway = RespondingGateway({
+            'PR=A': b'PR: A=OpenTherm Gateway 4.2\r\n',
+            'PR=B': b'PR: B=17:35 25-01-2018\r\n',
+            'SR=70:14': b'SR: 70:14\r\n', 'SR=71:1': b'SR: 71:1\r\n'})
+        queue, results = self.run_queue(
+            gateway, ['PR=A', 'PR=B', 'PR=A', 'SR=70:1', 'SR=71:1',
+                      'SR=70:14'])
+        self.assertEqual(gateway.written, ['PR=A\r', 'PR=B\r',
+                                           'SR=70:14\r', 'SR=71:1\r'])
+        self.assertEqual(queue.coalesced, 2)
+        self.assertEqual([status for _, status, _ in results], ['ok'] * 4)
+
+    def test_error_response(self):
+        gateway = RespondingGateway({'TT=19.00': b'BV\r\n'})
+        queue, results = self.run_queue(gateway, ['TT=19.00'])
+        self.assertEqual(results, [('TT=19.00', 'error', 'BV')])
+        # The response is not decoded as a message
+        self.assertEqual(gateway.messages, [])
+
+    def test_timeout(self):
+        gateway = RespondingGateway({})
+        queue, results = self.run_queue(gateway, ['TT=19.00'],
+                                         timeout=0.1)
+        self.assertEqual(results, [('TT=19.00', 'timeout', None)])
+
+    def test_late_response_is_not_matched(self):
+        gateway = RespondingGateway({'CH=1': b'CH: 1\r\n'})
+        queue = CommandQueue(gateway.write, timeout=0.1)
+        gateway.queue = queue
+        # Step through the worker by hand
+        queue._worker_running = True
+        # Nothing is in flight
+        self.assertFalse(queue.handle_response(b'TT: 19.00'))
+        queue.write('TT=19.00')
+        self.assertEqual(queue._next()[0], 'TT=19.00')
+        self.assertEqual(queue._wait_response(), ('timeout', None))
+        # The response to TT arrives while CH waits for its response
+        queue.write('CH=1')
+        self.assertEqual(queue._next()[0], 'CH=1')
+        self.assertFalse(queue.handle_response(b'TT: 19.00'))
+        self.assertTrue(queue.handle_response(b'CH: 1'))
+        self.assertEqual(queue._wait_response(), ('ok', '1'))
+
+if __name__ == '__main__':
+    unittest.main()
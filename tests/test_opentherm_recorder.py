@@ -0,0 +1,108 @@
+r"""
+Tests for recording the raw frames read from the OTGW
+"""
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import opentherm
+from opentherm_recorder import FrameReader, FrameRecorder, read_recording, \
+    segments
+
+# Lines from every source, with their times in seconds since the epoch
+lines = [
+    (1500000000.000, 'T80000200'),
+    (1500000000.125, 'B40000200'),
+    (1500000001.5, 'R90190000'),
+    (1500000002.001, 'AC0181325'),
+]
+
+class FrameRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_lines(self, path):
+        with FrameReader(path) as reader:
+            return [line for _, line in reader.lines()]
+
+    def record(self, lines, **kwargs):
+        recorder = FrameRecorder(self.directory, **kwargs)
+        for timestamp, line in lines:
+            recorder.record(line, timestamp)
+        recorder.start()
+        recorder.stop()
+        return recorder
+
+    def test_round_trip(self):
+        # Lines that are not frames are not recorded
+        recorder = self.record(lines + [(1500000003, 'XYZ'),
+                                        (1500000003, 'TT: 19.50')])
+        self.assertEqual(recorder.recorded, len(lines))
+        paths = segments(self.directory)
+        self.assertEqual(len(paths), 1)
+        with FrameReader(paths[0]) as reader:
+            self.assertEqual(len(reader), len(lines))
+            self.assertEqual(reader.start, 1500000000000)
+            self.assertEqual(list(reader.lines()), lines)
+            self.assertEqual(
+                list(reader),
+                [(timestamp, opentherm.decode_frame(line))
+                 for timestamp, line in lines])
+
+    def test_source_in_high_bits(self):
+        self.record(lines)
+        with open(segments(self.directory)[0], 'rb') as f:
+            data = f.read()
+        self.assertEqual(data[:8], b'OTGWRAW1')
+        self.assertEqual(len(data), 16 + 8 * len(lines))
+        for index, (timestamp, line) in enumerate(lines):
+            offset, frame = struct.unpack_from('<II', data, 16 + 8 * index)
+            self.assertEqual(offset >> 30, 'BART'.index(line[0]))
+            self.assertEqual(offset & ((1 << 30) - 1),
+                             int(round(timestamp * 1000)) - 1500000000000)
+            self.assertEqual(frame, int(line[1:], 16))
+
+    def test_rotate_on_segment_size(self):
+        # Room for the header and two records
+        self.record(lines, segment_size=16 + 8 * 2)
+        paths = segments(self.directory)
+        self.assertEqual(len(paths), 2)
+        self.assertEqual([self.read_lines(path) for path in paths],
+                         [['T80000200', 'B40000200'],
+                          ['R90190000', 'AC0181325']])
+        # The segments are read back in order
+        self.assertEqual([(timestamp, '{}{:08X}'.format(source, frame))
+                          for timestamp, source, frame in
+                          read_recording(self.directory, raw=True)],
+                         lines)
+
+    def test_rotate_on_offset_overflow(self):
+        start = 1500000000.
+        # The offset of the second frame does not fit in 30 bits, and the
+        # third frame is older than the start of the second segment
+        self.record([(start, 'T80000200'),
+                     (start + (1 << 30) / 1000., 'B40000200'),
+                     (start + 1, 'T80190000')])
+        paths = segments(self.directory)
+        self.assertEqual(len(paths), 3)
+        # The segments are named after their start time
+        self.assertEqual([self.read_lines(path) for path in paths],
+                         [['T80000200'], ['T80190000'], ['B40000200']])
+
+    def test_max_segments(self):
+        self.record(lines, segment_size=16 + 8, max_segments=2)
+        paths = segments(self.directory)
+        self.assertEqual(len(paths), 2)
+        self.assertEqual([self.read_lines(path) for path in paths],
+                         [['R90190000'], ['AC0181325']])
+
+if __name__ == '__main__':
+    unittest.main()
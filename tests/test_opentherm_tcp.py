@@ -0,0 +1,140 @@
+r"""
+Tests for the TCP client against a local socket server
+"""
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from opentherm_tcp import OTGWTcpClient
+
+def listening_socket():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    return server
+
+def closed_port():
+    # A port nothing listens on
+    server = listening_socket()
+    port = server.getsockname()[1]
+    server.close()
+    return port
+
+def read_until(client, expected, timeout=5):
+    # Read from the client until the data ends with expected
+    data = b''
+    deadline = time.time() + timeout
+    while not data.endswith(expected) and time.time() < deadline:
+        data += client.read(0.05)
+    return data
+
+class RecordingClient(OTGWTcpClient):
+    # Records the delay before every new connection attempt
+    def __init__(self, *args, **kwargs):
+        super(RecordingClient, self).__init__(*args, **kwargs)
+        self.delays = []
+
+    def _connect_failed(self, reason):
+        super(RecordingClient, self)._connect_failed(reason)
+        self.delays.append(self._reconnect_delay)
+
+class TcpClientTest(unittest.TestCase):
+    def test_backoff(self):
+        client = RecordingClient(None, host='127.0.0.1', port=closed_port(),
+                                 reconnect_min_delay=0.05,
+                                 reconnect_max_delay=0.2)
+        started = time.time()
+        while len(client.delays) < 5 and time.time() - started < 5:
+            client.read(0.01)
+        # The first attempt is not delayed
+        self.assertGreaterEqual(time.time() - started, 0.05 + 0.1 + 0.2 + 0.2)
+        self.assertEqual(client.delays, [0.05, 0.1, 0.2, 0.2, 0.2])
+        self.assertIsNone(client.fileno())
+
+    def test_reconnect(self):
+        server = listening_socket()
+        client = OTGWTcpClient(None, host='127.0.0.1',
+                               port=server.getsockname()[1],
+                               reconnect_min_delay=0.05)
+        try:
+            client.open()
+            conn, _ = server.accept()
+            conn.sendall(b'T80000200\r\n')
+            self.assertEqual(read_until(client, b'\r\n'), b'T80000200\r\n')
+
+            # The gateway drops the connection
+            conn.close()
+            started = time.time()
+            while client.fileno() is not None and time.time() - started < 5:
+                self.assertEqual(client.read(0.05), b'')
+            self.assertIsNone(client.fileno())
+
+            # Reading reconnects after the backoff
+            started = time.time()
+            while client.fileno() is None and time.time() - started < 5:
+                client.read(0.01)
+            self.assertGreaterEqual(time.time() - started, 0.04)
+            conn, _ = server.accept()
+            conn.sendall(b'B40190000\r\n')
+            self.assertEqual(read_until(client, b'\r\n'), b'B40190000\r\n')
+            conn.close()
+        finally:
+            client.close()
+            server.close()
+
+    def test_partial_writes(self):
+        server = listening_socket()
+        client = OTGWTcpClient(None, host='127.0.0.1',
+                               port=server.getsockname()[1],
+                               write_timeout=0.5)
+        try:
+            client.open()
+            conn, _ = server.accept()
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            client._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                      4096)
+            command = 'X' * (4 << 20)
+
+            # A gateway that does not read makes the write time out
+            self.assertRaises(socket.timeout, client.write, command)
+            conn.close()
+            client.close()
+
+            # A gateway that reads slowly gets all the data, in order
+            client._next_connect = 0
+            client.open()
+            conn, _ = server.accept()
+            client._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                      4096)
+            received = []
+            def receive():
+                while True:
+                    data = conn.recv(1024)
+                    if not data:
+                        return
+                    received.append(data)
+                    if len(received) % 64 == 0:
+                        time.sleep(0.001)
+            reader = threading.Thread(target=receive)
+            reader.start()
+            client._args['write_timeout'] = 30
+            command = ''.join(chr(ord('a') + i % 26)
+                              for i in range(1 << 20))
+            client.write(command)
+            client.close()
+            reader.join(10)
+            self.assertEqual(b''.join(received),
+                             command.encode('ascii') + b'\r\n')
+            conn.close()
+        finally:
+            client.close()
+            server.close()
+
+if __name__ == '__main__':
+    unittest.main()
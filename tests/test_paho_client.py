@@ -0,0 +1,169 @@
+r"""
+Regression tests for the changes to the vendored paho client
+"""
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import paho.mqtt as paho
+import paho.mqtt.client as mqtt
+import paho.mqtt.publish as publish
+
+class FakeSocket(object):
+    r"""
+    Accepts everything the client sends and collects the mids of the QoS 1
+    PUBLISH packets in it
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self.mids = []
+
+    def send(self, data):
+        self._buffer += data
+        buf = self._buffer
+        pos = 0
+        while len(buf) - pos >= 2:
+            # Decode the remaining length
+            length = 0
+            mult = 1
+            i = pos + 1
+            while i < len(buf):
+                length += (buf[i] & 127) * mult
+                mult *= 128
+                i += 1
+                if not buf[i - 1] & 128:
+                    break
+            else:
+                break
+            if len(buf) - i < length:
+                break
+            if buf[pos] & 0xF6 == mqtt.PUBLISH | 2:
+                topic_length, = struct.unpack_from('!H', buf, i)
+                mid, = struct.unpack_from('!H', buf, i + 2 + topic_length)
+                self.mids.append(mid)
+            pos = i + length
+        del buf[:pos]
+        return len(data)
+
+    def close(self):
+        pass
+
+def connected_client():
+    client = mqtt.Client('test')
+    client._sock = FakeSocket()
+    client._state = mqtt.mqtt_cs_connected
+    return client
+
+def ack(client, mid):
+    client._in_packet['command'] = mqtt.PUBACK
+    client._in_packet['remaining_length'] = 2
+    client._in_packet['packet'] = struct.pack('!H', mid)
+    return client._packet_handle()
+
+class InflightTest(unittest.TestCase):
+    def check_mid_collision(self, max_inflight):
+        client = connected_client()
+        client.max_inflight_messages_set(max_inflight)
+        sock = client._sock
+        # Keep the first message in flight while the mids wrap around
+        first = client.publish('test', b'0', qos=1)
+        for i in range(65534):
+            info = client.publish('test', b'1', qos=1)
+            self.assertEqual(ack(client, info.mid), mqtt.MQTT_ERR_SUCCESS)
+        sock.mids = []
+        # The next message gets the mid of the first one
+        colliding = client.publish('test', b'2', qos=1)
+        self.assertEqual(colliding.mid, first.mid)
+        self.assertEqual(sock.mids, [])
+        self.assertEqual(len(client._out_queue), 1)
+
+        # Finishing the first message sends the queued one
+        ack(client, first.mid)
+        self.assertEqual(sock.mids, [first.mid])
+        self.assertEqual(len(client._out_queue), 0)
+        ack(client, colliding.mid)
+        self.assertTrue(colliding.is_published())
+
+        # And later messages are sent right away
+        later = client.publish('test', b'3', qos=1)
+        self.assertEqual(sock.mids, [first.mid, later.mid])
+        ack(client, later.mid)
+        self.assertEqual(client._out_messages_len(), 0)
+        self.assertEqual(client._inflight_messages, 0)
+
+    def test_mid_collision_unlimited_window(self):
+        self.check_mid_collision(0)
+
+    def test_mid_collision_limited_window(self):
+        self.check_mid_collision(20)
+
+def publish_packet(topic, payload):
+    # A QoS 0 PUBLISH packet as the broker sends it
+    body = struct.pack('!H', len(topic)) + topic + payload
+    header = bytearray([mqtt.PUBLISH])
+    length = len(body)
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 128 if length else byte)
+        if not length:
+            return bytes(header) + body
+
+class ChunkedSocket(FakeSocket):
+    r"""
+    Returns the data it was given in chunks of at most size bytes
+    """
+    def __init__(self, data, size):
+        super(ChunkedSocket, self).__init__()
+        self._chunks = [data[i:i + size] for i in range(0, len(data), size)]
+
+    def recv(self, bufsize):
+        return self._chunks.pop(0)
+
+class PacketReadTest(unittest.TestCase):
+    def check_read(self, packets, size):
+        client = connected_client()
+        received = []
+        client.on_message = lambda client, userdata, msg: received.append(
+            (msg.topic, msg.payload, ))
+        data = b''.join(publish_packet(topic.encode('utf-8'), payload)
+                        for topic, payload in packets)
+        client._sock = sock = ChunkedSocket(data, size)
+        while sock._chunks:
+            self.assertEqual(client._packet_read(), mqtt.MQTT_ERR_SUCCESS)
+        self.assertEqual(received, packets)
+        self.assertEqual(len(client._in_buffer), 0)
+
+    def test_large_packet_in_small_reads(self):
+        payload = bytes(bytearray(i % 256 for i in range(200000)))
+        self.check_read([('big', payload), ('small', b'1')], 1000)
+
+    def test_packets_split_across_reads(self):
+        packets = [('test/{}'.format(i), str(i).encode('ascii') * i)
+                   for i in range(200)]
+        for size in (1, 7, 64, 1 << 20):
+            self.check_read(packets, size)
+
+class PublishMultipleTest(unittest.TestCase):
+    def test_rejected_messages_are_not_waited_for(self):
+        client = connected_client()
+        client.max_queued_messages_set(2)
+        client.user_data_set([('test', str(i), 1) for i in range(3)])
+        with self.assertRaises(paho.MQTTException):
+            publish._do_publish(client)
+        # Only the accepted messages are waited for
+        self.assertEqual(client._userdata, set(client._out_messages))
+        self.assertEqual(len(client._userdata), 2)
+
+    def test_accepted_messages_are_waited_for(self):
+        client = connected_client()
+        client.user_data_set([('test', str(i), 1) for i in range(3)])
+        publish._do_publish(client)
+        self.assertEqual(client._userdata, set(client._out_messages))
+        self.assertEqual(len(client._userdata), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+r"""
+Tests for the change filter, the publish batcher and the publish queue
+"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pipeline import ChangeFilter, PublishBatcher, PublishQueue
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+class ChangeFilterTest(unittest.TestCase):
+    def test_unchanged_payloads_are_suppressed(self):
+        change_filter = ChangeFilter()
+        self.assertTrue(change_filter.accept('a', b'1'))
+        self.assertFalse(change_filter.accept('a', b'1'))
+        self.assertTrue(change_filter.accept('b', b'1'))
+        self.assertTrue(change_filter.accept('a', b'2'))
+        self.assertTrue(change_filter.accept('a', b'1'))
+        self.assertEqual(change_filter.suppressed, 1)
+
+    def test_deadband_applies_to_float_topics_only(self):
+        change_filter = ChangeFilter(deadband=0.5, float_topics=['t'])
+        self.assertTrue(change_filter.accept('t', b'20.00'))
+        self.assertFalse(change_filter.accept('t', b'20.10'))
+        # The difference is taken from the last published value
+        self.assertFalse(change_filter.accept('t', b'20.40'))
+        self.assertFalse(change_filter.accept('t', b'19.60'))
+        self.assertTrue(change_filter.accept('t', b'20.50'))
+        self.assertTrue(change_filter.accept('t', b'20.00'))
+        # Other topics are published on every change
+        self.assertTrue(change_filter.accept('n', b'20'))
+        self.assertTrue(change_filter.accept('n', b'21'))
+        self.assertTrue(change_filter.accept('n', b'20'))
+        self.assertEqual(change_filter.suppressed, 3)
+
+    def test_max_silence_heartbeat(self):
+        clock = Clock()
+        change_filter = ChangeFilter(max_silence=300, clock=clock)
+        self.assertTrue(change_filter.accept('a', b'1'))
+        clock.now = 299.
+        self.assertFalse(change_filter.accept('a', b'1'))
+        clock.now = 300.
+        self.assertTrue(change_filter.accept('a', b'1'))
+        # The heartbeat starts a new period
+        clock.now = 599.
+        self.assertFalse(change_filter.accept('a', b'1'))
+        clock.now = 600.
+        self.assertTrue(change_filter.accept('a', b'1'))
+
+    def test_no_heartbeat_without_max_silence(self):
+        clock = Clock()
+        change_filter = ChangeFilter(clock=clock)
+        self.assertTrue(change_filter.accept('a', b'1'))
+        clock.now = 1e6
+        self.assertFalse(change_filter.accept('a', b'1'))
+
+    def test_reset(self):
+        change_filter = ChangeFilter(deadband=1, float_topics=['t'])
+        self.assertTrue(change_filter.accept('a', b'1'))
+        self.assertTrue(change_filter.accept('t', b'20.00'))
+        change_filter.reset()
+        self.assertTrue(change_filter.accept('a', b'1'))
+        self.assertTrue(change_filter.accept('t', b'20.10'))
+
+class PublishBatcherTest(unittest.TestCase):
+    def next_batch(self, batcher):
+        # Take a batch like the worker thread does
+        batcher._worker_running = True
+        started = time.time()
+        return batcher._next_batch(), time.time() - started
+
+    def test_newest_payload_per_topic(self):
+        batcher = PublishBatcher(None, window=0.05)
+        batcher.add('a', '1')
+        batcher.add('b', '1')
+        batcher.add('a', '2')
+        batch, elapsed = self.next_batch(batcher)
+        # A topic keeps the position of its first message
+        self.assertEqual(batch, [('a', '2'), ('b', '1')])
+        self.assertGreaterEqual(elapsed, 0.04)
+
+    def test_flush_at_max_messages(self):
+        batcher = PublishBatcher(None, window=10, max_messages=3)
+        for topic in 'abc':
+            batcher.add(topic, '1')
+        batch, elapsed = self.next_batch(batcher)
+        self.assertEqual([topic for topic, _ in batch], list('abc'))
+        self.assertLess(elapsed, 1)
+
+    def test_publish_from_worker(self):
+        batches = []
+        batcher = PublishBatcher(batches.append, window=10, max_messages=2)
+        batcher.start()
+        try:
+            batcher.add('a', '1')
+            batcher.add('b', '1')
+            deadline = time.time() + 5
+            while not batches and time.time() < deadline:
+                time.sleep(0.01)
+            batcher.add('c', '1')
+        finally:
+            # Stopping publishes the pending messages
+            batcher.stop()
+        self.assertEqual(batches, [[('a', '1'), ('b', '1')], [('c', '1')]])
+
+class PublishQueueTest(unittest.TestCase):
+    def test_keep_latest_counts_replacements_as_coalesced(self):
+        queue = PublishQueue(lambda batch: None, maxsize=2,
+                             policy='keep-latest')
+        queue.put('a', '1')
+        queue.put('a', '2')
+        queue.put('b', '1')
+        self.assertEqual(queue.coalesced, 1)
+        self.assertEqual(queue.dropped, 0)
+        self.assertEqual(queue._take(), [('a', '2'), ('b', '1')])
+
+    def test_keep_latest_counts_evictions_as_dropped(self):
+        queue = PublishQueue(lambda batch: None, maxsize=2,
+                             policy='keep-latest')
+        queue.put('a', '1')
+        queue.put('b', '1')
+        queue.put('c', '1')
+        self.assertEqual(queue.coalesced, 0)
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(queue._take(), [('b', '1'), ('c', '1')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,260 @@
+r"""
+Latency tracing of messages on their way from the OTGW to the broker.
+
+A `Tracer` follows every message through the stages of the bridge and
+records the time spent in each stage in a `LatencyHistogram`:
+
+- `decode`: from the read returning the data to the message being passed
+  to the listener
+- `queue`: from the listener to leaving the publish queue and the change
+  filter
+- `batch`: waiting in the publish batcher
+- `publish`: handing the message to the MQTT client, which serialises and
+  queues the packet
+- `write`: from the packet being queued to it being written to the socket,
+  or for QoS 1 and 2 to it being acknowledged by the broker
+- `total`: from the read returning the data to the end of `write`
+
+Messages are traced by topic (and by message id once they are handed to
+the MQTT client), so tracing does not change what is passed between the
+stages. When a topic is read again before its previous message is
+published, the newest message is traced.
+"""
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+try:
+    # Use monotonic clock if available
+    time_func = time.monotonic
+except AttributeError:
+    time_func = time.time
+
+# The stages a message passes, in order
+stages = ('decode', 'queue', 'batch', 'publish', 'write', 'total')
+
+class LatencyHistogram(object):
+    r"""
+    A histogram of latencies with a fixed relative precision, like an HDR
+    histogram.
+
+    Latencies are counted in whole microseconds. Every power of two range
+    is split into 2 ** `precision_bits` buckets of equal width, so the
+    value of a bucket is off by less than 1 / 2 ** `precision_bits` of the
+    latency. The buckets are allocated up front for latencies up to
+    2 ** `max_bits` microseconds (about 36 minutes by default), longer
+    latencies count in the last bucket.
+    """
+    def __init__(self, precision_bits=4, max_bits=31):
+        self._sub_buckets = 1 << precision_bits
+        self._precision_bits = precision_bits
+        self._counts = [0] * ((max_bits - precision_bits + 1)
+                              * self._sub_buckets)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def _index(self, us):
+        # Values below 2 * sub_buckets map to themselves, larger values are
+        # shifted down to their top precision_bits + 1 bits
+        shift = us.bit_length() - self._precision_bits - 1
+        if shift <= 0:
+            return us
+        return min((shift + 1) * self._sub_buckets
+                   + (us >> shift) - self._sub_buckets,
+                   len(self._counts) - 1)
+
+    def _value(self, index):
+        # The lowest latency in microseconds that counts in a bucket
+        if index < 2 * self._sub_buckets:
+            return index
+        shift = index // self._sub_buckets - 1
+        return (index % self._sub_buckets + self._sub_buckets) << shift
+
+    def record(self, seconds):
+        r"""
+        Count a latency in seconds
+        """
+        self._counts[self._index(max(0, int(seconds * 1e6)))] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        r"""
+        Get the latency in seconds that p percent of the latencies is at most
+
+        Returns 0 if nothing was recorded
+        """
+        if not self.count:
+            return 0.
+        rank = max(1, int(round(self.count * p / 100.)))
+        total = 0
+        for index, count in enumerate(self._counts):
+            total += count
+            if total >= rank:
+                return min(self._value(index) / 1e6, self.max)
+        return self.max
+
+    def reset(self):
+        r"""
+        Clear the histogram
+        """
+        self._counts = [0] * len(self._counts)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+class _StageSummary(object):
+    # Exposes the histograms of a tracer as a summary in a metrics registry
+    type = 'summary'
+    quantiles = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, name, tracer):
+        self.name = name
+        self.help = "Latency of the stages from the OTGW to the broker"
+        self._tracer = tracer
+
+    def collect(self):
+        samples = []
+        for stage in stages:
+            histogram = self._tracer.histograms[stage]
+            for quantile in self.quantiles:
+                samples.append((self.name,
+                                '{{stage="{}",quantile="{}"}}'.format(
+                                    stage, quantile),
+                                histogram.percentile(quantile * 100), ))
+            label = '{{stage="{}"}}'.format(stage)
+            samples.append(('{}_sum'.format(self.name), label,
+                            histogram.sum, ))
+            samples.append(('{}_count'.format(self.name), label,
+                            histogram.count, ))
+        return samples
+
+class Tracer(object):
+    r"""
+    Trace messages through the stages of the bridge
+
+    `start` is called when a message is passed to the listener, `mark` when
+    it passes the end of the `queue` and `batch` stages, `published` when
+    the MQTT client has queued it and `written` from the client's
+    `on_publish` callback. Each stage is recorded from a single thread, so
+    no locks are needed. Only `write` and `total` may be recorded by the
+    thread calling `published`, when the MQTT client's thread writes the
+    message before `published` is called.
+
+    If `registry` is given, the histograms are exposed in it as
+    `otgw_stage_latency_seconds`.
+    """
+    # Stop tracking messages that are never written after this many
+    _max_pending = 10000
+
+    def __init__(self, registry=None, clock=time_func):
+        self.clock = clock
+        self.histograms = dict((stage, LatencyHistogram())
+                               for stage in stages)
+        # Maps topics to [read time, time of the last stage]
+        self._topics = {}
+        # Maps message ids to [read time, time of the last stage]
+        self._mids = {}
+        # Maps message ids to the time they were written, for messages that
+        # were written before published was called
+        self._written = {}
+        if registry is not None:
+            registry.register(_StageSummary('otgw_stage_latency_seconds',
+                                            self))
+
+    def start(self, topic, read_time):
+        r"""
+        Start tracing a message that was read at read_time
+        """
+        now = self.clock()
+        self.histograms['decode'].record(now - read_time)
+        self._topics[topic] = [read_time, now]
+
+    def mark(self, topic, stage):
+        r"""
+        Record the end of stage for the message on topic
+        """
+        trace = self._topics.get(topic)
+        if trace is None:
+            return
+        now = self.clock()
+        self.histograms[stage].record(now - trace[1])
+        trace[1] = now
+
+    def published(self, topic, mid):
+        r"""
+        Record that the message on topic was queued by the MQTT client as
+        mid
+        """
+        trace = self._topics.pop(topic, None)
+        if trace is None:
+            return
+        now = self.clock()
+        handed = trace[1]
+        self.histograms['publish'].record(now - handed)
+        trace[1] = now
+        if len(self._mids) >= self._max_pending:
+            # The messages were lost, for example because the connection
+            # dropped before they were written
+            self._mids.clear()
+            self._written.clear()
+        self._mids[mid] = trace
+        # The client's thread may have written the message already. Times
+        # from before the message was handed to the client are left over
+        # from an earlier message with the same id.
+        written = self._written.pop(mid, None)
+        if written is not None and written >= handed:
+            trace = self._mids.pop(mid, None)
+            if trace is not None:
+                self._finish(trace, written)
+
+    def written(self, mid):
+        r"""
+        Record that message mid was written to the broker
+        """
+        now = self.clock()
+        trace = self._mids.pop(mid, None)
+        if trace is None:
+            # Leave the time for published, then check again in case it
+            # stored the message in the meantime
+            if len(self._written) >= self._max_pending:
+                self._written.clear()
+            self._written[mid] = now
+            trace = self._mids.pop(mid, None)
+            if trace is None:
+                return
+            self._written.pop(mid, None)
+        self._finish(trace, now)
+
+    def _finish(self, trace, now):
+        # A message written before published was called spent no time in
+        # the write stage
+        self.histograms['write'].record(max(0., now - trace[1]))
+        self.histograms['total'].record(now - trace[0])
+
+    def report(self):
+        r"""
+        Get a table of the latencies of all stages in milliseconds
+        """
+        lines = ["{:<8} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            "stage", "count", "p50", "p90", "p99", "max")]
+        for stage in stages:
+            histogram = self.histograms[stage]
+            lines.append("{:<8} {:>9} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}"
+                         .format(stage, histogram.count,
+                                 histogram.percentile(50) * 1e3,
+                                 histogram.percentile(90) * 1e3,
+                                 histogram.percentile(99) * 1e3,
+                                 histogram.max * 1e3))
+        return '\n'.join(lines)
+
+    def reset(self):
+        r"""
+        Clear the histograms
+        """
+        for histogram in self.histograms.values():
+            histogram.reset()